@@ -0,0 +1,832 @@
+import os
+import re
+import glob
+import json
+import hashlib
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+
+import nomenclator
+from nomenclator import variantes_nombre
+
+# =====================================================
+# ALMACÉN COLUMNAR DE DATOS
+# =====================================================
+# El scraping genera los datos en excel, pero leerlos con openpyxl es muy lento.
+# Este módulo compila los datos en ficheros parquet tipados (un fichero por dataset) dentro de data/almacen,
+# junto con un manifest.json con el esquema, el número de filas y el checksum de cada fichero.
+# Tanto la app de streamlit como el script de scraping leen y escriben a través de aquí. El excel queda solo como exportación.
+#
+# Cada dataset tiene además una copia Arrow sin comprimir (<dataset>.arrow) para la app. Se abre con memory-map:
+# las columnas numéricas y de texto apuntan directamente a las páginas del fichero, así que todas las sesiones
+# y todos los procesos de la app comparten la misma memoria (la caché de páginas del sistema) en vez de una copia cada uno.
+
+CARPETA_ALMACEN = "almacen"
+MANIFEST = "manifest.json"
+
+DATASETS = {
+    "renta": "renta.parquet",
+    # Modelo largo de criminalidad: una fila por región, tipo de delito, año y trimestre (ver modelo_largo)
+    "criminalidad": "criminalidad.parquet",
+    # Trimestres acumulados tal y como se descargan (sirven para la actualizacion incremental del scraping)
+    "criminalidad_enero_marzo": "criminalidad_enero_marzo.parquet",
+    "criminalidad_enero_junio": "criminalidad_enero_junio.parquet",
+    "criminalidad_enero_septiembre": "criminalidad_enero_septiembre.parquet",
+    "criminalidad_enero_diciembre": "criminalidad_enero_diciembre.parquet",
+    # Dimensión geográfica por código INE de municipio y cruce de criminalidad y renta por municipio
+    "geografia": "geografia.parquet",
+    "delitos_renta": "delitos_renta.parquet",
+}
+
+# Esquema de las columnas de texto. Las muy repetidas se guardan como categóricas (dictionary encoding en parquet y Arrow):
+# en memoria son códigos enteros y los filtros y groupbys comparan códigos en vez de cadenas
+COLUMNAS_CATEGORICAS = ["Comunidad", "Provincia", "Municipio", "Tipo Delito", "Trimestre", "comunidad_autonoma", "provincia",
+                        "comunidad", "unidad_renta", "fichero_origen"]
+# Las casi únicas (una por municipio) no ganan nada como categóricas: string[pyarrow] guarda todas las cadenas
+# en un único buffer en vez de un objeto Python por fila
+COLUMNAS_TEXTO = ["Municipios", "codigo_ine", "municipio", "municipio_delitos"]
+# Se sube al cambiar el esquema. Los datasets guardados con otra versión se regeneran desde sus fuentes si las tienen
+# (p. ej. los excels de rentas) y si no, se vuelven a tipar al cargarlos
+VERSION_ESQUEMA = 4
+
+
+def ruta_almacen(path):
+    return os.path.join(path, CARPETA_ALMACEN)
+
+
+def firma_ficheros(lista_ficheros):
+    # (ruta, fecha de modificación, tamaño) de cada fichero. Sirve para saber si un dataset está desactualizado
+    return tuple(
+        (os.path.basename(fichero), os.path.getmtime(fichero), os.path.getsize(fichero))
+        for fichero in lista_ficheros if os.path.exists(fichero)
+    )
+
+
+def ficheros_rentas(path):
+    # Todos los excels de rentas de la carpeta, ignorando los ficheros temporales de excel (~$...)
+    return sorted(
+        f for f in glob.glob(os.path.join(path, "*_datos_rentas.xlsx"))
+        if not os.path.basename(f).startswith("~$")
+    )
+
+
+def leer_manifest(path):
+    ruta = os.path.join(ruta_almacen(path), MANIFEST)
+    if not os.path.exists(ruta):
+        return {"datasets": {}}
+    with open(ruta, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def escribir_manifest(path, manifest):
+    with open(os.path.join(ruta_almacen(path), MANIFEST), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+
+def sha256_fichero(ruta):
+    h = hashlib.sha256()
+    with open(ruta, "rb") as f:
+        for bloque in iter(lambda: f.read(1 << 20), b""):
+            h.update(bloque)
+    return h.hexdigest()
+
+
+def tipar(df):
+    # Quitamos el índice que deja to_excel y pasamos a categóricas las columnas de texto repetidas.
+    # Las cadenas vacías se guardan como nulos, igual que quedan al pasar por excel (la app filtra con isna())
+    df = df.drop(columns=[c for c in df.columns if str(c).startswith("Unnamed:")])
+    if "fichero_origen" in df.columns:
+        # Solo el nombre del excel, no la ruta completa de la máquina que lo generó
+        df["fichero_origen"] = df["fichero_origen"].astype(object).map(os.path.basename, na_action="ignore")
+    for col in COLUMNAS_CATEGORICAS:
+        if col in df.columns:
+            df[col] = df[col].mask(df[col] == "").astype("category")
+    for col in COLUMNAS_TEXTO:
+        if col in df.columns:
+            df[col] = df[col].mask(df[col] == "").astype(pd.StringDtype("pyarrow"))
+    # Id entero de la comunidad y la provincia (ver nomenclator.py): los cruces con otras fuentes se hacen por él
+    for nivel, col_id in nomenclator.COLUMNAS_ID.items():
+        if nivel in df.columns:
+            df[col_id] = nomenclator.ids_region(nivel, df[nivel])
+    return df
+
+
+def informe_memoria(df):
+    """ Memoria de cada columna (con el contenido de las cadenas) y el total, en MB."""
+    memoria = df.memory_usage(deep=True, index=False) / 1e6
+    informe = pd.DataFrame({"tipo": df.dtypes.astype(str), "MB": memoria})
+    informe.loc["Total"] = ["", memoria.sum()]
+    return informe
+
+
+def ruta_arrow(path, nombre):
+    return os.path.join(ruta_almacen(path), os.path.splitext(DATASETS[nombre])[0] + ".arrow")
+
+
+def escribir_arrow(ruta, df):
+    # Los NaN de las columnas float se guardan como valores y no como nulos: sin máscara de nulos,
+    # to_pandas puede devolver la columna sin copiarla
+    tabla = pa.Table.from_pandas(df, preserve_index=False)
+    for i, campo in enumerate(tabla.schema):
+        if pa.types.is_floating(campo.type):
+            tabla = tabla.set_column(i, campo, pa.array(df[campo.name].to_numpy(), type=campo.type, from_pandas=False))
+    with pa.OSFile(ruta, "wb") as f, ipc.new_file(f, tabla.schema) as escritor:
+        escritor.write_table(tabla)
+
+
+def tipos_pandas(tipo_arrow):
+    # El texto se lee como string[pyarrow] (sin esto, pandas lo convierte a un objeto Python por fila)
+    if pa.types.is_string(tipo_arrow) or pa.types.is_large_string(tipo_arrow):
+        return pd.StringDtype("pyarrow")
+    return None
+
+
+def leer_parquet(ruta):
+    return pq.read_table(ruta).to_pandas(types_mapper=tipos_pandas)
+
+
+def abrir_arrow(ruta):
+    """ DataFrame de solo lectura sobre el fichero Arrow mapeado en memoria. Las columnas float y de texto
+        (string[pyarrow]) no se copian; las categóricas solo copian los códigos."""
+    tabla = ipc.open_file(pa.memory_map(ruta, "r")).read_all()
+    return tabla.to_pandas(split_blocks=True, types_mapper=tipos_pandas)
+
+
+def guardar_dataset(path, nombre, df, fuentes=()):
+    os.makedirs(ruta_almacen(path), exist_ok=True)
+    df = tipar(df)
+    ruta = os.path.join(ruta_almacen(path), DATASETS[nombre])
+    df.to_parquet(ruta, index=False)
+    escribir_arrow(ruta_arrow(path, nombre), df)
+
+    manifest = leer_manifest(path)
+    manifest["datasets"][nombre] = {
+        "fichero": DATASETS[nombre],
+        "filas": len(df),
+        "esquema": {col: str(dtype) for col, dtype in df.dtypes.items()},
+        "sha256": sha256_fichero(ruta),
+        "fuentes": [list(x) for x in fuentes],
+        "version_esquema": VERSION_ESQUEMA,
+    }
+    escribir_manifest(path, manifest)
+    return df
+
+
+def cargar_dataset(path, nombre, fuentes=None, compartido=False):
+    """ Devuelve el dataset del almacén o None si no existe.
+        Si se pasan las fuentes (firma de los ficheros de origen) y no coinciden con las del manifest, también devuelve None.
+        Con compartido=True se devuelve la copia Arrow mapeada en memoria (de solo lectura, ver abrir_arrow)."""
+    info = leer_manifest(path)["datasets"].get(nombre)
+    if info is None:
+        return None
+    ruta = os.path.join(ruta_almacen(path), info["fichero"])
+    if not os.path.exists(ruta):
+        return None
+    if fuentes is not None and [list(x) for x in fuentes] != info["fuentes"]:
+        return None
+    if info.get("version_esquema") != VERSION_ESQUEMA:
+        if info["fuentes"]:
+            return None
+        try:
+            guardar_dataset(path, nombre, leer_parquet(ruta), fuentes=info["fuentes"])
+        except OSError:
+            return tipar(leer_parquet(ruta))
+    if not compartido:
+        return leer_parquet(ruta)
+    if not os.path.exists(ruta_arrow(path, nombre)) or os.path.getmtime(ruta_arrow(path, nombre)) < os.path.getmtime(ruta):
+        # Almacén generado antes de existir la copia Arrow (o parquet reescrito por fuera)
+        try:
+            escribir_arrow(ruta_arrow(path, nombre), leer_parquet(ruta))
+        except OSError:
+            return leer_parquet(ruta)
+    return abrir_arrow(ruta_arrow(path, nombre))
+
+
+def dataset_al_dia(path, nombre, fuentes=None):
+    # Lo mismo que comprueba cargar_dataset (existe, con esas fuentes y con el esquema actual), sin leer el dataset
+    info = leer_manifest(path)["datasets"].get(nombre)
+    return (info is not None and os.path.exists(os.path.join(ruta_almacen(path), info["fichero"]))
+            and (fuentes is None or [list(x) for x in fuentes] == info["fuentes"])
+            and info.get("version_esquema") == VERSION_ESQUEMA)
+
+
+# =====================================================
+# PREPARACIÓN DE LOS DATASETS
+# =====================================================
+def ids_provincia(codigos_ine):
+    # El id de la provincia en el nomenclátor es su código INE: los 2 primeros dígitos del código de municipio
+    return pd.to_numeric(pd.Series(codigos_ine).str[:2], errors="coerce").fillna(nomenclator.SIN_ID).astype("int8")
+
+
+def ids_comunidad(ids_provincia):
+    return ids_provincia.map(nomenclator.COMUNIDAD_DE_PROVINCIA).fillna(nomenclator.SIN_ID).astype("int8")
+
+
+def codigos_renta(etiquetas):
+    """ Código completo, código INE del municipio y unidad (Municipio, Distrito o Sección) de cada etiqueta de renta.
+        "28079 Madrid", "0700101 Alaró distrito 01", "0311902006 Sant Joan d'Alacant sección 02006": los 5 primeros
+        dígitos son el código INE del municipio (los 2 primeros, la provincia), 2 más el distrito y 3 más la sección.
+        Nulos si la etiqueta no empieza por un código."""
+    etiquetas = pd.Series(etiquetas)
+    partes = etiquetas.astype(str).str.extract(r"^(\d{5})(\d{2})?(\d{3})?\s")
+    unidad = pd.Series(
+        np.select([partes[2].notna(), partes[1].notna()], ["Sección", "Distrito"], default="Municipio"),
+        index=etiquetas.index,
+    ).where(partes[0].notna())
+    return pd.DataFrame({
+        "codigo": partes[0] + partes[1].fillna("") + partes[2].fillna(""),
+        "codigo_ine": partes[0],
+        "unidad_renta": unidad,
+    })
+
+
+def preparar_rentas(lista_excels):
+    dfs = []
+    for fichero in lista_excels:
+        if not os.path.exists(fichero):
+            continue
+        df = pd.read_excel(fichero)
+        df["fichero_origen"] = fichero
+        dfs.append(df)
+
+    if not dfs:
+        return None
+
+    df_total = pd.concat(dfs, ignore_index=True)
+    codigos = codigos_renta(df_total["Municipios"])
+    df_total["codigo_ine"] = codigos["codigo_ine"]
+    df_total["unidad_renta"] = codigos["unidad_renta"]
+    # Las filas sin código INE (totales, filas vacías) se quitan aquí y no al leer: la app usa el dataframe
+    # mapeado tal cual y un dropna al cargarlo copiaría todas las columnas
+    df_total = df_total.dropna(subset=["codigo_ine"]).reset_index(drop=True)
+    df_total["id_provincia"] = ids_provincia(df_total["codigo_ine"])
+    df_total["id_comunidad"] = ids_comunidad(df_total["id_provincia"])
+    df_total["provincia"] = df_total["id_provincia"].map(nomenclator.NOMBRES["Provincia"])
+    df_total["comunidad_autonoma"] = df_total["id_comunidad"].map(nomenclator.NOMBRES["Comunidad"])
+
+    columnas_renta = [col for col in df_total.columns if "Renta" in col or "Media" in col or "Mediana" in col]
+    for col in columnas_renta:
+        df_total[col] = pd.to_numeric(df_total[col], errors="coerce")
+
+    return df_total
+
+
+def cargar_rentas(path, lista_excels, compartido=False):
+    # Parquet si está al día con los excels. Si no, se leen los excels y se regenera el dataset
+    fuentes = firma_ficheros(lista_excels)
+    df = cargar_dataset(path, "renta", fuentes=fuentes, compartido=compartido)
+    if df is not None:
+        return df
+    df = preparar_rentas(lista_excels)
+    if df is None:
+        return None
+    try:
+        guardar_dataset(path, "renta", df, fuentes=fuentes)
+        return cargar_dataset(path, "renta", compartido=compartido)
+    except OSError:
+        # Carpeta de solo lectura: seguimos sin almacén
+        return tipar(df)
+
+
+# =====================================================
+# AGREGADOS DE RENTA
+# =====================================================
+# La pestaña de rentas pide medias, medianas y rankings de una métrica para un conjunto de comunidades.
+# Al cargar los datos se calculan una vez las estadísticas de cada comunidad y, para cada métrica, las posiciones
+# de los municipios de cada comunidad ordenadas de mayor a menor. Un ranking solo une las cabezas de esas listas.
+METRICAS_RENTA = [
+    "Renta neta media por persona 2023",
+    "Renta neta media por persona 2022",
+    "Renta neta media por hogar 2023",
+    "Renta neta media por hogar 2022",
+    "Media de la renta por unidad de consumo 2023",
+    "Media de la renta por unidad de consumo 2022",
+    "Mediana de la renta por unidad de consumo 2023",
+    "Mediana de la renta por unidad de consumo 2022",
+    "Renta bruta media por persona 2023",
+    "Renta bruta media por persona 2022",
+    "Renta bruta media por hogar 2023",
+    "Renta bruta media por hogar 2022",
+]
+
+
+def orden_descendente(valores):
+    # Posiciones de mayor a menor valor (en empate, la primera posición), sin los NaN
+    posiciones = np.lexsort((np.arange(len(valores)), -valores))
+    return posiciones[~np.isnan(valores[posiciones])]
+
+
+def construir_agregados_renta(df_rentas):
+    """ Devuelve un diccionario con:
+        - "comunidades": por comunidad, media, mediana y número de valores de cada métrica
+          (columnas (métrica, estadística)) y número de municipios
+        - "total": {métrica: (media, mediana, número de valores)} de todas las comunidades juntas
+        - "orden": {métrica: {comunidad: posiciones}} posiciones (iloc) de los municipios con dato de cada comunidad,
+          de mayor a menor valor de la métrica. Con la clave None, las de todas las comunidades"""
+    grupos = df_rentas.groupby("comunidad_autonoma", observed=True)
+    comunidades = grupos[METRICAS_RENTA].agg(["mean", "median", "count"])
+    comunidades["municipios"] = grupos["Municipios"].count()
+
+    codigos = df_rentas["comunidad_autonoma"].cat.codes.to_numpy()
+    categorias = df_rentas["comunidad_autonoma"].cat.categories
+    total, orden = {}, {}
+    for metrica in METRICAS_RENTA:
+        valores = df_rentas[metrica].to_numpy(dtype="float64")
+        posiciones = orden_descendente(valores)
+        # Reparto estable por comunidad: cada trozo conserva el orden de mayor a menor
+        por_comunidad = np.argsort(codigos[posiciones], kind="stable")
+        cortes = np.searchsorted(codigos[posiciones][por_comunidad], np.arange(len(categorias) + 1))
+        orden[metrica] = {
+            comunidad: posiciones[por_comunidad[cortes[i]:cortes[i + 1]]]
+            for i, comunidad in enumerate(categorias) if cortes[i + 1] > cortes[i]
+        }
+        # Sin las filas sin comunidad, que ninguna selección incluye
+        orden[metrica][None] = posiciones[codigos[posiciones] >= 0]
+        valores_total = valores[orden[metrica][None]]
+        total[metrica] = (valores_total.mean(), np.median(valores_total), len(valores_total)) if len(valores_total) else (np.nan, np.nan, 0)
+    return {"comunidades": comunidades, "total": total, "orden": orden}
+
+
+def todas_las_comunidades(agregados, metrica, comunidades):
+    return set(agregados["orden"][metrica]) - {None} <= set(comunidades)
+
+
+def posiciones_renta(agregados, metrica, comunidades, top_n=None):
+    # Posiciones con dato de las comunidades pedidas; con top_n, solo las top_n primeras de cada una
+    listas = [agregados["orden"][metrica][c][:top_n] for c in comunidades if c in agregados["orden"][metrica]]
+    return np.concatenate(listas) if listas else np.array([], dtype="int64")
+
+
+def resumen_renta(df_rentas, agregados, metrica, comunidades):
+    # (media, mediana, número de municipios con dato) de la métrica en esas comunidades
+    if todas_las_comunidades(agregados, metrica, comunidades):
+        return agregados["total"][metrica]
+    posiciones = posiciones_renta(agregados, metrica, comunidades)
+    if len(posiciones) == 0:
+        return np.nan, np.nan, 0
+    valores = df_rentas[metrica].to_numpy(dtype="float64")[posiciones]
+    return valores.mean(), np.median(valores), len(valores)
+
+
+def ranking_renta(df_rentas, agregados, metrica, comunidades, top_n):
+    """ Los top_n municipios con mayor valor de la métrica en esas comunidades, de mayor a menor.
+        Cada comunidad aporta como mucho sus top_n primeros y solo se ordenan esos candidatos."""
+    if todas_las_comunidades(agregados, metrica, comunidades):
+        return df_rentas.iloc[agregados["orden"][metrica][None][:top_n]]
+    candidatos = np.sort(posiciones_renta(agregados, metrica, comunidades, top_n))
+    valores = df_rentas[metrica].to_numpy(dtype="float64")[candidatos]
+    return df_rentas.iloc[candidatos[np.argsort(-valores, kind="stable")[:top_n]]]
+
+
+# =====================================================
+# RENTA POR DISTRITOS Y SECCIONES CENSALES
+# =====================================================
+# Por debajo del municipio el INE publica la renta de cada distrito y de cada sección censal (~36.000 secciones).
+# No se carga entera: se guarda en un dataset particionado por provincia (renta_unidades/id_provincia=NN/unidades.parquet)
+# con una fila por unidad (municipio, distrito o sección) y el código de su padre: la provincia del municipio,
+# el municipio del distrito y el distrito de la sección. Dentro de cada partición las filas van ordenadas por
+# codigo_padre en grupos de filas pequeños, y el min/max de codigo_padre de cada grupo hace de índice: abrir un nodo
+# lee solo la partición de su provincia y los grupos que contienen a sus hijos.
+CARPETA_UNIDADES_RENTA = "renta_unidades"
+FICHERO_PARTICION = "unidades.parquet"
+# Lo mínimo que se lee al abrir un nodo
+FILAS_GRUPO_UNIDADES = 1024
+UNIDADES_RENTA = ["Municipio", "Distrito", "Sección"]
+# El código del padre son los primeros dígitos del código de la unidad (2 = código de la provincia)
+DIGITOS_PADRE = {"Municipio": 2, "Distrito": 5, "Sección": 7}
+COLUMNAS_UNIDADES = ["codigo", "codigo_padre", "unidad_renta", "nombre"] + METRICAS_RENTA
+
+
+def ruta_particion_unidades(path, id_provincia):
+    return os.path.join(ruta_almacen(path), CARPETA_UNIDADES_RENTA, f"id_provincia={id_provincia:02d}", FICHERO_PARTICION)
+
+
+def preparar_unidades_renta(df):
+    """ Una fila por unidad con COLUMNAS_UNIDADES e id_provincia, a partir de una tabla con la etiqueta de cada unidad
+        en "Municipios" y las métricas en columnas, como los excels de rentas. Se descartan las filas sin código."""
+    codigos = codigos_renta(df["Municipios"])
+    validas = codigos["codigo"].notna().to_numpy()
+    df, codigos = df[validas], codigos[validas]
+    unidades = pd.DataFrame({
+        "codigo": codigos["codigo"].astype(str),
+        "codigo_padre": [codigo[:DIGITOS_PADRE[unidad]] for codigo, unidad in zip(codigos["codigo"], codigos["unidad_renta"])],
+        "unidad_renta": codigos["unidad_renta"].astype(str),
+        "nombre": df["Municipios"].astype(str).str.replace(r"^\d+\s+", "", regex=True),
+    })
+    for col in METRICAS_RENTA:
+        unidades[col] = pd.to_numeric(df[col], errors="coerce") if col in df.columns else np.nan
+    unidades["id_provincia"] = ids_provincia(unidades["codigo"])
+    return unidades[unidades["id_provincia"] != nomenclator.SIN_ID].drop_duplicates("codigo").reset_index(drop=True)
+
+
+def guardar_unidades_renta(path, df_unidades):
+    """ Escribe la partición de cada provincia de df_unidades (reemplaza la que hubiera) y no toca las demás:
+        cada worker del scraping puede guardar su provincia por separado."""
+    for id_provincia, df in df_unidades.groupby("id_provincia", sort=True):
+        ruta = ruta_particion_unidades(path, id_provincia)
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        tabla = pa.Table.from_pandas(df.sort_values(["codigo_padre", "codigo"])[COLUMNAS_UNIDADES], preserve_index=False)
+        # Se escribe con otro nombre y se renombra para que nadie lea una partición a medias.
+        # Los ficheros que empiezan por "." no forman parte del dataset (ver indice_unidades_renta)
+        temporal = os.path.join(os.path.dirname(ruta), "." + FICHERO_PARTICION)
+        pq.write_table(tabla, temporal, row_group_size=FILAS_GRUPO_UNIDADES)
+        os.replace(temporal, ruta)
+
+
+def completar_unidades_renta(path, df_rentas):
+    # Crea desde la renta municipal las particiones de las provincias que aún no tienen (las del scraping traen
+    # además distritos y secciones, así que nunca se sobrescriben desde aquí)
+    unidades = preparar_unidades_renta(df_rentas)
+    faltan = [not os.path.exists(ruta_particion_unidades(path, id_provincia)) for id_provincia in unidades["id_provincia"]]
+    guardar_unidades_renta(path, unidades[faltan])
+
+
+def indice_unidades_renta(path):
+    """ Índice de padres del dataset: {codigo_padre: número de hijos}, vacío si no hay datos.
+        Solo se lee la columna codigo_padre de cada partición. Dice qué nodos se pueden abrir sin leer sus hijos."""
+    carpeta = os.path.join(ruta_almacen(path), CARPETA_UNIDADES_RENTA)
+    if not os.path.isdir(carpeta):
+        return {}
+    padres = ds.dataset(carpeta, format="parquet", partitioning="hive").to_table(columns=["codigo_padre"])["codigo_padre"]
+    return {fila["values"]: fila["counts"] for fila in pc.value_counts(padres).to_pylist()}
+
+
+def hijos_renta(path, codigo_padre, columnas=None):
+    """ Unidades hijas de un nodo: los municipios de una provincia ("28"), los distritos de un municipio ("28079")
+        o las secciones de un distrito ("2807901"), ordenadas por código. None si su provincia no tiene datos."""
+    ruta = ruta_particion_unidades(path, int(codigo_padre[:2]))
+    if not os.path.exists(ruta):
+        return None
+    # El filtro descarta los grupos de filas por sus estadísticas antes de leerlos. El id de la provincia va en
+    # el nombre de la carpeta, no en el fichero (partitioning=None: no se añade como columna)
+    tabla = pq.read_table(ruta, columns=columnas, filters=[("codigo_padre", "=", codigo_padre)], partitioning=None)
+    return tabla.to_pandas(types_mapper=tipos_pandas)
+
+
+# =====================================================
+# MODELO LARGO DE CRIMINALIDAD
+# =====================================================
+# El dato de criminalidad se guarda en formato largo: Comunidad, Provincia, Municipio, Tipo Delito, Año, Trimestre y Valor.
+# Añadir un año solo añade filas. Las vistas anchas (una columna por trimestre y año) y las variaciones interanuales
+# se calculan al pedirlas, para el año que se quiere ver.
+TRIMESTRES = ["Enero-Marzo", "Abril-Junio", "Julio-Septiembre", "Octubre-Diciembre"]
+CLAVES_DELITO = ["Comunidad", "Provincia", "Municipio", "Tipo Delito"]
+COLUMNAS_MODELO = CLAVES_DELITO + ["Año", "Trimestre", "Valor"]
+
+
+def columnas_por_anio(df, prefijo):
+    # {año: columna} de las columnas con nombre "<prefijo><año>", p. ej. {2023: "Dato 2023", 2022: "Dato 2022"}
+    patron = re.compile(rf"^{re.escape(prefijo)}(\d{{4}})$")
+    return {int(m.group(1)): col for col in df.columns if (m := patron.match(str(col)))}
+
+
+def tipar_modelo(df):
+    df = tipar(df[COLUMNAS_MODELO])
+    df["Año"] = df["Año"].astype("int16")
+    df["Trimestre"] = df["Trimestre"].astype(pd.CategoricalDtype(TRIMESTRES, ordered=True))
+    # Son recuentos de delitos: float32 es exacto hasta 16 millones y ocupa la mitad
+    df["Valor"] = pd.to_numeric(df["Valor"], errors="coerce").astype("float32")
+    return df
+
+
+def modelo_largo(df_long):
+    """ Pasa el LONG del scraping (una columna "Dato <año>" por año) al modelo largo."""
+    datos = columnas_por_anio(df_long, "Dato ")
+    df = df_long.melt(id_vars=CLAVES_DELITO + ["Trimestre"], value_vars=list(datos.values()), var_name="Año", value_name="Valor")
+    df["Año"] = df["Año"].map({col: anio for anio, col in datos.items()})
+    return tipar_modelo(df)
+
+
+def combinar_modelos(*modelos):
+    # Cada publicación del ministerio trae un año y el anterior. Si un (región, delito, año, trimestre) viene en varias,
+    # se queda el de la última, que es la que puede traer el dato revisado
+    df = pd.concat([m.astype({col: object for col in CLAVES_DELITO}) for m in modelos if m is not None], ignore_index=True)
+    df = df.drop_duplicates(subset=COLUMNAS_MODELO[:-1], keep="last")
+    return tipar_modelo(df.reset_index(drop=True))
+
+
+def anios_modelo(modelo):
+    return sorted(int(anio) for anio in modelo["Año"].unique())
+
+
+def anios_comparables(modelo):
+    # Años que tienen datos del año anterior con los que calcular la variación
+    return anios_con_anterior(anios_modelo(modelo))
+
+
+def anios_con_anterior(anios):
+    return [anio for anio in anios if anio - 1 in anios]
+
+
+def mensaje_sin_anios_comparables(anios, anio=None):
+    # Las vistas de criminalidad comparan un año con el anterior: con un solo año en el almacén no hay nada que comparar
+    if anio is not None:
+        return f"No hay datos de criminalidad de {anio - 1} con los que comparar {anio}"
+    disponibles = ", ".join(str(a) for a in anios) or "ninguno"
+    return (f"Los datos de criminalidad no tienen dos años seguidos que comparar (años en el almacén: {disponibles}). "
+            "Vuelve a descargar los datos del ministerio, que traen cada año junto con el anterior")
+
+
+def variacion(actual, anterior):
+    return ((actual - anterior) / anterior * 100).round(1)
+
+
+def vista_ancha(modelo, anio=None):
+    """ Vista ancha de un año frente al anterior, con las columnas "<trimestre><año>", "<trimestre>_VAR_<año>_<anterior>",
+        "Total_<año>" y "Variación_total_<año>_<anterior>". Por defecto, el último año que se puede comparar.
+        Conserva los ids de comunidad y provincia del modelo.
+        Si el año no se puede comparar (o no hay ninguno, p. ej. con un solo año en el modelo) lanza ValueError."""
+    comparables = anios_comparables(modelo)
+    if anio is None and comparables:
+        anio = comparables[-1]
+    if anio not in comparables:
+        raise ValueError(mensaje_sin_anios_comparables(anios_modelo(modelo), anio))
+    anterior = anio - 1
+    df = modelo[modelo["Año"].isin([anio, anterior])]
+    claves = CLAVES_DELITO + [col for col in nomenclator.COLUMNAS_ID.values() if col in df.columns]
+
+    valores = (
+        df.set_index(claves + ["Año", "Trimestre"])["Valor"]
+        .unstack(["Año", "Trimestre"])
+        .reindex(columns=pd.MultiIndex.from_product([[anio, anterior], TRIMESTRES]))
+        .astype("float64")
+        .fillna(0)
+    )
+
+    ancho = pd.DataFrame(index=valores.index)
+    for a in (anio, anterior):
+        for trimestre in TRIMESTRES:
+            ancho[f"{trimestre}{a}"] = valores[(a, trimestre)]
+    for trimestre in TRIMESTRES:
+        ancho[f"{trimestre}_VAR_{anio}_{anterior}"] = variacion(valores[(anio, trimestre)], valores[(anterior, trimestre)])
+    ancho[f"Total_{anio}"] = valores[anio].sum(axis=1)
+    ancho[f"Total_{anterior}"] = valores[anterior].sum(axis=1)
+    ancho[f"Variación_total_{anio}_{anterior}"] = variacion(ancho[f"Total_{anio}"], ancho[f"Total_{anterior}"])
+
+    return ancho.reset_index()
+
+
+def columnas_ancha(anio):
+    # Columnas de vista_ancha de un año (con los ids de región del modelo), sin tener que calcularla
+    anterior = anio - 1
+    return (CLAVES_DELITO + list(nomenclator.COLUMNAS_ID.values())
+            + [f"{trimestre}{a}" for a in (anio, anterior) for trimestre in TRIMESTRES]
+            + [f"{trimestre}_VAR_{anio}_{anterior}" for trimestre in TRIMESTRES]
+            + [f"Total_{anio}", f"Total_{anterior}", f"Variación_total_{anio}_{anterior}"])
+
+
+def columnas_vista(trimestre, anio):
+    # Columnas de vista_ancha con el dato del año, el del anterior y la variación. trimestre puede ser "Total"
+    anterior = anio - 1
+    if trimestre == "Total":
+        return f"Total_{anio}", f"Total_{anterior}", f"Variación_total_{anio}_{anterior}"
+    return f"{trimestre}{anio}", f"{trimestre}{anterior}", f"{trimestre}_VAR_{anio}_{anterior}"
+
+
+def cargar_modelo_delitos(path, compartido=False):
+    # Modelo del almacén. Si no existe, se genera a partir del excel LONG que exporta el scraping
+    df = cargar_dataset(path, "criminalidad", compartido=compartido)
+    if df is not None:
+        return df
+    df = modelo_largo(pd.read_excel(os.path.join(path, "datos_criminalidad_espana_LONG.xlsx")))
+    try:
+        guardar_dataset(path, "criminalidad", df)
+        return cargar_dataset(path, "criminalidad", compartido=compartido)
+    except OSError:
+        return df
+
+
+# =====================================================
+# ÍNDICE DE FILTROS DE CRIMINALIDAD
+# =====================================================
+# Las vistas de la app filtran por región y tipo de delito en cada recarga. En vez de comparar columnas enteras,
+# se agrupan una vez las posiciones de las filas de cada valor y cada selección es un iloc con esas posiciones.
+NIVELES = ["Comunidad", "Provincia", "Municipio"]
+
+
+def nivel_geografico(df_delitos):
+    # Nivel de cada fila: las de comunidad no tienen provincia ni municipio, las de provincia no tienen municipio.
+    # Las cadenas vacías ya vienen como nulos (ver tipar), así que basta con isna()
+    sin_provincia = df_delitos["Provincia"].isna().to_numpy()
+    sin_municipio = df_delitos["Municipio"].isna().to_numpy()
+    codigos = np.select([sin_provincia & sin_municipio, sin_municipio], [0, 1], default=2).astype("int8")
+    return pd.Series(pd.Categorical.from_codes(codigos, NIVELES), index=df_delitos.index)
+
+
+def posiciones_por_grupo(columnas):
+    # {valor (o tupla de valores): array con las posiciones de sus filas}, en el orden original
+    return pd.DataFrame(columnas).groupby(list(columnas), observed=True, sort=False).indices
+
+
+def construir_indice_delitos(df_delitos):
+    """ Devuelve {clave: {valor: posiciones}} con las claves:
+        - "Comunidad", "Provincia", "Municipio" y "Tipo Delito": filas con ese valor en la columna
+        - (nivel, "Tipo Delito"): filas con esa región y ese tipo de delito, p. ej. ("Madrid", "8. Hurtos")
+        - "Nivel": filas de cada (nivel geográfico, tipo de delito), p. ej. ("Provincia", "8. Hurtos")"""
+    tipo = df_delitos["Tipo Delito"]
+    indice = {col: posiciones_por_grupo({col: df_delitos[col]}) for col in NIVELES + ["Tipo Delito"]}
+    for nivel in NIVELES:
+        indice[(nivel, "Tipo Delito")] = posiciones_por_grupo({nivel: df_delitos[nivel], "Tipo Delito": tipo})
+    indice["Nivel"] = posiciones_por_grupo({"Nivel": nivel_geografico(df_delitos), "Tipo Delito": tipo})
+    return indice
+
+
+def filas_indice(df, indice, clave, valor):
+    # Filas de df para un valor del índice (vacío si el valor no existe)
+    return df.iloc[indice[clave].get(valor, [])]
+
+
+# =====================================================
+# TABLA PAGINADA
+# =====================================================
+# La tabla de la app no envía el dataframe entero al navegador: el filtro (con el índice de posiciones) y el orden
+# (posiciones precalculadas por columna) se resuelven sobre posiciones enteras y solo se materializa la página visible
+# con las columnas elegidas. Lo que se envía depende del tamaño de la página, no del de los datos.
+def orden_tabla(df, columna, descendente=False):
+    """ Posiciones de las filas de df ordenadas por una columna, con los nulos al final. Las categóricas se ordenan
+        alfabéticamente y no por el orden de sus categorías."""
+    serie = df[columna].reset_index(drop=True)
+    if isinstance(serie.dtype, pd.CategoricalDtype):
+        serie = serie.cat.reorder_categories(sorted(serie.cat.categories))
+    return serie.sort_values(ascending=not descendente, na_position="last", kind="stable").index.to_numpy()
+
+
+def posiciones_filtro(indice, nivel=None, region=None, tipos_delito=()):
+    """ Posiciones (ordenadas) de las filas que cumplen los filtros, o None si no hay ninguno.
+        region es un valor de la columna del nivel; sin ella se filtra por el nivel geográfico de la fila."""
+    grupos = []
+    if region is not None:
+        grupos.append(indice[nivel].get(region, np.array([], dtype="int64")))
+    elif nivel is not None:
+        grupos.append(np.concatenate([pos for (n, _), pos in indice["Nivel"].items() if n == nivel] or [np.array([], dtype="int64")]))
+    if tipos_delito:
+        grupos.append(np.concatenate([indice["Tipo Delito"].get(tipo, np.array([], dtype="int64")) for tipo in tipos_delito]))
+    if not grupos:
+        return None
+    posiciones = np.sort(grupos[0])
+    for grupo in grupos[1:]:
+        posiciones = np.intersect1d(posiciones, grupo, assume_unique=True)
+    return posiciones
+
+
+def pagina_tabla(df, orden, posiciones, columnas, pagina, filas_por_pagina):
+    """ Devuelve (página, total de filas): las filas de posiciones (None = todas) en el orden de orden_tabla,
+        solo con las columnas pedidas. pagina empieza en 0."""
+    if posiciones is not None:
+        seleccion = np.zeros(len(df), dtype=bool)
+        seleccion[posiciones] = True
+        orden = orden[seleccion[orden]]
+    inicio = pagina * filas_por_pagina
+    filas = orden[inicio:inicio + filas_por_pagina]
+    return df.iloc[filas, df.columns.get_indexer(columnas)], len(orden)
+
+
+# =====================================================
+# DIMENSIÓN GEOGRÁFICA Y CRUCE DELITOS x RENTA
+# =====================================================
+# La renta viene por código INE de municipio y la criminalidad por nombre de municipio dentro de cada provincia.
+# La dimensión geográfica (municipio INE -> provincia -> comunidad) guarda una vez el nombre con el que cada municipio
+# aparece en los datos de criminalidad, y con ella se materializa la tabla delitos x renta por municipio.
+# Las dos se guardan en el almacén y solo se recalculan si cambia la renta o el modelo de criminalidad.
+COLUMNAS_RENTA_CRUCE = [
+    "Renta neta media por persona 2023", "Renta neta media por persona 2022",
+    "Renta neta media por hogar 2023", "Renta neta media por hogar 2022",
+    "Renta bruta media por persona 2023", "Renta bruta media por persona 2022",
+]
+
+
+def construir_geografia(df_rentas, modelo):
+    """ Una fila por municipio INE: codigo_ine, municipio, id_provincia, provincia, id_comunidad, comunidad
+        y municipio_delitos (nombre del municipio en los datos de criminalidad, nulo si no tiene datos)."""
+    municipios = df_rentas[df_rentas["unidad_renta"] == "Municipio"].drop_duplicates("codigo_ine")
+    geografia = pd.DataFrame({
+        "codigo_ine": municipios["codigo_ine"].astype(str).to_numpy(),
+        "municipio": municipios["Municipios"].astype(str).str.replace(r"^\d+\s+", "", regex=True).to_numpy(),
+    })
+    geografia["id_provincia"] = ids_provincia(geografia["codigo_ine"])
+    geografia["provincia"] = geografia["id_provincia"].map(nomenclator.NOMBRES["Provincia"])
+    geografia["id_comunidad"] = ids_comunidad(geografia["id_provincia"])
+    geografia["comunidad"] = geografia["id_comunidad"].map(nomenclator.NOMBRES["Comunidad"])
+
+    # Nombre en criminalidad: alguna variante en común dentro de la misma provincia (por id)
+    por_variante = {}
+    delitos = modelo.loc[modelo["Municipio"].notna(), ["id_provincia", "Municipio"]].drop_duplicates()
+    for provincia, municipio in zip(delitos["id_provincia"], delitos["Municipio"].astype(str)):
+        for variante in variantes_nombre(municipio):
+            por_variante.setdefault((provincia, variante), municipio)
+    geografia["municipio_delitos"] = [
+        next((por_variante[(provincia, v)] for v in sorted(variantes_nombre(nombre)) if (provincia, v) in por_variante), None)
+        for provincia, nombre in zip(geografia["id_provincia"], geografia["municipio"])
+    ]
+
+    # Los que quedan sin cruzar pueden estar con las dos formas unidas por un guion ("Maó-Mahón" frente a "Maó").
+    # No se parte siempre por el guion porque muchos nombres lo llevan ("Vélez-Rubio")
+    cruzados = set(geografia["municipio_delitos"].dropna())
+    por_parte = {}
+    for provincia, municipio in zip(delitos["id_provincia"], delitos["Municipio"].astype(str)):
+        if municipio not in cruzados:
+            for parte in municipio.split("-"):
+                for variante in variantes_nombre(parte):
+                    por_parte.setdefault((provincia, variante), municipio)
+    sin_cruzar = geografia["municipio_delitos"].isna()
+    geografia.loc[sin_cruzar, "municipio_delitos"] = [
+        next((por_parte[(provincia, v)] for v in sorted(variantes_nombre(nombre)) if (provincia, v) in por_parte), None)
+        for provincia, nombre in zip(geografia.loc[sin_cruzar, "id_provincia"], geografia.loc[sin_cruzar, "municipio"])
+    ]
+    return geografia
+
+
+def construir_delitos_renta(geografia, modelo, df_rentas):
+    """ Tabla materializada por municipio, tipo de delito y año: claves geográficas, total de delitos del año
+        (suma de sus trimestres), número de trimestres con dato y las métricas de renta del municipio."""
+    delitos = modelo[modelo["Municipio"].notna()]
+    anuales = (
+        delitos.groupby(["id_provincia", "Municipio", "Tipo Delito", "Año"], observed=True)["Valor"]
+        .agg(delitos="sum", trimestres="count")
+        .reset_index()
+    )
+    anuales["Municipio"] = anuales["Municipio"].astype(str)
+    claves = geografia.dropna(subset=["municipio_delitos"]).astype({"municipio_delitos": str})
+    tabla = claves.merge(anuales, left_on=["id_provincia", "municipio_delitos"], right_on=["id_provincia", "Municipio"])
+    renta = df_rentas[df_rentas["unidad_renta"] == "Municipio"].drop_duplicates("codigo_ine")
+    renta = renta.assign(codigo_ine=renta["codigo_ine"].astype(str))[["codigo_ine"] + COLUMNAS_RENTA_CRUCE]
+    tabla = tabla.merge(renta, on="codigo_ine", how="left")
+    tabla = tabla.drop(columns=["Municipio"]).rename(columns={"municipio_delitos": "Municipio"})
+    tabla["Año"] = tabla["Año"].astype("int16")
+    return tabla
+
+
+def fuentes_delitos_renta(path):
+    return firma_ficheros([os.path.join(ruta_almacen(path), DATASETS[nombre]) for nombre in ("renta", "criminalidad")])
+
+
+def cargar_delitos_renta(path, compartido=False):
+    """ Devuelve (geografia, delitos_renta) del almacén. Se regeneran si cambian los datasets de renta o criminalidad."""
+    fuentes = fuentes_delitos_renta(path)
+    geografia = cargar_dataset(path, "geografia", fuentes=fuentes, compartido=compartido)
+    delitos_renta = cargar_dataset(path, "delitos_renta", fuentes=fuentes, compartido=compartido)
+    if geografia is not None and delitos_renta is not None:
+        return geografia, delitos_renta
+    modelo = cargar_modelo_delitos(path)
+    df_rentas = cargar_rentas(path, ficheros_rentas(path))
+    geografia = construir_geografia(df_rentas, modelo)
+    delitos_renta = construir_delitos_renta(geografia, modelo, df_rentas)
+    try:
+        guardar_dataset(path, "geografia", geografia, fuentes=fuentes)
+        guardar_dataset(path, "delitos_renta", delitos_renta, fuentes=fuentes)
+        return (cargar_dataset(path, "geografia", compartido=compartido),
+                cargar_dataset(path, "delitos_renta", compartido=compartido))
+    except OSError:
+        return tipar(geografia), tipar(delitos_renta)
+
+
+def construir_almacen(path, df_long=None):
+    """ Paso de "build": compila los excels (o los dataframes recién obtenidos del scraping) en el almacén parquet."""
+    if df_long is None and os.path.exists(os.path.join(path, "datos_criminalidad_espana_LONG.xlsx")):
+        df_long = pd.read_excel(os.path.join(path, "datos_criminalidad_espana_LONG.xlsx"))
+
+    if df_long is not None:
+        guardar_dataset(path, "criminalidad", modelo_largo(df_long))
+
+    lista_excels = ficheros_rentas(path)
+    df_rentas = preparar_rentas(lista_excels)
+    if df_rentas is not None:
+        guardar_dataset(path, "renta", df_rentas, fuentes=firma_ficheros(lista_excels))
+        completar_unidades_renta(path, df_rentas)
+
+    if leer_manifest(path)["datasets"].keys() >= {"renta", "criminalidad"}:
+        cargar_delitos_renta(path)
+
+    return leer_manifest(path)
+
+
+def actualizar_almacen(path):
+    """ Para quien lee los parquet del almacén sin pasar por cargar_dataset (las consultas de consultas_sql.py):
+        regenera con las funciones de carga los datasets que faltan o no están al día con sus fuentes, sin leer los
+        que lo están. Devuelve la firma de los parquet del almacén, que cambia cada vez que se reescribe alguno."""
+    fichero_long = os.path.join(path, "datos_criminalidad_espana_LONG.xlsx")
+    if not dataset_al_dia(path, "criminalidad") and ("criminalidad" in leer_manifest(path)["datasets"] or os.path.exists(fichero_long)):
+        cargar_modelo_delitos(path)
+
+    lista_excels = ficheros_rentas(path)
+    if lista_excels and not dataset_al_dia(path, "renta", firma_ficheros(lista_excels)):
+        cargar_rentas(path, lista_excels)
+
+    if dataset_al_dia(path, "renta") and dataset_al_dia(path, "criminalidad"):
+        fuentes = fuentes_delitos_renta(path)
+        if not (dataset_al_dia(path, "geografia", fuentes) and dataset_al_dia(path, "delitos_renta", fuentes)):
+            cargar_delitos_renta(path)
+
+    return firma_ficheros([os.path.join(ruta_almacen(path), fichero) for fichero in DATASETS.values()])
+
+
+if __name__ == "__main__":
+    manifest = construir_almacen(os.path.join(os.getcwd(), "data"))
+    for nombre, info in manifest["datasets"].items():
+        print(f"{nombre}: {info['filas']} filas -> {info['fichero']}")
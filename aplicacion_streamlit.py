@@ -1,11 +1,15 @@
 # app.py
 import os
+import threading
 import pandas as pd
 import streamlit as st
-import plotly.express as px
-import folium
-from streamlit_folium import st_folium
-import geopandas as gpd
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+import almacen_datos
+
+# plotly, folium y la pila geográfica (geopandas, shapely) tardan segundos en importarse. No se importan aquí sino
+# en las vistas y funciones que los usan, así el arranque y la primera vista no los esperan (ver benchmark.py arranque).
+# A partir de la primera vez, el import solo consulta sys.modules
 
 # =====================================================
 # CONFIGURACIÓN STREAMLIT
@@ -18,131 +22,213 @@ path = os.getcwd()
 path = path + "/data/"
 
 # =====================================================
-# LISTA DE EXCELS DE RENTAS
+# FUNCIÓN DE CARGA DE EXCELS DE RENTAS
 # =====================================================
-EXCEL_FILES = [
-    f"{path}melilla_datos_rentas.xlsx",
-    f"{path}valencia_valència_datos_rentas.xlsx",
-    f"{path}almería_datos_rentas.xlsx",
-
-    f"{path}albacete_datos_rentas.xlsx",
-    f"{path}alicante_alacant_datos_rentas.xlsx",
-    f"{path}araba_álava_datos_rentas.xlsx",
-    f"{path}asturias_datos_rentas.xlsx",
-    f"{path}avila_datos_rentas.xlsx",
-    f"{path}badajoz_datos_rentas.xlsx",
-
-    f"{path}balears illes_datos_rentas.xlsx",
-    f"{path}barcelona_datos_rentas.xlsx",
-    f"{path}bizkaia_datos_rentas.xlsx",
-    f"{path}cáceres_datos_rentas.xlsx",
-    f"{path}cádiz_datos_rentas.xlsx",
-    f"{path}cantabria_datos_rentas.xlsx",
-    f"{path}badajoz_datos_rentas.xlsx",
-    f"{path}castellón_castelló_datos_rentas.xlsx",
-    f"{path}ceuta_datos_rentas.xlsx",
-    f"{path}ciudad real_datos_rentas.xlsx",
-    
-    f"{path}córdoba_datos_rentas.xlsx",
-    f"{path}coruña a_datos_rentas.xlsx",
-    f"{path}cuenca_datos_rentas.xlsx",
-    f"{path}gipuzkoa_datos_rentas.xlsx",
-
-    f"{path}girona_datos_rentas.xlsx",
-    f"{path}granada_datos_rentas.xlsx",
-    f"{path}guadalajara_datos_rentas.xlsx",
-    f"{path}huelva_datos_rentas.xlsx",
-    f"{path}huesca_datos_rentas.xlsx",
-    f"{path}jaén_datos_rentas.xlsx",
-    f"{path}león_datos_rentas.xlsx",
-    f"{path}lleida_datos_rentas.xlsx",
-    f"{path}lugo_datos_rentas.xlsx",
-    f"{path}madrid_datos_rentas.xlsx",
-
-    f"{path}málaga_datos_rentas.xlsx",
-    f"{path}murcia_datos_rentas.xlsx",
-    f"{path}navarra_datos_rentas.xlsx",
-    f"{path}ourense_datos_rentas.xlsx",
-    f"{path}palencia_datos_rentas.xlsx",
-    f"{path}palmas las_datos_rentas.xlsx",
-    f"{path}pontevedra_datos_rentas.xlsx",
-    f"{path}rioja la_datos_rentas.xlsx",
-    f"{path}salamanca_datos_rentas.xlsx",
-    f"{path}santa cruz de tenerife_datos_rentas.xlsx",
-    f"{path}segovia_datos_rentas.xlsx",
-    f"{path}sevilla_datos_rentas.xlsx",
-
-    f"{path}tarragona_datos_rentas.xlsx",
-    f"{path}teruel_datos_rentas.xlsx",
-    f"{path}toledo_datos_rentas.xlsx",
-    f"{path}valladolid_datos_rentas.xlsx",
-    f"{path}zamora_datos_rentas.xlsx",
-    f"{path}zaragoza_datos_rentas.xlsx"
-]
+# Los datos se leen del almacén (ver almacen_datos.py). Los excels solo se vuelven a leer si alguno ha cambiado.
+# Son todos los *_datos_rentas.xlsx de la carpeta (almacen_datos.ficheros_rentas), la misma lista con la que compilan
+# la renta el scraping y el paso de build: con otra, cada uno reescribiría el dataset del otro.
+# La firma se pasa como argumento para que la caché se invalide si cambia algún excel.
+# st.cache_resource y la copia Arrow mapeada en memoria: todas las sesiones (y procesos) comparten el mismo dataframe
+# de solo lectura. Las vistas solo toman las columnas y filas que necesitan
+@st.cache_resource
+def cargar_excels(firma):
+    df_total = almacen_datos.cargar_rentas(path, almacen_datos.ficheros_rentas(path), compartido=True)
+
+    if df_total is None:
+        st.error("❌ No se ha cargado ningún fichero Excel")
+        st.stop()
+
+    # Sin dropna: las filas sin código INE ya no llegan al almacén y filtrar aquí copiaría el dataframe mapeado
+    return df_total
+
+# Estadísticas por comunidad y rankings de cada métrica de renta (ver almacen_datos.construir_agregados_renta)
+@st.cache_resource
+def cargar_agregados_renta(firma):
+    return almacen_datos.construir_agregados_renta(cargar_excels(firma))
+
+# Renta por distritos y secciones censales (ver almacen_datos.hijos_renta): el índice de padres se lee una vez
+# y los hijos de cada nodo solo cuando se abre. La app solo lee las particiones: las escriben el scraping
+# (obtener_datos_ine.py) y el paso de build (python almacen_datos.py), nunca una sesión
+# La firma de los excels solo invalida la caché cuando el scraping los vuelve a escribir
+@st.cache_resource
+def cargar_indice_unidades_renta(firma):
+    return almacen_datos.indice_unidades_renta(path)
+
+@st.cache_resource(max_entries=256)
+def cargar_hijos_renta(codigo_padre):
+    return almacen_datos.hijos_renta(path, codigo_padre)
 
 # =====================================================
-# MAPEOS DE CÓDIGOS A NOMBRE
+# FUNCIÓN DE CARGA DE DATOS DE DELITOS
 # =====================================================
-codigo_a_comunidad = {
-    "01": "Araba/Álava", "02": "Albacete", "03": "Alicante/Alacant", "04": "Almería", "05": "Ávila",
-    "06": "Badajoz", "07": "Balears, Illes", "08": "Barcelona", "09": "Burgos", "10": "Cáceres",
-    "11": "Cádiz", "12": "Castellón/Castelló", "13": "Ciudad Real", "14": "Córdoba", "15": "Coruña, A",
-    "16": "Cuenca", "17": "Girona", "18": "Granada", "19": "Guadalajara", "20": "Gipuzkoa",
-    "21": "Huelva", "22": "Huesca", "23": "Jaén", "24": "León", "25": "Lleida", "26": "Rioja, La",
-    "27": "Lugo", "28": "Madrid", "29": "Málaga", "30": "Murcia", "31": "Navarra", "32": "Ourense",
-    "33": "Asturias", "34": "Palencia", "35": "Palmas, Las", "36": "Pontevedra", "37": "Salamanca",
-    "38": "Santa Cruz de Tenerife", "39": "Cantabria", "40": "Segovia", "41": "Sevilla", "42": "Soria",
-    "43": "Tarragona", "44": "Teruel", "45": "Toledo", "46": "Valencia/València", "47": "Valladolid",
-    "48": "Bizkaia", "49": "Zamora", "50": "Zaragoza", "51": "Ceuta", "52": "Melilla"
-}
+# st.cache_resource en vez de st.cache_data: todas las vistas (tabla, histograma, gráfico por región y mapa)
+# comparten el mismo dataframe en memoria sin copiarlo en cada recarga. Ninguna vista lo modifica.
+# Los datos están en formato largo (una fila por región, delito, año y trimestre)
+@st.cache_resource
+def cargar_modelo_delitos():
+    return almacen_datos.cargar_modelo_delitos(path, compartido=True)
+
+# Vista ancha de un año frente al anterior. Solo se calcula para los años que se consultan
+@st.cache_resource
+def cargar_datos_delitos(anio):
+    return almacen_datos.vista_ancha(cargar_modelo_delitos(), anio)
+
+# Posiciones de las filas de cada región, tipo de delito y nivel geográfico, calculadas una sola vez por año
+@st.cache_resource
+def cargar_indice_delitos(anio):
+    return almacen_datos.construir_indice_delitos(cargar_datos_delitos(anio))
+
+# Orden de las filas de la vista ancha por una columna, para la tabla paginada. Una vez por año, columna y sentido
+@st.cache_resource
+def cargar_orden_delitos(anio, columna, descendente):
+    return almacen_datos.orden_tabla(cargar_datos_delitos(anio), columna, descendente)
+
+# Cruce de criminalidad y renta por municipio (por código INE, ver almacen_datos.cargar_delitos_renta)
+# y posiciones de sus filas por tipo de delito y año
+@st.cache_resource
+def cargar_delitos_renta():
+    _, delitos_renta = almacen_datos.cargar_delitos_renta(path, compartido=True)
+    return delitos_renta, almacen_datos.posiciones_por_grupo({"Tipo Delito": delitos_renta["Tipo Delito"], "Año": delitos_renta["Año"]})
 
 # =====================================================
-# FUNCIÓN DE CARGA DE EXCELS DE RENTAS
+# MOTOR DE CONSULTAS
 # =====================================================
-def cargar_excels(lista_excels):
-    dfs = []
-
-    for fichero in lista_excels:
-        if not os.path.exists(fichero):
-            st.warning(f"⚠️ No se encuentra el fichero: {fichero}")
-            continue
-        df = pd.read_excel(fichero)
-        df["fichero_origen"] = fichero
-        dfs.append(df)
-
-    if not dfs:
-        st.error("❌ No se ha cargado ningún fichero Excel")
+# Se elige con la variable de entorno MOTOR_CONSULTAS (p. ej. MOTOR_CONSULTAS=duckdb streamlit run aplicacion_streamlit.py).
+# "pandas" (por defecto): las vistas filtran los dataframes en memoria con los índices precalculados (lo más rápido con
+# los datos actuales).
+# "duckdb": los años, las opciones de los filtros, la tabla, el histograma, el gráfico por región, los datos del mapa y
+# la renta son consultas SQL sobre los parquet del almacén (ver consultas_sql.py) y no se carga el modelo de criminalidad
+# ni la renta en memoria. Si DuckDB no está instalado, pandas
+MOTOR_CONSULTAS = os.environ.get("MOTOR_CONSULTAS", "pandas").strip().lower()
+if MOTOR_CONSULTAS not in ("pandas", "duckdb"):
+    st.sidebar.warning(f"⚠️ Motor de consultas desconocido: {MOTOR_CONSULTAS}. Se usa pandas")
+if MOTOR_CONSULTAS == "duckdb":
+    import consultas_sql
+    if consultas_sql.duckdb is None:
+        st.sidebar.warning("⚠️ DuckDB no está instalado (pip install duckdb). Se usa pandas")
+USAR_DUCKDB = MOTOR_CONSULTAS == "duckdb" and consultas_sql.duckdb is not None
+
+# DuckDB lee los parquet directamente, sin las comprobaciones de almacen_datos.cargar_dataset: en cada recarga se deja
+# el almacén al día con sus fuentes (almacen_datos.actualizar_almacen) y su firma forma parte de la clave de la caché,
+# así que si se reescribe algún parquet se abre una conexión nueva con las vistas sobre los ficheros nuevos
+if USAR_DUCKDB:
+    try:
+        firma_almacen = almacen_datos.actualizar_almacen(path)
+    except OSError as e:
+        st.error(f"❌ No se ha podido preparar el almacén de datos: {e}")
         st.stop()
 
-    df_total = pd.concat(dfs, ignore_index=True)
-    df_total["codigo_postal"] = df_total["Municipios"].astype(str).str.extract(r"^(\d{5})")
-    df_total["comunidad_autonoma"] = df_total["codigo_postal"].str[:2].map(codigo_a_comunidad)
+@st.cache_resource
+def abrir_conexion_sql(firma):
+    return consultas_sql.conectar(path)
 
-    columnas_renta = [col for col in df_total.columns if "Renta" in col or "Media" in col or "Mediana" in col]
-    for col in columnas_renta:
-        df_total[col] = pd.to_numeric(df_total[col], errors="coerce")
+def conectar_sql():
+    return abrir_conexion_sql(firma_almacen)
 
-    return df_total
+# Años del almacén (SELECT DISTINCT "Año") y opciones de los filtros de un año, sin cargar el modelo
+@st.cache_resource
+def cargar_anios_sql(firma):
+    return consultas_sql.anios(conectar_sql())
+
+@st.cache_resource
+def cargar_opciones_sql(firma, anio):
+    return consultas_sql.opciones_delitos(conectar_sql(), anio)
 
 # =====================================================
-# FUNCIÓN DE CARGA DE DATOS DE DELITOS
+# CAPAS GEOGRÁFICAS DEL MAPA
+# =====================================================
+# Se leen y simplifican una sola vez por proceso y se comparten entre todas las sesiones
+@st.cache_resource
+def cargar_capas_mapa():
+    import capas_geograficas
+    return capas_geograficas.cargar_capas(path)
+
+# Dimensión geografia del almacén: un municipio INE por fila con su provincia y su nombre en criminalidad
+@st.cache_resource
+def cargar_geografia():
+    geografia, _ = almacen_datos.cargar_delitos_renta(path, compartido=True)
+    return geografia
+
+# Municipios con datos de criminalidad (None si no está el geojson de municipios)
+@st.cache_resource
+def cargar_municipios_mapa():
+    import capas_geograficas
+    return capas_geograficas.cargar_municipios(path, cargar_geografia())
+
+# =====================================================
+# CACHÉ DE CAPAS DEL MAPA
 # =====================================================
-@st.cache_data
-def cargar_datos_delitos():
-    df = pd.read_excel(path + "datos_criminalidad_espana_WIDE.xlsx")
-    columnas_num = ['Abril-Junio2023', 'Enero-Marzo2023', 'Julio-Septiembre2023', 'Octubre-Diciembre2023',
-                    'Abril-Junio2022', 'Enero-Marzo2022', 'Julio-Septiembre2022', 'Octubre-Diciembre2022',
-                    'Total_2023', 'Total_2022', 'Variación_total_2023_2022']
-    for col in columnas_num:
-        df[col] = pd.to_numeric(df[col].astype(str).str.replace(',', '.'), errors='coerce')
-    return df
+TIPOS_DELITO_MAPA = [
+    "1. Homicidios dolosos y asesinatos consumados",
+    "2. Homicidios dolosos y asesinatos en grado tentativa",
+    "3. Delitos graves y menos graves de lesiones y riña tumultuaria",
+    "4. Secuestro",
+    "5. Delitos contra la libertad sexual",
+    "5.1.-Agresión sexual con penetración",
+    "5.2.-Resto de delitos contra la libertad sexual",
+    "6. Robos con violencia e intimidación",
+    "7. Robos con fuerza en domicilios, establecimientos y otras instalaciones",
+    "7.1.-Robos con fuerza en domicilios",
+    "8. Hurtos",
+    "9. Sustracciones de vehículos",
+    "10. Tráfico de drogas",
+    "11. Resto de criminalidad convencional",
+    "12.-Estafas informáticas",
+    "13.-Otros ciberdelitos",
+    "I. CRIMINALIDAD CONVENCIONAL",
+    "II. CIBERCRIMINALIDAD (infracciones penales cometidas en/por medio ciber)",
+    "III. TOTAL INFRACCIONES PENALES"
+]
+
+TRIMESTRES_MAPA = ["Enero-Marzo", "Abril-Junio", "Julio-Septiembre", "Octubre-Diciembre", "Total"]
+
+# Al abrir el mapa por primera vez se precalculan en segundo plano las capas a zoom nacional de todos los delitos y trimestres
+CALENTAR_CACHE_MAPA = True
+
+# Datos del mapa y capa ya cruzada para cada combinación de año, nivel, delito, trimestre y detalle de geometría.
+# Compartida entre sesiones; el resultado no se modifica. max_entries limita la memoria (LRU)
+@st.cache_resource(max_entries=1024)
+def preparar_capa_mapa(anio, nivel, tipo_delito, trimestre, detalle):
+    import capas_geograficas
+    if USAR_DUCKDB:
+        df_filas = consultas_sql.vista_delitos(conectar_sql(), anio, trimestre, nivel=nivel, tipo_delito=tipo_delito)
+    else:
+        df_filas = almacen_datos.filas_indice(cargar_datos_delitos(anio), cargar_indice_delitos(anio), "Nivel", (nivel, tipo_delito))
+    df_filtrado = capas_geograficas.datos_mapa(df_filas, nivel, tipo_delito, *almacen_datos.columnas_vista(trimestre, anio),
+                                               geografia=cargar_geografia() if nivel == "Municipio" else None)
+    if nivel == "Municipio":
+        if detalle >= capas_geograficas.zoom_detalle(capas_geograficas.ZOOM_POLIGONOS_MUNICIPIOS):
+            # Polígonos: solo se cruzan los de la vista (ver "Municipios de la vista" en el mapa)
+            return df_filtrado, None
+        gdf = capas_geograficas.capa_municipios(cargar_municipios_mapa(), detalle)
+    else:
+        gdf = capas_geograficas.capa_para_zoom(cargar_capas_mapa(), nivel, detalle)
+    return df_filtrado, capas_geograficas.cruzar_capa(gdf, df_filtrado, nivel)
+
+# Un solo hilo por proceso (y año) que rellena la caché mientras el usuario empieza a usar la aplicación
+@st.cache_resource
+def calentar_cache_mapa(anio):
+    import capas_geograficas
+
+    def calentar():
+        niveles = ["Comunidad", "Provincia"] + (["Municipio"] if cargar_municipios_mapa() is not None else [])
+        for nivel in niveles:
+            detalle = capas_geograficas.detalle_capa(nivel, 6)
+            for tipo_delito in TIPOS_DELITO_MAPA:
+                for trimestre in TRIMESTRES_MAPA:
+                    preparar_capa_mapa(anio, nivel, tipo_delito, trimestre, detalle)
+    hilo = threading.Thread(target=calentar, name="calentar_cache_mapa", daemon=True)
+    add_script_run_ctx(hilo, get_script_run_ctx())
+    hilo.start()
+    return hilo
 
 # =====================================================
 # CARGA DE DATOS
 # =====================================================
-df_rentas = cargar_excels(EXCEL_FILES)
-df_rentas = df_rentas.dropna(subset=["codigo_postal"])
-df_delitos = cargar_datos_delitos()
+# Cada vista carga solo lo que usa: la renta en "Rentas", la vista ancha de criminalidad en las vistas 1 a 3
+# y las capas del mapa en "Mapa de España"
+firma_rentas = almacen_datos.firma_ficheros(almacen_datos.ficheros_rentas(path))
+VISTAS_TABLA_DELITOS = ("Tabla interactiva", "Histograma por tipo de delito", "Gráfico por región")
 
 # =====================================================
 # Sidebar: Filtros y opciones DELITOS
@@ -150,38 +236,108 @@ df_delitos = cargar_datos_delitos()
 st.sidebar.header("Filtros y Opciones")
 opcion = st.sidebar.radio(
     "Selecciona una opción",
-    ("Tabla interactiva", "Histograma por tipo de delito", "Gráfico por región", "Mapa de España", "Rentas")
+    ("Tabla interactiva", "Histograma por tipo de delito", "Gráfico por región", "Mapa de España", "Delitos y renta", "Rentas")
 )
 
-comunidad_opciones = df_delitos['Comunidad'].dropna().unique()
-provincia_opciones = df_delitos['Provincia'].dropna().unique()
-municipio_opciones = df_delitos['Municipio'].dropna().unique()
-tipo_delito_opciones = df_delitos['Tipo Delito'].unique()
-años = ["2022", "2023", "Variación"]
+# Con DuckDB, la vista necesita su dataset en el almacén (si no, la consulta fallaría porque no existe la tabla)
+if USAR_DUCKDB:
+    dataset_vista = "renta" if opcion == "Rentas" else "criminalidad"
+    if not almacen_datos.dataset_al_dia(path, dataset_vista):
+        st.error(f"❌ El almacén no tiene el dataset {dataset_vista}: no hay datos de origen con los que generarlo en {path}")
+        st.stop()
+
+# Año de los datos de criminalidad (se compara con el año anterior).
+# Si el almacén no tiene dos años seguidos (p. ej. solo uno) las vistas de criminalidad no se pueden mostrar
+if opcion != "Rentas":
+    anios_almacen = cargar_anios_sql(firma_almacen) if USAR_DUCKDB else almacen_datos.anios_modelo(cargar_modelo_delitos())
+    anios_delitos = almacen_datos.anios_con_anterior(anios_almacen)
+    if not anios_delitos:
+        st.error(almacen_datos.mensaje_sin_anios_comparables(anios_almacen))
+        st.stop()
+    anio = st.sidebar.selectbox("Año", anios_delitos[::-1])
+    anio_anterior = anio - 1
+
+if opcion in VISTAS_TABLA_DELITOS:
+    if USAR_DUCKDB:
+        opciones_delitos = cargar_opciones_sql(firma_almacen, anio)
+    else:
+        df_delitos = cargar_datos_delitos(anio)
+        indice_delitos = cargar_indice_delitos(anio)
+        opciones_delitos = {col: list(indice_delitos[col]) for col in almacen_datos.NIVELES + ["Tipo Delito"]}
+
+    comunidad_opciones = opciones_delitos['Comunidad']
+    provincia_opciones = opciones_delitos['Provincia']
+    municipio_opciones = opciones_delitos['Municipio']
+    tipo_delito_opciones = opciones_delitos['Tipo Delito']
 
 # =====================================================
 # 1. Tabla interactiva DELITOS
 # =====================================================
 if opcion == "Tabla interactiva":
     st.header("1. Tabla interactiva de delitos")
-    st.dataframe(df_delitos)
+    # Filtro, orden y columnas se aplican en el servidor: al navegador solo se envía la página visible
+    col_nivel, col_region, col_tipos = st.columns(3)
+    nivel_tabla = col_nivel.selectbox("Nivel", ["Todos"] + almacen_datos.NIVELES)
+    regiones_tabla = {"Comunidad": comunidad_opciones, "Provincia": provincia_opciones, "Municipio": municipio_opciones}
+    region_tabla = col_region.selectbox("Región", ["Todas"] + regiones_tabla.get(nivel_tabla, []), disabled=nivel_tabla == "Todos")
+    tipos_tabla = col_tipos.multiselect("Tipos de delito", tipo_delito_opciones)
+
+    columnas_defecto = almacen_datos.CLAVES_DELITO + [f"Total_{anio}", f"Total_{anio_anterior}", f"Variación_total_{anio}_{anio_anterior}"]
+    columnas_tabla = st.multiselect("Columnas", almacen_datos.columnas_ancha(anio), default=columnas_defecto) or columnas_defecto
+
+    col_orden, col_sentido, col_tamano = st.columns(3)
+    total_anio = f"Total_{anio}"
+    orden_por = col_orden.selectbox("Ordenar por", columnas_tabla,
+                                    index=columnas_tabla.index(total_anio) if total_anio in columnas_tabla else 0)
+    descendente = col_sentido.checkbox("Descendente", value=True)
+    filas_por_pagina = col_tamano.selectbox("Filas por página", [25, 50, 100, 500], index=1)
+
+    filtros_tabla = {
+        "nivel": None if nivel_tabla == "Todos" else nivel_tabla,
+        "region": None if nivel_tabla == "Todos" or region_tabla == "Todas" else region_tabla,
+        "tipos_delito": tipos_tabla,
+    }
+    if USAR_DUCKDB:
+        total_filas = consultas_sql.filas_delitos(conectar_sql(), anio, **filtros_tabla)
+    else:
+        posiciones_tabla = almacen_datos.posiciones_filtro(indice_delitos, **filtros_tabla)
+        total_filas = len(df_delitos) if posiciones_tabla is None else len(posiciones_tabla)
+    paginas = max(1, -(-total_filas // filas_por_pagina))
+    pagina = st.number_input(f"Página (de {paginas})", min_value=1, max_value=paginas, value=1, step=1)
+
+    if USAR_DUCKDB:
+        df_pagina = consultas_sql.pagina_delitos(conectar_sql(), anio, columnas_tabla, orden_por, descendente,
+                                                 pagina - 1, filas_por_pagina, **filtros_tabla)
+    else:
+        df_pagina, total_filas = almacen_datos.pagina_tabla(
+            df_delitos, cargar_orden_delitos(anio, orden_por, descendente), posiciones_tabla, columnas_tabla,
+            pagina - 1, filas_por_pagina,
+        )
+    inicio = (pagina - 1) * filas_por_pagina
+    st.caption(f"Filas {min(inicio + 1, total_filas)}-{inicio + len(df_pagina)} de {total_filas}")
+    st.dataframe(df_pagina, hide_index=True, use_container_width=True)
 
 # =====================================================
 # 2. Histograma por tipo de delito
 # =====================================================
 elif opcion == "Histograma por tipo de delito":
+    import plotly.express as px
+
     st.header("2. Histograma por tipo de delito")
     tipo_delito_sel = st.selectbox("Selecciona el tipo de delito:", tipo_delito_opciones)
-    df_delito = df_delitos[df_delitos['Tipo Delito'] == tipo_delito_sel]
+    if USAR_DUCKDB:
+        df_delito = consultas_sql.vista_delitos(conectar_sql(), anio, tipo_delito=tipo_delito_sel)
+    else:
+        df_delito = almacen_datos.filas_indice(df_delitos, indice_delitos, 'Tipo Delito', tipo_delito_sel)
 
     hist_data = pd.DataFrame({
-        "Año": ["2023", "2022"],
-        "Total": [df_delito['Total_2023'].values[0], df_delito['Total_2022'].values[0]]
+        "Año": [str(anio), str(anio_anterior)],
+        "Total": [df_delito[f'Total_{anio}'].values[0], df_delito[f'Total_{anio_anterior}'].values[0]]
     })
 
     fig = px.bar(hist_data, x="Año", y="Total", text="Total",
                  labels={"Total": "Número de delitos"}, color="Año",
-                 color_discrete_map={"2023": "crimson", "2022": "royalblue"})
+                 color_discrete_map={str(anio): "crimson", str(anio_anterior): "royalblue"})
     fig.update_layout(title=f"Comparativa de delitos: {tipo_delito_sel}")
     st.plotly_chart(fig, use_container_width=True)
 
@@ -189,22 +345,25 @@ elif opcion == "Histograma por tipo de delito":
 # 3. Gráfico por región
 # =====================================================
 elif opcion == "Gráfico por región":
+    import plotly.express as px
+
     st.header("3. Delitos por región")
     region_tipo = st.selectbox("Selecciona el nivel de región:", ["Comunidad", "Provincia", "Municipio"])
     
     if region_tipo == "Comunidad":
         region_sel = st.selectbox("Selecciona la comunidad:", comunidad_opciones)
-        df_region = df_delitos[df_delitos['Comunidad'] == region_sel]
     elif region_tipo == "Provincia":
         region_sel = st.selectbox("Selecciona la provincia:", provincia_opciones)
-        df_region = df_delitos[df_delitos['Provincia'] == region_sel]
     else:
         region_sel = st.selectbox("Selecciona el municipio:", municipio_opciones)
-        df_region = df_delitos[df_delitos['Municipio'] == region_sel]
+    if USAR_DUCKDB:
+        df_region = consultas_sql.vista_delitos(conectar_sql(), anio, columna_region=region_tipo, region=region_sel)
+    else:
+        df_region = almacen_datos.filas_indice(df_delitos, indice_delitos, region_tipo, region_sel)
 
-    fig = px.bar(df_region, x="Tipo Delito", y="Total_2023",
-                 hover_data=["Total_2022", "Variación_total_2023_2022"],
-                 labels={"Total_2023": "Delitos 2023"},
+    fig = px.bar(df_region, x="Tipo Delito", y=f"Total_{anio}",
+                 hover_data=[f"Total_{anio_anterior}", f"Variación_total_{anio}_{anio_anterior}"],
+                 labels={f"Total_{anio}": f"Delitos {anio}"},
                  title=f"Delitos en {region_sel} ({region_tipo})")
     fig.update_layout(xaxis_tickangle=-45)
     st.plotly_chart(fig, use_container_width=True)
@@ -213,83 +372,48 @@ elif opcion == "Gráfico por región":
 # 4. Mapa interactivo de España
 # =====================================================
 elif opcion == "Mapa de España":
+    import folium
+    import plotly.express as px
+    from streamlit_folium import st_folium
+
+    import capas_geograficas
+
     st.sidebar.header("Filtros del análisis de criminalidad")
 
-    niveles_agregacion = ["Comunidad", "Provincia"]
+    municipios_mapa = cargar_municipios_mapa()
+    niveles_agregacion = ["Comunidad", "Provincia"] + (["Municipio"] if municipios_mapa is not None else [])
     nivel_agregacion = st.sidebar.selectbox("Nivel de agregación", niveles_agregacion)
 
-    tipos_delito = [
-        "1. Homicidios dolosos y asesinatos consumados",
-        "2. Homicidios dolosos y asesinatos en grado tentativa",
-        "3. Delitos graves y menos graves de lesiones y riña tumultuaria",
-        "4. Secuestro",
-        "5. Delitos contra la libertad sexual",
-        "5.1.-Agresión sexual con penetración",
-        "5.2.-Resto de delitos contra la libertad sexual",
-        "6. Robos con violencia e intimidación",
-        "7. Robos con fuerza en domicilios, establecimientos y otras instalaciones",
-        "7.1.-Robos con fuerza en domicilios",
-        "8. Hurtos",
-        "9. Sustracciones de vehículos",
-        "10. Tráfico de drogas",
-        "11. Resto de criminalidad convencional",
-        "12.-Estafas informáticas",
-        "13.-Otros ciberdelitos",
-        "I. CRIMINALIDAD CONVENCIONAL",
-        "II. CIBERCRIMINALIDAD (infracciones penales cometidas en/por medio ciber)",
-        "III. TOTAL INFRACCIONES PENALES"
-    ]
-    tipo_delito = st.sidebar.selectbox("Tipo de delito", tipos_delito)
-
-    trimestres = ["Enero-Marzo", "Abril-Junio", "Julio-Septiembre", "Octubre-Diciembre", "Total"]
-    trimestre = st.sidebar.selectbox("Trimestre", trimestres)
+    tipo_delito = st.sidebar.selectbox("Tipo de delito", TIPOS_DELITO_MAPA)
+
+    trimestre = st.sidebar.selectbox("Trimestre", TRIMESTRES_MAPA)
 
     # -------------------------
-    # 1. Cargar datos
+    # 1. Datos y capa de la selección
     # -------------------------
-
-    path_data = fr"{path}datos_criminalidad_espana_WIDE.xlsx"
-    df = pd.read_excel(path_data)
+    # Salen de la caché de capas: cambiar de delito o trimestre es una consulta a un diccionario
+    zoom_mapa = st.session_state.get("zoom_mapa", 6)
+    centro_mapa = st.session_state.get("centro_mapa", [40, -3.5])
+    detalle = capas_geograficas.detalle_capa(nivel_agregacion, zoom_mapa)
+    df_filtrado, gdf_merged = preparar_capa_mapa(anio, nivel_agregacion, tipo_delito, trimestre, detalle)
+    # Después de la selección actual, el resto de combinaciones en segundo plano
+    if CALENTAR_CACHE_MAPA:
+        calentar_cache_mapa(anio)
+    nombre_columna_geojson = capas_geograficas.COLUMNA_NOMBRE
 
     # -------------------------
-    # 2. Filtrar por nivel de agregación
+    # 2. Municipios de la vista
     # -------------------------
-    normalizacion = {
-        "Comunidad": { 'Castilla y León': 'Castilla-Leon', 'Andalucía': 'Andalucia', 'País Vasco': 'Pais Vasco', 'Aragón': 'Aragon', 'Illes Balears': 'Baleares', 'Comunidad Valenciana': 'Valencia', 'Comunidad de Madrid': 'Madrid', 'Ciudad Autónoma de Ceuta': 'Ceuta', 'Ciudad Autónoma de Melilla': 'Melilla', 'Castilla-La Mancha': 'Castilla-La Mancha', 'La Rioja': 'La Rioja', 'Galicia': 'Galicia', 'Extremadura': 'Extremadura', 'Principado de Asturias': 'Asturias', 'Canarias': 'Canarias', 'Cantabria': 'Cantabria', 'Cataluña': 'Cataluña', 'Comunidad Foral de Navarra': 'Navarra', 'Región de Murcia': 'Murcia' },
-        "Provincia": { 'Baleares': 'Illes Balears', 'Asturias': 'Asturias', 'A Coruña': 'A Coruña', 'Girona': 'Girona', 'Las Palmas': 'Las Palmas', 'Pontevedra': 'Pontevedra', 'Santa Cruz de Tenerife': 'Santa Cruz De Tenerife', 'Cantabria': 'Cantabria', 'Málaga': 'Málaga', 'Almería': 'Almería', 'Murcia': 'Murcia', 'Albacete': 'Albacete', 'Ávila': 'Ávila', 'Álava': 'Araba/Álava', 'Badajoz': 'Badajoz', 'Alicante':'Alacant/Alicante', 'Ourense': 'Ourense', 'Barcelona': 'Barcelona', 'Burgos': 'Burgos', 'Cáceres': 'Cáceres', 'Cádiz': 'Cádiz', 'Castellón': 'Castelló/Castellón', 'Ciudad Real': 'Ciudad Real', 'Jaén': 'Jaén', 'Córdoba': 'Córdoba', 'Cuenca': 'Cuenca', 'Granada': 'Granada', 'Guadalajara': 'Guadalajara', 'Gipuzkoa': 'Gipuzkoa/Guipúzcoa', 'Huelva': 'Huelva', 'Huesca': 'Huesca', 'León': 'León', 'Lleida': 'Lleida', 'La Rioja': 'La Rioja', 'Soria': 'Soria', 'Navarra': 'Navarra', 'Ceuta': 'Ceuta', 'Lugo': 'Lugo', 'Madrid': 'Madrid', 'Palencia': 'Palencia', 'Salamanca': 'Salamanca', 'Segovia': 'Segovia', 'Sevilla': 'Sevilla', 'Toledo': 'Toledo', 'Tarragona': 'Tarragona', 'Teruel': 'Teruel', 'Valencia': 'València/Valencia', 'Valladolid': 'Valladolid', 'Bizkaia': 'Bizkaia/Vizcaya', 'Zamora': 'Zamora', 'Zaragoza': 'Zaragoza', 'Melilla': 'Melilla' }
-    }
-
-    if nivel_agregacion == "Comunidad":
-        df_filtrado = df[((df["Provincia"].isna()) | (df["Provincia"] == "")) & ((df["Municipio"].isna()) | (df["Municipio"] == ""))].copy()
-        geojson_path = fr"{path}spain-communities.geojson"
-        df_filtrado["Region_norm"] = df_filtrado["Comunidad"].replace(normalizacion["Comunidad"])
-        merge_key = "Region_norm"
-        nombre_columna_geojson = "name"
-    else:
-        df_filtrado = df[(~df["Provincia"].isna()) & (df["Municipio"].isna())].copy()
-        geojson_path = fr"{path}spain-provinces.geojson"
-        df_filtrado["Region_norm"] = df_filtrado["Provincia"].replace(normalizacion["Provincia"])
-        merge_key = "Region_norm"
-        nombre_columna_geojson = "name"
-
-    df_filtrado = df_filtrado[df_filtrado["Tipo Delito"] == tipo_delito].copy()
-    if trimestre == "Total":
-        col_2023 = "Total_2023"; col_2022 = "Total_2022"; col_var = "Variación_total_2023_2022"
-    else:
-        col_2023 = f"{trimestre}2023"; col_2022 = f"{trimestre}2022"; col_var = f"{trimestre}_VAR_2023_2022"
-
-    df_filtrado["valor_2023"] = df_filtrado[col_2023]
-    df_filtrado["valor_2022"] = df_filtrado[col_2022]
-    df_filtrado["variacion"] = df_filtrado[col_var]
-    df_filtrado["tipo_delito_tooltip"] = tipo_delito
-    df_mapa = df_filtrado[[merge_key, "valor_2023", "valor_2022", "variacion", "tipo_delito_tooltip"]]
-    df_mapa["variacion_pct"] = df_mapa["variacion"].astype(str) + "%"
-
-    gdf = gpd.read_file(geojson_path)
-    gdf = gdf[[col for col in gdf.columns if not pd.api.types.is_datetime64_any_dtype(gdf[col])]]
-    gdf_merged = gdf.merge(df_mapa, left_on=nombre_columna_geojson, right_on=merge_key, how="left")
-
-    m = folium.Map(location=[40, -3.5], zoom_start=6)
+    if nivel_agregacion == "Municipio" and zoom_mapa >= capas_geograficas.ZOOM_POLIGONOS_MUNICIPIOS:
+        # Con zoom, solo los polígonos de la vista actual (con margen)
+        limites_municipios = st.session_state.get("limites_municipios") or capas_geograficas.ampliar_limites(
+            capas_geograficas.limites_aproximados(centro_mapa, zoom_mapa))
+        st.session_state["limites_municipios"] = limites_municipios
+        # La consulta usa el índice espacial precalculado de la capa y solo se cruzan con los datos los polígonos de la vista
+        gdf_vista = capas_geograficas.municipios_en_vista(municipios_mapa, zoom_mapa, limites_municipios)
+        gdf_merged = capas_geograficas.cruzar_capa(gdf_vista, df_filtrado, nivel_agregacion)
+
+    m = folium.Map(location=centro_mapa, zoom_start=zoom_mapa)
     def color_scale(val):
         if pd.isna(val): return "lightgray"
         elif val > 1000: return "#800026"
@@ -297,36 +421,114 @@ elif opcion == "Mapa de España":
         elif val > 100: return "#E31A1C"
         else: return "#FC4E2A"
 
-    folium.GeoJson(
-        gdf_merged,
-        style_function=lambda x: {'fillColor': color_scale(x['properties'].get('valor_2023', 0)),
-                                'color': 'black', 'weight': 0.5},
-        tooltip=folium.features.GeoJsonTooltip(
-            fields=[nombre_columna_geojson, "tipo_delito_tooltip", "valor_2023", "valor_2022", "variacion_pct"],
-            aliases=[f"{nivel_agregacion}:", "Delito:", f"{trimestre} 2023:", f"{trimestre} 2022:", f"{trimestre}_VAR_2023_2022:"],
-            localize=True
-        )
-    ).add_to(m)
+    # En la vista puede no haber ningún municipio con datos (p. ej. en el mar).
+    # Al navegador solo van la geometría y las columnas del tooltip
+    columnas_tooltip = [nombre_columna_geojson, "tipo_delito_tooltip", "valor_actual", "valor_anterior", "variacion_pct"]
+    if not gdf_merged.empty:
+        folium.GeoJson(
+            gdf_merged[columnas_tooltip + ["geometry"]],
+            marker=folium.CircleMarker(radius=5, fill=True, fill_opacity=0.8) if nivel_agregacion == "Municipio" else None,
+            style_function=lambda x: {'fillColor': color_scale(x['properties'].get('valor_actual', 0)),
+                                    'color': 'black', 'weight': 0.5},
+            tooltip=folium.features.GeoJsonTooltip(
+                fields=columnas_tooltip,
+                aliases=[f"{nivel_agregacion}:", "Delito:", f"{trimestre} {anio}:", f"{trimestre} {anio_anterior}:", f"{trimestre}_VAR_{anio}_{anio_anterior}:"],
+                localize=True
+            )
+        ).add_to(m)
 
     st.markdown(f"### Mapa de España - Nivel: {nivel_agregacion}")
-    st_folium(m, width=1200, height=800)
+    salida_mapa = st_folium(m, width=1200, height=800, returned_objects=["zoom", "center", "bounds"])
+
+    # Si al hacer zoom cambia el nivel de detalle necesario, se vuelve a pintar el mapa con la geometría adecuada
+    if salida_mapa and salida_mapa.get("zoom") is not None:
+        nuevo_zoom = salida_mapa["zoom"]
+        if salida_mapa.get("center"):
+            st.session_state["centro_mapa"] = [salida_mapa["center"]["lat"], salida_mapa["center"]["lng"]]
+        st.session_state["zoom_mapa"] = nuevo_zoom
+        # (en Municipio, de 7 a 8 cambia de puntos a polígonos aunque zoom_detalle sea el mismo)
+        if (capas_geograficas.zoom_detalle(nuevo_zoom) != capas_geograficas.zoom_detalle(zoom_mapa)
+                or capas_geograficas.detalle_capa(nivel_agregacion, nuevo_zoom) != detalle):
+            st.session_state["limites_municipios"] = None
+            st.rerun()
+
+        # Municipios: si la vista se sale de la zona cargada, se cargan los de la nueva vista
+        limites = salida_mapa.get("bounds") or {}
+        if (nivel_agregacion == "Municipio" and nuevo_zoom >= capas_geograficas.ZOOM_POLIGONOS_MUNICIPIOS
+                and (limites.get("_southWest") or {}).get("lat") is not None):
+            vista = [[limites["_southWest"]["lat"], limites["_southWest"]["lng"]], [limites["_northEast"]["lat"], limites["_northEast"]["lng"]]]
+            # Sin zona cargada (None) cuenta como que la vista no está dentro
+            limites_cargados = st.session_state.get("limites_municipios")
+            if limites_cargados is None or not capas_geograficas.limites_contienen(limites_cargados, vista):
+                st.session_state["limites_municipios"] = capas_geograficas.ampliar_limites(vista)
+                st.rerun()
+
+    if nivel_agregacion == "Municipio":
+        st.download_button("Descargar municipios de la vista (GeoJSON)", gdf_merged.to_json(),
+                           file_name=f"municipios_{tipo_delito}_{trimestre}_{anio}.geojson", mime="application/geo+json")
 
     st.markdown("### Comparativa por región")
-    fig = px.bar(df_filtrado, x="Region_norm", y="valor_2023",
-                hover_data=["valor_2022", "variacion"],
-                labels={"valor_2023": f"Delitos {trimestre} 2023", "Region_norm": nivel_agregacion},
-                color="valor_2023", color_continuous_scale="Reds",
+    fig = px.bar(df_filtrado, x="Region_norm", y="valor_actual",
+                hover_data=["valor_anterior", "variacion"],
+                labels={"valor_actual": f"Delitos {trimestre} {anio}", "valor_anterior": f"Delitos {trimestre} {anio_anterior}", "Region_norm": nivel_agregacion},
+                color="valor_actual", color_continuous_scale="Reds",
                 title=f"Delitos en {nivel_agregacion} - {tipo_delito}")
     fig.update_layout(xaxis_tickangle=-45)
     st.plotly_chart(fig, use_container_width=True)
 
+# =====================================================
+# 5. Delitos y renta por municipio
+# =====================================================
+elif opcion == "Delitos y renta":
+    import graficos
+
+    st.header("5. Delitos y renta por municipio")
+    delitos_renta, indice_cruce = cargar_delitos_renta()
+
+    col1, col2 = st.columns(2)
+    tipo_cruce = col1.selectbox("Tipo de delito", TIPOS_DELITO_MAPA, index=len(TIPOS_DELITO_MAPA) - 1)
+    metrica_cruce = col2.selectbox("Métrica de renta", almacen_datos.COLUMNAS_RENTA_CRUCE)
+
+    df_cruce = delitos_renta.iloc[indice_cruce.get((tipo_cruce, anio), [])].dropna(subset=[metrica_cruce])
+
+    m1, m2, m3 = st.columns(3)
+    m1.metric("Municipios", len(df_cruce))
+    m2.metric("Correlación de Pearson", f"{df_cruce['delitos'].corr(df_cruce[metrica_cruce]):.2f}")
+    # Spearman: Pearson de los rangos, sin pasar por scipy
+    m3.metric("Correlación de Spearman", f"{df_cruce['delitos'].rank().corr(df_cruce[metrica_cruce].rank()):.2f}")
+    st.caption("Los delitos son el total del año (suma de los trimestres publicados) y no están divididos por población: "
+               "los municipios más grandes tienen más delitos.")
+
+    fig_cruce, _ = graficos.figura_dispersion(
+        df_cruce, x=metrica_cruce, y="delitos", color="comunidad", hover_name="Municipio",
+        titulo=f"{tipo_cruce} ({anio}) frente a {metrica_cruce}"
+    )
+    if st.checkbox("Escala logarítmica de delitos", value=True):
+        fig_cruce.update_yaxes(type="log")
+    st.plotly_chart(fig_cruce, use_container_width=True)
+
+    st.dataframe(
+        df_cruce[["Municipio", "provincia", "comunidad", "delitos", "trimestres", metrica_cruce]].sort_values("delitos", ascending=False),
+        use_container_width=True
+    )
+
 # =====================================================
 # RENTAS
 # =====================================================
 elif opcion == "Rentas":
-    tab1, tab2 = st.tabs([
+    import plotly.express as px
+
+    import graficos
+    import nomenclator
+
+    # Con DuckDB la renta no se carga en memoria: cada gráfico consulta solo lo que pinta
+    if not USAR_DUCKDB:
+        df_rentas = cargar_excels(firma_rentas)
+        agregados_renta = cargar_agregados_renta(firma_rentas)
+    tab1, tab2, tab3 = st.tabs([
         "Exploración interactiva renta",
-        "Agrupación por CP y Comunidad"
+        "Agrupación por CP y Comunidad",
+        "Distritos y secciones censales"
     ])
 
     # TAB 1 — EXPLORACIÓN INTERACTIVA
@@ -335,7 +537,10 @@ elif opcion == "Rentas":
 
         col1, col2, col3 = st.columns(3)
 
-        comunidades = sorted(df_rentas["comunidad_autonoma"].dropna().unique())
+        if USAR_DUCKDB:
+            comunidades = consultas_sql.comunidades_renta(conectar_sql())
+        else:
+            comunidades = sorted(df_rentas["comunidad_autonoma"].dropna().unique())
         comunidad_sel = col1.multiselect(
             "Comunidad autónoma",
             comunidades,
@@ -344,20 +549,7 @@ elif opcion == "Rentas":
 
         metrica = col2.selectbox(
             "Métrica de renta",
-            [
-                "Renta neta media por persona 2023",
-                "Renta neta media por persona 2022",
-                "Renta neta media por hogar 2023",
-                "Renta neta media por hogar 2022",
-                "Media de la renta por unidad de consumo 2023",
-                "Media de la renta por unidad de consumo 2022",
-                "Mediana de la renta por unidad de consumo 2023",
-                "Mediana de la renta por unidad de consumo 2022",
-                "Renta bruta media por persona 2023",
-                "Renta bruta media por persona 2022",
-                "Renta bruta media por hogar 2023",
-                "Renta bruta media por hogar 2022",
-            ]
+            almacen_datos.METRICAS_RENTA
         )
 
         top_n = col3.slider(
@@ -367,14 +559,21 @@ elif opcion == "Rentas":
             value=30
         )
 
-        df_filtro = df_rentas[df_rentas["comunidad_autonoma"].isin(comunidad_sel)].dropna(subset=[metrica])
+        # Estadísticas y ranking salen de los agregados precalculados: no se filtra ni se ordena el dataframe
+        if USAR_DUCKDB:
+            media, mediana, n_municipios = consultas_sql.resumen_renta(conectar_sql(), metrica, comunidad_sel)
+        else:
+            media, mediana, n_municipios = almacen_datos.resumen_renta(df_rentas, agregados_renta, metrica, comunidad_sel)
 
         m1, m2, m3 = st.columns(3)
-        m1.metric("Media", f"{df_filtro[metrica].mean():,.0f} €")
-        m2.metric("Mediana", f"{df_filtro[metrica].median():,.0f} €")
-        m3.metric("Municipios", len(df_filtro))
+        m1.metric("Media", f"{media:,.0f} €")
+        m2.metric("Mediana", f"{mediana:,.0f} €")
+        m3.metric("Municipios", n_municipios)
 
-        ranking = df_filtro.sort_values(metrica, ascending=False).head(top_n)
+        if USAR_DUCKDB:
+            ranking = consultas_sql.ranking_renta(conectar_sql(), metrica, comunidad_sel, top_n)
+        else:
+            ranking = almacen_datos.ranking_renta(df_rentas, agregados_renta, metrica, comunidad_sel, top_n)
 
         fig_ranking = px.bar(
             ranking,
@@ -391,18 +590,21 @@ elif opcion == "Rentas":
     with tab2:
         st.subheader("Perfil medio de renta por comunidad autónoma")
 
-        agrupado = (
-            df_rentas.groupby("comunidad_autonoma")
-            .agg(
-                renta_neta_persona_2023=("Renta neta media por persona 2023", "mean"),
-                renta_neta_hogar_2023=("Renta neta media por hogar 2023", "mean"),
-                renta_uc_media_2023=("Media de la renta por unidad de consumo 2023", "mean"),
-                renta_uc_mediana_2023=("Mediana de la renta por unidad de consumo 2023", "mean"),
-                municipios=("Municipios", "count")
+        if USAR_DUCKDB:
+            agrupado = consultas_sql.perfil_comunidades(conectar_sql())
+        else:
+            comunidades_renta = agregados_renta["comunidades"]
+            agrupado = (
+                pd.DataFrame({
+                    "renta_neta_persona_2023": comunidades_renta[("Renta neta media por persona 2023", "mean")],
+                    "renta_neta_hogar_2023": comunidades_renta[("Renta neta media por hogar 2023", "mean")],
+                    "renta_uc_media_2023": comunidades_renta[("Media de la renta por unidad de consumo 2023", "mean")],
+                    "renta_uc_mediana_2023": comunidades_renta[("Mediana de la renta por unidad de consumo 2023", "mean")],
+                    "municipios": comunidades_renta["municipios"],
+                })
+                .reset_index()
+                .sort_values("renta_neta_persona_2023", ascending=False)
             )
-            .reset_index()
-            .sort_values("renta_neta_persona_2023", ascending=False)
-        )
 
         fig_ca = px.bar(
             agrupado,
@@ -411,19 +613,85 @@ elif opcion == "Rentas":
             title="Renta neta media por persona (2023)"
         )
 
-        fig_evol = px.scatter(
-            df_rentas,
+        # WebGL y, por encima de graficos.PUNTOS_MAXIMOS, mapa de densidad. Seleccionar una zona hace zoom con todo el detalle
+        rango_evolucion = st.session_state.get("rango_evolucion")
+        columnas_evolucion = ["Municipios", "Renta neta media por persona 2022", "Renta neta media por persona 2023", "comunidad_autonoma"]
+        fig_evol, densidad_evol = graficos.figura_dispersion(
+            consultas_sql.columnas_renta(conectar_sql(), columnas_evolucion) if USAR_DUCKDB else df_rentas,
             x="Renta neta media por persona 2022",
             y="Renta neta media por persona 2023",
             color="comunidad_autonoma",
             hover_name="Municipios",
-            title="Evolución renta neta por municipio (2022 → 2023)"
+            titulo="Evolución renta neta por municipio (2022 → 2023)",
+            rango=rango_evolucion
         )
 
         st.plotly_chart(fig_ca, use_container_width=True)
-        st.plotly_chart(fig_evol, use_container_width=True)
+        seleccion_evol = st.plotly_chart(fig_evol, use_container_width=True, on_select="rerun",
+                                         selection_mode="box", key="grafico_evolucion")
+        if densidad_evol:
+            st.caption("Hay demasiados puntos para pintarlos todos: se muestra su densidad. Selecciona una zona para ver el detalle.")
+
+        # Solo se aplica una selección nueva (la del widget se mantiene entre recargas)
+        cajas = seleccion_evol.selection.box if seleccion_evol else []
+        if cajas and cajas[0] != st.session_state.get("caja_evolucion"):
+            st.session_state["caja_evolucion"] = cajas[0]
+            st.session_state["rango_evolucion"] = [sorted(cajas[0]["x"]), sorted(cajas[0]["y"])]
+            st.rerun()
+        if rango_evolucion is not None and st.button("Ver todos los municipios"):
+            st.session_state["rango_evolucion"] = None
+            st.rerun()
+
         st.dataframe(agrupado, use_container_width=True)
 
+    # TAB 3 — DISTRITOS Y SECCIONES CENSALES
+    # Provincia -> municipio -> distrito: cada nivel solo carga los hijos del nodo elegido en el anterior
+    with tab3:
+        st.subheader("Renta por distritos y secciones censales")
+
+        indice_unidades = cargar_indice_unidades_renta(firma_rentas)
+        if not indice_unidades:
+            st.info("No hay datos de renta por distritos y secciones censales en el almacén: faltan sus particiones. "
+                    "Se crean con el scraping (python obtener_datos_ine.py) o con el paso de build (python almacen_datos.py)")
+        else:
+            col1, col2, col3, col4 = st.columns(4)
+
+            metrica_unidades = col1.selectbox(
+                "Métrica de renta",
+                almacen_datos.METRICAS_RENTA,
+                key="metrica_unidades"
+            )
+
+            provincias = sorted(
+                (int(codigo) for codigo in indice_unidades if len(codigo) == 2),
+                key=nomenclator.NOMBRES["Provincia"].get
+            )
+            provincia = col2.selectbox("Provincia", provincias, format_func=nomenclator.NOMBRES["Provincia"].get)
+
+            nodo, nombre_nodo = f"{provincia:02d}", nomenclator.NOMBRES["Provincia"][provincia]
+            for columna, unidad in ((col3, "Municipio"), (col4, "Distrito")):
+                # Solo se pueden abrir los hijos que tienen a su vez hijos
+                hijos = cargar_hijos_renta(nodo)
+                abribles = hijos[hijos["codigo"].isin(list(indice_unidades))]
+                nombres = {None: "Todos", **dict(zip(abribles["codigo"], abribles["nombre"]))}
+                elegido = columna.selectbox(unidad, list(nombres), format_func=nombres.get, key=f"unidad_renta_{unidad}")
+                if elegido is None:
+                    break
+                nodo, nombre_nodo = elegido, nombres[elegido]
+
+            hijos = cargar_hijos_renta(nodo)
+            st.caption(f"{nombre_nodo}: {len(hijos)} unidades ({', '.join(hijos['unidad_renta'].unique())})")
+
+            fig_unidades = px.bar(
+                hijos.sort_values(metrica_unidades, ascending=False),
+                x="nombre",
+                y=metrica_unidades,
+                hover_data=["codigo"],
+                title=f"{metrica_unidades} en {nombre_nodo}"
+            )
+            st.plotly_chart(fig_unidades, use_container_width=True)
+            st.dataframe(hijos[["codigo", "nombre", "unidad_renta", metrica_unidades]], hide_index=True, use_container_width=True)
+
 # =====================================================
 # Footer
 # =====================================================
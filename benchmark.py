@@ -0,0 +1,1235 @@
+import os
+import json
+import multiprocessing
+import subprocess
+import tempfile
+import textwrap
+import threading
+import functools
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qsl
+from types import SimpleNamespace
+from io import BytesIO, StringIO
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import folium
+import plotly.express as px
+import geopandas as gpd
+import shapely
+from bs4 import BeautifulSoup
+
+import almacen_datos
+import capas_geograficas
+import consultas_sql
+import graficos
+import nomenclator
+import obtener_datos_ine
+import traza_scraping
+from obtener_datos_ine import reestructurar_excel_datos_criminalidad, agrupar_datos_por_trimestres, leer_tabla_html
+
+# =====================================================
+# BENCHMARKS
+# =====================================================
+# Uso: python benchmark.py [nombre_benchmark]
+# Sin argumentos se ejecutan todos. Se asume que existe la carpeta data en el path de ejecución.
+
+path = os.path.join(os.getcwd(), "data")
+
+FICHEROS_TRIMESTRES = ["enero_marzo", "enero_junio", "enero_septiembre", "enero_diciembre"]
+
+
+def medir(funcion, *args, repeticiones=3):
+    # Mejor tiempo de varias repeticiones, en segundos
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        resultado = funcion(*args)
+        tiempos.append(time.perf_counter() - inicio)
+    return min(tiempos), resultado
+
+
+def memoria_pico(funcion, *args):
+    # Pico de memoria reservada por python durante la llamada, en MB
+    tracemalloc.start()
+    funcion(*args)
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return pico / 1024 / 1024
+
+
+# =====================================================
+# IMPLEMENTACIONES DE REFERENCIA
+# =====================================================
+# Copias sin tocar de las funciones de la versión inicial del scraping (obtener_datos_ine.py), contra las que se
+# comparan los resultados y los tiempos de las versiones actuales. No se modifican aunque cambien las actuales.
+
+def reestructurar_excel_datos_criminalidad_original(df, trimestre):
+    def esta_en_mayusculas(s):
+        return isinstance(s, str) and any(c.isalpha() for c in s) and s.isupper()
+
+    trimestre = trimestre.replace("_", "-")
+    # Renombrar columna
+    df = df.rename(columns={"Unnamed: 0": "Texto"})
+
+    tratamiento_especial = {
+        "CIUDAD AUTÓNOMA DE CEUTA",
+        "CIUDAD AUTÓNOMA DE MELILLA",
+        "EN EL EXTRANJERO",
+        "NACIONAL"
+    }
+
+    datos = {
+        "Comunidad": [],
+        "Provincia": [],
+        "Municipio": [],
+        "Tipo Delito": [],
+        "Trimestre": [],
+        "Dato 2023": [],
+        "Dato 2022": [],
+        "Variación 2023/2022": []
+    }
+
+    comunidad = None
+    provincia = None
+    municipio = None
+
+    for _, row in df.iterrows():
+        texto = row["Texto"]
+
+        # Comunidades y especiales
+        if esta_en_mayusculas(texto) and texto not in {"I. CRIMINALIDAD CONVENCIONAL",
+                                                      "II. CIBERCRIMINALIDAD (infracciones penales cometidas en/por medio ciber)",
+                                                      "III. TOTAL INFRACCIONES PENALES"}:
+            comunidad = texto
+            provincia = None
+            municipio = None
+            continue
+
+        # Provincias
+        if isinstance(texto, str) and texto.startswith("Provincia de"):
+            provincia = texto
+            municipio = None
+            continue
+
+        # Municipios
+        if isinstance(texto, str) and (
+            texto.startswith("-Municipio de") or texto.startswith("Municipio de") or
+            texto.startswith("Municipo de") or texto.startswith("Isla de") or
+            texto.startswith("-Municipo de") or texto.startswith("CIUDAD AUTÓNOMA")
+        ):
+            municipio = texto.lstrip("-")
+            continue
+
+        # Filas con datos (incluyendo categorías I, II, III)
+        if pd.notna(row[f"{trimestre} 2022"]):
+            datos["Comunidad"].append(comunidad)
+            datos["Provincia"].append(provincia)
+            datos["Municipio"].append(municipio)
+            datos["Tipo Delito"].append(texto)
+            datos["Trimestre"].append(trimestre)
+            datos["Dato 2023"].append(pd.to_numeric(row[f"{trimestre} 2023"], errors='coerce'))
+            datos["Dato 2022"].append(pd.to_numeric(row[f"{trimestre} 2022"], errors='coerce'))
+            datos["Variación 2023/2022"].append(pd.to_numeric(row["Variación % 2023/2022"], errors='coerce'))
+
+    df_final = pd.DataFrame(datos)
+
+    # None en lugar de "Columna Vacía"
+    df_final["Provincia"] = df_final["Provincia"].where(df_final["Provincia"].notna(), None)
+    df_final["Municipio"] = df_final["Municipio"].where(df_final["Municipio"].notna(), None)
+
+    # Ordenar
+    df_final = df_final.sort_values(
+        by=["Comunidad", "Provincia", "Municipio", "Tipo Delito"],
+        key=lambda col: col.fillna('')
+    ).reset_index(drop=True)
+
+    return df_final
+
+
+def agrupar_datos_por_trimestres_original(df_enero_marzo, df_enero_junio, df_enero_septiembre, df_enero_diciembre):
+    """ Con esta funcion pretendo agrupar todos los datos obtenidos de enero_marzo, enero_junio, enero_septiembre y enero_diciembre
+        Los datos obtenidos del ministerio de interior de criminalidad, en vez de venir agrupados por trimestres, agrupan el trimestre actual
+        y el trimestre anterior. De tal forma que cuando antes obtenia el dato de los botones primer trimestre, segundo trimestre... en realidad
+        estaba obtiendo el agregado hasta la fecha."""
+    
+    cols_clave = ["Comunidad", "Provincia", "Municipio", "Tipo Delito"]
+
+    for df in [df_enero_marzo, df_enero_junio, df_enero_septiembre, df_enero_diciembre]:
+        df["Dato 2023"] = pd.to_numeric(df["Dato 2023"], errors="coerce")
+        df["Dato 2022"] = pd.to_numeric(df["Dato 2022"], errors="coerce")
+        for col in cols_clave:
+            df[col] = df[col].fillna("").str.strip() #.str.upper()
+    
+    combinaciones = set()
+    for df in [df_enero_marzo, df_enero_junio, df_enero_septiembre, df_enero_diciembre]:
+        combinaciones.update([tuple(x) for x in df[cols_clave].values])
+
+    def alinear(df):
+        df_full = pd.DataFrame(list(combinaciones), columns=cols_clave)
+        df_merge = df_full.merge(df, on=cols_clave, how="left")
+        df_merge[["Dato 2023", "Dato 2022"]] = df_merge[["Dato 2023", "Dato 2022"]].fillna(0)
+        return df_merge
+    
+    df_enero_marzo = alinear(df_enero_marzo)
+    df_enero_junio = alinear(df_enero_junio)
+    df_enero_septiembre = alinear(df_enero_septiembre)
+    df_enero_diciembre = alinear(df_enero_diciembre)
+
+    # Calcular trimestres reales
+    df1 = df_enero_marzo.copy(); df1["Trimestre"] = "Enero-Marzo"
+    df2 = df_enero_junio.copy(); df2["Dato 2023"] -= df_enero_marzo["Dato 2023"]; df2["Dato 2022"] -= df_enero_marzo["Dato 2022"]; df2["Trimestre"] = "Abril-Junio"
+    df3 = df_enero_septiembre.copy(); df3["Dato 2023"] -= df_enero_junio["Dato 2023"]; df3["Dato 2022"] -= df_enero_junio["Dato 2022"]; df3["Trimestre"] = "Julio-Septiembre"
+    df4 = df_enero_diciembre.copy(); df4["Dato 2023"] -= df_enero_septiembre["Dato 2023"]; df4["Dato 2022"] -= df_enero_septiembre["Dato 2022"]; df4["Trimestre"] = "Octubre-Diciembre"
+
+    # Concatenar todos los trimestres
+    df_long = pd.concat([df1, df2, df3, df4], ignore_index=True)
+
+    ccaa_dict = {"ANDALUCÍA": "Andalucía", "ARAGÓN": "Aragón", "ASTURIAS (PRINCIPADO DE)": "Principado de Asturias", "BALEARS (ILLES)": "Illes Balears", "CANARIAS": "Canarias", 
+                 "CANTABRIA": "Cantabria", "CASTILLA - LA MANCHA": "Castilla-La Mancha", "CASTILLA Y LEON": "Castilla y León", "CATALUÑA": "Cataluña", "CIUDAD AUTÓNOMA DE CEUTA": "Ciudad Autónoma de Ceuta", 
+                 "CIUDAD AUTÓNOMA DE MELILLA": "Ciudad Autónoma de Melilla", "COMUNITAT VALENCIANA": "Comunidad Valenciana", "EXTREMADURA": "Extremadura", "GALICIA": "Galicia", 
+                 "MADRID (COMUNIDAD DE)": "Comunidad de Madrid", "MURCIA (REGION DE)": "Región de Murcia", "NAVARRA (COMUNIDAD FORAL DE)": "Comunidad Foral de Navarra", "PAÍS VASCO": "País Vasco", 
+                 "RIOJA (LA)": "La Rioja", "NACIONAL": "Nacional", "EN EL EXTRANJERO": "En el extranjero"}
+    
+    provincias_dict = {"Provincia de ÁVILA": "Ávila", "Provincia de ALBACETE": "Albacete", "Provincia de ALICANTE/ALACANT": "Alicante", "Provincia de ALMERÍA": "Almería", 
+                       "Provincia de ARABA/ÁLAVA": "Álava", "Provincia de BADAJOZ": "Badajoz", "Provincia de BALEARS (LAS)": "Las Palmas", "Provincia de BARCELONA": "Barcelona", 
+                       "Provincia de BIZKAIA": "Bizkaia", "Provincia de BURGOS": "Burgos", "Provincia de CÁCERES": "Cáceres", "Provincia de CÁDIZ": "Cádiz", "Provincia de CASTELLÓN/CASTELLÓ": "Castellón", 
+                       "Provincia de CIUDAD REAL": "Ciudad Real", "Provincia de CÓRDOBA": "Córdoba", "Provincia de CORUÑA (A)": "A Coruña", "Provincia de CUENCA": "Cuenca", 
+                       "Provincia de GIRONA": "Girona", "Provincia de GRANADA": "Granada", "Provincia de GUADALAJARA": "Guadalajara", "Provincia de GIPUZKOA": "Gipuzkoa", 
+                       "Provincia de HUELVA": "Huelva", "Provincia de HUESCA": "Huesca", "Provincia de JAÉN": "Jaén", "Provincia de LEÓN": "León", "Provincia de LLEIDA": "Lleida", 
+                       "Provincia de LUGO": "Lugo", "Provincia de MADRID": "Madrid", "Provincia de MÁLAGA": "Málaga", "Provincia de MURCIA": "Murcia", "Provincia de OURENSE": "Ourense", 
+                       "Provincia de PALENCIA": "Palencia", "Provincia de PALMAS (LAS)": "Las Palmas", "Provincia de PONTEVEDRA": "Pontevedra", "Provincia de SALAMANCA": "Salamanca", 
+                       "Provincia de SANTA CRUZ DE TENERIFE": "Santa Cruz de Tenerife", "Provincia de SEGOVIA": "Segovia", "Provincia de SEVILLA": "Sevilla", "Provincia de SORIA": "Soria", 
+                       "Provincia de TARRAGONA": "Tarragona", "Provincia de TERUEL": "Teruel", "Provincia de TOLEDO": "Toledo", "Provincia de VALENCIA/VALÈNCIA": "Valencia", 
+                       "Provincia de VALLADOLID": "Valladolid", "Provincia de ZAMORA": "Zamora", "Provincia de ZARAGOZA": "Zaragoza", "": ""}
+    
+    df_long["Comunidad"] = df_long["Comunidad"].replace(ccaa_dict)
+    df_long["Provincia"] = df_long["Provincia"].replace(provincias_dict)
+    df_long["Municipio"] = df_long["Municipio"].str.replace("Municipio de ", "", regex=False).str.replace("Municipo de ", "", regex=False)
+    df_long["Variación 2023/2022"] = ((df_long["Dato 2023"] - df_long["Dato 2022"]) / df_long["Dato 2022"] * 100).round(1)
+
+    # Pivot para 2023
+    df_wide_2023 = df_long.pivot_table(index=cols_clave,columns="Trimestre",values="Dato 2023",aggfunc="first")
+
+    # Pivot para 2022
+    df_wide_2022 = df_long.pivot_table(index=cols_clave,columns="Trimestre",values="Dato 2022",aggfunc="first")
+
+    df_variacion_2023_2022 = df_long.pivot_table(index=cols_clave, columns="Trimestre", values="Variación 2023/2022", aggfunc="first")
+
+    df_wide_2023.columns = [f"{c}2023" for c in df_wide_2023.columns]
+    df_wide_2022.columns = [f"{c}2022" for c in df_wide_2022.columns]
+    df_variacion_2023_2022.columns = [f"{c}_VAR_2023_2022" for c in df_variacion_2023_2022.columns]
+
+    df_wide = (df_wide_2023.join(df_wide_2022, how="outer").join(df_variacion_2023_2022, how="outer").reset_index())
+
+    # Columnas de trimestres
+    trimestres = ["Enero-Marzo", "Abril-Junio", "Julio-Septiembre", "Octubre-Diciembre"]
+
+    # Sumar los trimestres para 2023 y 2022
+    df_wide["Total_2023"] = df_wide[[f"{t}2023" for t in trimestres]].sum(axis=1)
+    df_wide["Total_2022"] = df_wide[[f"{t}2022" for t in trimestres]].sum(axis=1)
+
+    # Variación porcentual anual
+    df_wide["Variación_total_2023_2022"] = ((df_wide["Total_2023"] - df_wide["Total_2022"]) / df_wide["Total_2022"] * 100).round(1)
+
+
+    return df_long, df_wide
+
+
+def tabla_ministerio_desde_trimestre(df):
+    """ Los excels trimestrales guardados ya estan reestructurados. Para el benchmark se reconstruye
+        la tabla con el formato original del ministerio: cabeceras de comunidad, provincia y municipio
+        intercaladas con las filas de delitos en la primera columna."""
+    trimestre = df["Trimestre"].iloc[0]
+    col_2023, col_2022 = f"{trimestre} 2023", f"{trimestre} 2022"
+
+    filas = []
+    actual = (None, None, None)
+    for comunidad, provincia, municipio, tipo, d2023, d2022, var in df[
+        ["Comunidad", "Provincia", "Municipio", "Tipo Delito", "Dato 2023", "Dato 2022", "Variación 2023/2022"]
+    ].itertuples(index=False):
+        provincia = None if pd.isna(provincia) else provincia
+        municipio = None if pd.isna(municipio) else municipio
+        if comunidad != actual[0]:
+            filas.append((comunidad, np.nan, np.nan, np.nan))
+            actual = (comunidad, None, None)
+        if provincia != actual[1]:
+            filas.append((provincia, np.nan, np.nan, np.nan))
+            actual = (comunidad, provincia, None)
+        if municipio != actual[2]:
+            filas.append((municipio, np.nan, np.nan, np.nan))
+            actual = (comunidad, provincia, municipio)
+        filas.append((tipo, d2023, d2022, var))
+
+    return pd.DataFrame(filas, columns=["Unnamed: 0", col_2023, col_2022, "Variación % 2023/2022"])
+
+
+def benchmark_reestructurar():
+    print("reestructurar_excel_datos_criminalidad: iterrows vs vectorizado")
+    for nombre in FICHEROS_TRIMESTRES:
+        df_guardado = pd.read_excel(os.path.join(path, f"{nombre}_datos_criminalidad_espana.xlsx"))
+        trimestre = df_guardado["Trimestre"].iloc[0]
+        df_tabla = tabla_ministerio_desde_trimestre(df_guardado)
+
+        t_iterativo, df_iterativo = medir(reestructurar_excel_datos_criminalidad_original, df_tabla, trimestre)
+        t_vectorizado, df_vectorizado = medir(reestructurar_excel_datos_criminalidad, df_tabla, trimestre)
+        pd.testing.assert_frame_equal(df_iterativo, df_vectorizado)
+
+        print(f"  {nombre:<18} {len(df_tabla):>6} filas | iterrows {t_iterativo:7.3f}s | "
+              f"vectorizado {t_vectorizado:7.3f}s | x{t_iterativo / t_vectorizado:5.1f}")
+
+
+def benchmark_agrupar():
+    print("agrupar_datos_por_trimestres: merges por trimestre vs groupby diff")
+    acumulados = [
+        pd.read_excel(os.path.join(path, f"{nombre}_datos_criminalidad_espana.xlsx")).drop(columns=["Unnamed: 0"])
+        for nombre in FICHEROS_TRIMESTRES
+    ]
+
+    # La version con merges modifica los dataframes de entrada: cada llamada recibe copias.
+    # Devuelve (LONG, WIDE); se compara el LONG
+    def con_merge():
+        return agrupar_datos_por_trimestres_original(*[df.copy() for df in acumulados])[0]
+
+    def con_diff():
+        return agrupar_datos_por_trimestres(*[df.copy() for df in acumulados])
+
+    t_merge, df_merge = medir(con_merge)
+    t_diff, df_diff = medir(con_diff)
+
+    # La version con merges saca las regiones en el orden de un set (cambia en cada ejecucion): se compara ordenando
+    claves = ["Trimestre", "Comunidad", "Provincia", "Municipio", "Tipo Delito"]
+    pd.testing.assert_frame_equal(
+        df_merge.sort_values(claves, ignore_index=True), df_diff.sort_values(claves, ignore_index=True), check_dtype=False
+    )
+
+    m_merge, m_diff = memoria_pico(con_merge), memoria_pico(con_diff)
+    print(f"  {len(df_diff):>6} filas | merges {t_merge:6.3f}s {m_merge:6.1f}MB | "
+          f"groupby diff {t_diff:6.3f}s {m_diff:6.1f}MB | x{t_merge / t_diff:4.1f}")
+
+
+def html_pagina_ministerio(df_tabla, copias=1):
+    # Pagina con la tabla tablaDatosPx en el formato del ministerio: miles con "." y decimales con ","
+    def celda(valor, decimales):
+        if pd.isna(valor):
+            return "<td></td>"
+        texto = f"{valor:,.{decimales}f}".replace(",", " ").replace(".", ",").replace(" ", ".")
+        return f"<td>{texto}</td>"
+
+    cabecera = "<tr>" + "".join(f"<th>{'' if col.startswith('Unnamed') else col}</th>" for col in df_tabla.columns) + "</tr>"
+    filas = [
+        f"<tr><th>{texto}</th>{celda(d1, 0)}{celda(d2, 0)}{celda(var, 1)}</tr>"
+        for texto, d1, d2, var in df_tabla.itertuples(index=False)
+    ]
+    return ("<html><head><meta charset='utf-8'></head><body><div>Consulta</div>"
+            f"<table id='tablaDatosPx'>{cabecera}{''.join(filas * copias)}</table><p>Fuente: Ministerio del Interior</p></body></html>")
+
+
+def benchmark_tabla_html():
+    print("Tabla html del ministerio: BeautifulSoup + str(table) + pd.read_html vs lxml iterparse")
+    df_guardado = pd.read_excel(os.path.join(path, "enero_diciembre_datos_criminalidad_espana.xlsx"))
+    df_tabla = tabla_ministerio_desde_trimestre(df_guardado)
+
+    for copias in (1, 5):
+        html = html_pagina_ministerio(df_tabla, copias)
+
+        def con_beautifulsoup():
+            table = BeautifulSoup(html, "html.parser").find("table", id="tablaDatosPx")
+            return pd.read_html(StringIO(str(table)), header=0, decimal=",", thousands=".")[0]
+
+        def con_iterparse():
+            return leer_tabla_html(BytesIO(html.encode("utf-8")), "tablaDatosPx", encoding="utf-8")
+
+        t_bs, df_bs = medir(con_beautifulsoup, repeticiones=1)
+        t_lxml, df_lxml = medir(con_iterparse, repeticiones=1)
+        pd.testing.assert_frame_equal(df_bs, df_lxml)
+
+        # tracemalloc solo ve la memoria de python: el DOM de lxml que construye pd.read_html no se cuenta,
+        # así que la reducción real es mayor que la que se muestra
+        m_bs, m_lxml = memoria_pico(con_beautifulsoup), memoria_pico(con_iterparse)
+        print(f"  {len(df_lxml):>6} filas, {len(html) / 1024 / 1024:5.1f}MB de html | "
+              f"BeautifulSoup {t_bs:6.3f}s {m_bs:6.1f}MB | iterparse {t_lxml:6.3f}s {m_lxml:6.1f}MB")
+
+
+# Presupuesto del mapa a zoom nacional (el zoom inicial de la app)
+PRESUPUESTO_MAPA_KB = 200
+PRESUPUESTO_MAPA_S = 0.25
+
+
+def pintar_mapa(gdf):
+    # Igual que en la app: merge con unos datos de ejemplo, GeoJson con tooltip y render del html que se envía al navegador
+    df_mapa = pd.DataFrame({"name": gdf["name"], "valor_2023": np.arange(len(gdf)), "valor_2022": np.arange(len(gdf))})
+    gdf_merged = gdf.merge(df_mapa, on="name", how="left")
+    m = folium.Map(location=[40, -3.5], zoom_start=6)
+    folium.GeoJson(
+        gdf_merged,
+        tooltip=folium.features.GeoJsonTooltip(fields=["name", "valor_2023", "valor_2022"])
+    ).add_to(m)
+    return m.get_root().render()
+
+
+def benchmark_mapa():
+    print("Mapa: geojson completo leído en cada recarga vs capas simplificadas precalculadas")
+    inicio = time.perf_counter()
+    capas = capas_geograficas.cargar_capas(path)
+    print(f"  precálculo de capas (una vez por proceso): {time.perf_counter() - inicio:.3f}s")
+
+    for nivel, fichero in capas_geograficas.FICHEROS_GEOJSON.items():
+        def original():
+            gdf = gpd.read_file(os.path.join(path, fichero))
+            gdf = gdf[[col for col in gdf.columns if not pd.api.types.is_datetime64_any_dtype(gdf[col])]]
+            return pintar_mapa(gdf)
+
+        t_original, html_original = medir(original)
+        print(f"  {nivel:<10} original      {len(html_original) / 1024:7.0f} KB {t_original:6.3f}s")
+
+        for zoom in capas_geograficas.TOLERANCIAS_POR_ZOOM:
+            t_capa, html_capa = medir(pintar_mapa, capas[nivel][zoom])
+            print(f"  {nivel:<10} zoom >= {zoom:<5} {len(html_capa) / 1024:7.0f} KB {t_capa:6.3f}s")
+
+        t_nacional, html_nacional = medir(pintar_mapa, capas_geograficas.capa_para_zoom(capas, nivel, 6))
+        assert len(html_nacional) / 1024 <= PRESUPUESTO_MAPA_KB, f"{nivel}: el mapa ocupa más de {PRESUPUESTO_MAPA_KB} KB"
+        assert t_nacional <= PRESUPUESTO_MAPA_S, f"{nivel}: el mapa tarda más de {PRESUPUESTO_MAPA_S}s"
+
+
+def benchmark_filtros():
+    print("Filtros de región y tipo de delito: comparación de columnas vs índice de posiciones")
+    df_delitos = almacen_datos.vista_ancha(almacen_datos.cargar_modelo_delitos(path))
+    # Se repiten los datos para simular varios años cargados a la vez
+    for copias in (1, 10):
+        df = pd.concat([df_delitos] * copias, ignore_index=True)
+        t_indice, indice = medir(almacen_datos.construir_indice_delitos, df, repeticiones=1)
+        selecciones = [("Comunidad", "Madrid"), ("Municipio", "Getafe"), ("Tipo Delito", "8. Hurtos")]
+
+        def con_mascara():
+            return [df[df[col] == valor] for col, valor in selecciones]
+
+        def con_indice():
+            return [almacen_datos.filas_indice(df, indice, col, valor) for col, valor in selecciones]
+
+        t_mascara, res_mascara = medir(con_mascara, repeticiones=20)
+        t_con_indice, res_indice = medir(con_indice, repeticiones=20)
+        for a, b in zip(res_mascara, res_indice):
+            pd.testing.assert_frame_equal(a, b)
+        print(f"  {len(df):>7} filas | índice (una vez) {t_indice:6.3f}s | máscaras {t_mascara * 1000:7.2f}ms | "
+              f"índice {t_con_indice * 1000:7.2f}ms | x{t_mascara / t_con_indice:5.1f}")
+
+
+def municipios_sinteticos(gdf_provincias, geografia, total=8000, semilla=0):
+    # El geojson de municipios no viene con el repositorio: se parte cada provincia en celdas de Voronoi
+    # (en total unas 8.000, como municipios hay en España). Las celdas de cada provincia llevan el nombre
+    # y el código INE de los municipios de esa provincia en la geografía del almacén
+    rng = np.random.default_rng(semilla)
+    areas = shapely.area(np.asarray(gdf_provincias.geometry))
+    ids_provincia = nomenclator.ids_region("Provincia", gdf_provincias["name"])
+    nombres, codigos, celdas = [], [], []
+    for geometria, area, id_provincia in zip(gdf_provincias.geometry, areas, ids_provincia):
+        n = max(3, int(total * area / areas.sum()))
+        xmin, ymin, xmax, ymax = geometria.bounds
+        puntos = shapely.points(rng.uniform(xmin, xmax, n), rng.uniform(ymin, ymax, n))
+        voronoi = shapely.voronoi_polygons(shapely.multipoints(puntos), extend_to=shapely.box(xmin, ymin, xmax, ymax))
+        recortes = shapely.intersection(shapely.get_parts(voronoi), geometria)
+        recortes = [c for c in recortes if c.geom_type in ("Polygon", "MultiPolygon") and not c.is_empty]
+        # Primero los que tienen datos de criminalidad, que son los que se pintan
+        municipios = geografia[geografia["id_provincia"] == id_provincia].sort_values("municipio_delitos", na_position="last")
+        nombres += (list(municipios["municipio"].astype(str)) + [f"Municipio sintético {i}" for i in range(len(recortes))])[:len(recortes)]
+        codigos += (list(municipios["codigo_ine"].astype(str)) + [None] * len(recortes))[:len(recortes)]
+        celdas += recortes
+    return gpd.GeoDataFrame({"name": nombres, "mun_code": codigos}, geometry=celdas, crs=gdf_provincias.crs)
+
+
+def benchmark_municipios():
+    print("Mapa de municipios: capa completa vs puntos a escala nacional y polígonos de la vista (índice espacial)")
+    geografia, _ = almacen_datos.cargar_delitos_renta(path)
+    gdf_provincias = gpd.read_file(os.path.join(path, "spain-provinces.geojson"))
+    gdf_municipios = municipios_sinteticos(gdf_provincias, geografia)
+
+    with tempfile.TemporaryDirectory() as carpeta:
+        gdf_provincias.to_file(os.path.join(carpeta, capas_geograficas.FICHEROS_GEOJSON["Provincia"]), driver="GeoJSON")
+        # Con el código INE en el geojson y sin él (provincia que contiene el polígono y nombre)
+        gdf_municipios.to_file(os.path.join(carpeta, capas_geograficas.FICHERO_MUNICIPIOS), driver="GeoJSON")
+        t_codigo, municipios = medir(capas_geograficas.cargar_municipios, carpeta, geografia, repeticiones=1)
+        gdf_municipios.drop(columns=["mun_code"]).to_file(os.path.join(carpeta, capas_geograficas.FICHERO_MUNICIPIOS), driver="GeoJSON")
+        t_nombre, por_nombre = medir(capas_geograficas.cargar_municipios, carpeta, geografia, repeticiones=1)
+    puntos = municipios["puntos"]
+    # Cada polígono se ha cruzado con un municipio de su provincia, lo mismo por código que por provincia y nombre
+    assert (puntos["codigo_ine"].str[:2].astype(int) == puntos["id_provincia"]).all()
+    cruzados = set(puntos["codigo_ine"]) & set(por_nombre["puntos"]["codigo_ine"])
+    assert len(cruzados) >= 0.99 * len(puntos)
+    print(f"  {len(gdf_municipios)} municipios, {len(puntos)} con datos | "
+          f"precálculo (una vez por proceso) por código {t_codigo:.3f}s, por provincia y nombre {t_nombre:.3f}s")
+
+    t_completa, html_completa = medir(pintar_mapa, gdf_municipios, repeticiones=1)
+    print(f"  capa completa           {len(html_completa) / 1024:7.0f} KB {t_completa:6.3f}s")
+
+    # Datos de un delito para cruzar con los municipios de la vista
+    anio = almacen_datos.anios_comparables(almacen_datos.cargar_modelo_delitos(path))[-1]
+    df_delitos = almacen_datos.vista_ancha(almacen_datos.cargar_modelo_delitos(path), anio)
+    df_filas = df_delitos[df_delitos["Municipio"].notna() & (df_delitos["Tipo Delito"] == "8. Hurtos")]
+    df_filtrado = capas_geograficas.datos_mapa(df_filas, "Municipio", "8. Hurtos", *almacen_datos.columnas_vista("Total", anio),
+                                               geografia=geografia)
+
+    # Vistas centradas en un municipio con datos: consulta con el índice precalculado de la capa y cruce de la vista,
+    # frente a cruzar la capa entera y consultar la copia cruzada (que construye su propio índice)
+    punto = puntos.geometry.iloc[0]
+    for zoom, centro in [(6, [40, -3.5]), (9, [punto.y, punto.x]), (12, [punto.y, punto.x])]:
+        limites = capas_geograficas.ampliar_limites(capas_geograficas.limites_aproximados(centro, zoom))
+
+        def vista_y_cruce():
+            return capas_geograficas.cruzar_capa(capas_geograficas.municipios_en_vista(municipios, zoom, limites), df_filtrado, "Municipio")
+
+        def cruce_y_vista():
+            gdf = capas_geograficas.cruzar_capa(capas_geograficas.capa_municipios(municipios, zoom), df_filtrado, "Municipio")
+            return gdf if zoom < capas_geograficas.ZOOM_POLIGONOS_MUNICIPIOS else capas_geograficas.filtrar_vista(gdf, limites)
+
+        t_vista, gdf_vista = medir(vista_y_cruce)
+        t_antes, gdf_antes = medir(cruce_y_vista)
+        pd.testing.assert_frame_equal(gdf_vista.reset_index(drop=True), gdf_antes.reset_index(drop=True))
+        assert gdf_vista["valor_actual"].notna().all()
+        # Al navegador solo van el nombre y la geometría con los datos del tooltip
+        t_mapa, html_vista = medir(pintar_mapa, gdf_vista[["name", "geometry"]])
+        print(f"  zoom {zoom:<3} {len(gdf_vista):>5} municipios | vista y cruce {t_vista * 1000:6.2f}ms "
+              f"(cruce y vista {t_antes * 1000:6.2f}ms) | {len(html_vista) / 1024:7.0f} KB {t_mapa:6.3f}s")
+        if zoom < capas_geograficas.ZOOM_POLIGONOS_MUNICIPIOS:
+            assert len(html_vista) / 1024 <= PRESUPUESTO_MAPA_KB, f"el mapa de municipios ocupa más de {PRESUPUESTO_MAPA_KB} KB"
+            assert t_mapa <= PRESUPUESTO_MAPA_S, f"el mapa de municipios tarda más de {PRESUPUESTO_MAPA_S}s"
+
+
+def benchmark_cache_mapa():
+    print("Mapa: datos y capa cruzada recalculados en cada selección vs caché de capas precalculadas")
+    df_delitos = almacen_datos.vista_ancha(almacen_datos.cargar_modelo_delitos(path))
+    anio = almacen_datos.anios_comparables(almacen_datos.cargar_modelo_delitos(path))[-1]
+    indice = almacen_datos.construir_indice_delitos(df_delitos)
+    capas = capas_geograficas.cargar_capas(path)
+    tipos = df_delitos["Tipo Delito"].dropna().unique()
+    trimestres = almacen_datos.TRIMESTRES + ["Total"]
+
+    def preparar(nivel, tipo_delito, trimestre):
+        # Mismo cálculo que preparar_capa_mapa en la aplicación
+        df_filas = almacen_datos.filas_indice(df_delitos, indice, "Nivel", (nivel, tipo_delito))
+        df_filtrado = capas_geograficas.datos_mapa(df_filas, nivel, tipo_delito, *almacen_datos.columnas_vista(trimestre, anio))
+        gdf = capas_geograficas.capa_para_zoom(capas, nivel, 6)
+        return df_filtrado, capas_geograficas.cruzar_capa(gdf, df_filtrado, nivel)
+
+    combinaciones = [(nivel, tipo, trimestre) for nivel in capas_geograficas.FICHEROS_GEOJSON
+                     for tipo in tipos for trimestre in trimestres]
+    inicio = time.perf_counter()
+    cache = {clave: preparar(*clave) for clave in combinaciones}
+    print(f"  calentar {len(cache)} combinaciones (una vez por proceso): {time.perf_counter() - inicio:.3f}s")
+
+    for clave in combinaciones[:: max(1, len(combinaciones) // 3)]:
+        t_calculo, (_, gdf_calculo) = medir(preparar, *clave, repeticiones=5)
+        t_cache, (_, gdf_cache) = medir(cache.__getitem__, clave, repeticiones=5)
+        pd.testing.assert_frame_equal(gdf_calculo, gdf_cache)
+        print(f"  {clave[0]:<10} {clave[2]:<17} recálculo {t_calculo * 1000:7.2f}ms | caché {t_cache * 1000:7.4f}ms")
+
+
+def memoria_proceso():
+    # (memoria privada, páginas de ficheros mapeados) en MB del proceso actual, de /proc/self/status (solo Linux)
+    with open("/proc/self/status") as f:
+        campos = dict(linea.split(":", 1) for linea in f)
+    return int(campos["RssAnon"].split()[0]) / 1024, int(campos["RssFile"].split()[0]) / 1024
+
+
+def simular_sesiones(modo, sesiones, cola):
+    # Cada sesión se queda con los datos que usa una recarga de la vista de rentas y los del modelo de criminalidad
+    metrica = "Renta neta media por persona 2023"
+    inicial = memoria_proceso()
+    vivas = []
+    if modo == "copia":
+        # Antes: st.cache_data devuelve una copia por sesión y cada vista filtra el dataframe entero
+        for _ in range(sesiones):
+            df_rentas = almacen_datos.cargar_rentas(path, almacen_datos.ficheros_rentas(path)).dropna(subset=["codigo_ine"])
+            df_filtro = df_rentas[df_rentas["comunidad_autonoma"].notna()].dropna(subset=[metrica])
+            vivas.append((df_rentas, df_filtro, almacen_datos.cargar_modelo_delitos(path)))
+    else:
+        # Ahora: un único dataframe por proceso sobre la copia Arrow mapeada; cada sesión solo su columna y su ranking.
+        # Es el mismo objeto que guarda cargar_excels en la app (sin filtrar, ver almacen_datos.preparar_rentas)
+        df_rentas = almacen_datos.cargar_rentas(path, almacen_datos.ficheros_rentas(path), compartido=True)
+        modelo = almacen_datos.cargar_modelo_delitos(path, compartido=True)
+        for _ in range(sesiones):
+            valores = df_rentas[metrica][df_rentas["comunidad_autonoma"].notna()].dropna()
+            vivas.append((valores, df_rentas.loc[valores.nlargest(30).index], modelo))
+    final = memoria_proceso()
+    cola.put((final[0] - inicial[0], final[1] - inicial[1]))
+
+
+def benchmark_sesiones():
+    print("Memoria con N sesiones: copia por sesión vs dataframe compartido sobre Arrow mapeado en memoria")
+    # Se genera la copia Arrow si aún no existe, para no medir su escritura
+    almacen_datos.cargar_rentas(path, almacen_datos.ficheros_rentas(path), compartido=True)
+    almacen_datos.cargar_modelo_delitos(path, compartido=True)
+    contexto = multiprocessing.get_context("fork")
+    for sesiones in (1, 10, 50):
+        linea = f"  {sesiones:>3} sesiones"
+        for modo in ("copia", "compartido"):
+            # Un proceso nuevo por medida para que no se mezclen las memorias de un escenario y otro
+            cola = contexto.Queue()
+            proceso = contexto.Process(target=simular_sesiones, args=(modo, sesiones, cola))
+            proceso.start()
+            privada, mapeada = cola.get()
+            proceso.join()
+            linea += f" | {modo}: privada {privada:7.1f} MB, mapeada {mapeada:5.1f} MB"
+        print(linea)
+
+
+def sin_esquema(df):
+    # Columnas de texto como objetos Python, como quedan al leer los excels
+    return df.astype({col: object for col in df.columns if not pd.api.types.is_numeric_dtype(df[col])})
+
+
+def benchmark_memoria():
+    print("Memoria por dataframe: texto como objetos Python vs esquema (categóricas y string[pyarrow])")
+    rentas_excel = almacen_datos.preparar_rentas(almacen_datos.ficheros_rentas(path))
+    modelo = almacen_datos.cargar_modelo_delitos(path)
+    modelo_objetos = sin_esquema(modelo)
+    frames = {
+        "renta": (rentas_excel, almacen_datos.tipar(rentas_excel)),
+        "criminalidad": (modelo_objetos, modelo),
+        "vista_ancha": (almacen_datos.vista_ancha(modelo_objetos), almacen_datos.vista_ancha(modelo)),
+    }
+    for nombre, (antes, despues) in frames.items():
+        informe = almacen_datos.informe_memoria(antes).join(almacen_datos.informe_memoria(despues), lsuffix="_antes", rsuffix="_despues")
+        print(f"  {nombre} ({len(despues)} filas)")
+        print(textwrap.indent(informe.round(3).to_string(), "    "))
+
+    print("  Filtros y groupbys sobre el modelo de criminalidad")
+    for etiqueta, df in [("objetos", modelo_objetos), ("códigos", modelo)]:
+        t_filtro, _ = medir(lambda: df[df["Tipo Delito"] == "8. Hurtos"], repeticiones=20)
+        t_grupo, _ = medir(lambda: df.groupby(["Comunidad", "Tipo Delito"], observed=True)["Valor"].sum(), repeticiones=5)
+        print(f"    {etiqueta:<8} filtro {t_filtro * 1000:6.2f}ms | groupby {t_grupo * 1000:6.2f}ms")
+
+
+def benchmark_rentas():
+    print("Rentas: filtro y ordenación del dataframe en cada recarga vs agregados y rankings precalculados")
+    df_rentas = almacen_datos.cargar_rentas(path, almacen_datos.ficheros_rentas(path), compartido=True)
+    t_agregados, agregados = medir(almacen_datos.construir_agregados_renta, df_rentas, repeticiones=1)
+    print(f"  agregados (una vez por proceso): {t_agregados:.3f}s")
+    comunidades = list(df_rentas["comunidad_autonoma"].cat.categories)
+    metrica = almacen_datos.METRICAS_RENTA[0]
+
+    for seleccion in (comunidades, comunidades[:5], comunidades[:1]):
+        def original():
+            df_filtro = df_rentas[df_rentas["comunidad_autonoma"].isin(seleccion)].dropna(subset=[metrica])
+            resumen = (df_filtro[metrica].mean(), df_filtro[metrica].median(), len(df_filtro))
+            return resumen, df_filtro.sort_values(metrica, ascending=False, kind="stable").head(100)
+
+        def precalculado():
+            resumen = almacen_datos.resumen_renta(df_rentas, agregados, metrica, seleccion)
+            return resumen, almacen_datos.ranking_renta(df_rentas, agregados, metrica, seleccion, 100)
+
+        t_original, (resumen_original, ranking_original) = medir(original, repeticiones=20)
+        t_precalculado, (resumen, ranking) = medir(precalculado, repeticiones=20)
+        pd.testing.assert_frame_equal(ranking_original, ranking)
+        assert np.allclose(resumen_original, resumen)
+        print(f"  {len(seleccion):>2} comunidades | original {t_original * 1000:6.2f}ms | "
+              f"precalculado {t_precalculado * 1000:6.2f}ms | x{t_original / t_precalculado:5.1f}")
+
+    def agrupacion():
+        return df_rentas.groupby("comunidad_autonoma", observed=True)[metrica].agg(["mean", "count"])
+
+    t_grupo, _ = medir(agrupacion, repeticiones=20)
+    print(f"  perfil por comunidad: groupby {t_grupo * 1000:6.2f}ms por recarga | precalculado: consulta a la tabla")
+
+
+def benchmark_dispersion():
+    print("Evolución de la renta: scatter SVG con todos los puntos vs WebGL con presupuesto de puntos (densidad)")
+    df_rentas = almacen_datos.cargar_rentas(path, almacen_datos.ficheros_rentas(path), compartido=True)
+    x, y = "Renta neta media por persona 2022", "Renta neta media por persona 2023"
+    rng = np.random.default_rng(0)
+    # Se repiten los municipios con algo de ruido para simular datos por distrito o sección censal
+    for copias in (1, 5, 20):
+        df = pd.concat([df_rentas] * copias, ignore_index=True)
+        if copias > 1:
+            df[x] = df[x] * rng.normal(1, 0.03, len(df))
+            df[y] = df[y] * rng.normal(1, 0.03, len(df))
+
+        def svg():
+            return px.scatter(df, x=x, y=y, color="comunidad_autonoma", hover_name="Municipios").to_json()
+
+        def presupuesto():
+            fig, densidad = graficos.figura_dispersion(df, x, y, "comunidad_autonoma", "Municipios", "Evolución")
+            return fig.to_json(), densidad
+
+        t_svg, json_svg = medir(svg, repeticiones=1)
+        t_presupuesto, (json_presupuesto, densidad) = medir(presupuesto, repeticiones=1)
+        modo = "densidad" if densidad else "scattergl"
+        print(f"  {len(df):>7} puntos | svg {len(json_svg) / 1024:8.0f} KB {t_svg:6.3f}s | "
+              f"{modo:<9} {len(json_presupuesto) / 1024:6.0f} KB {t_presupuesto:6.3f}s")
+        if densidad:
+            assert len(json_presupuesto) <= len(json_svg), "el mapa de densidad ocupa más que los puntos"
+
+    # Zoom: con el rango seleccionado vuelve el detalle completo
+    df = pd.concat([df_rentas] * 20, ignore_index=True)
+    rango = [[10000, 11000], [10000, 11000]]
+    fig, densidad = graficos.figura_dispersion(df, x, y, "comunidad_autonoma", "Municipios", "Evolución", rango=rango)
+    print(f"  zoom {rango}: {sum(len(traza.x) for traza in fig.data)} puntos, densidad={densidad}")
+
+
+def benchmark_cruce():
+    print("Delitos x renta: cruce por nombres en cada recarga vs tabla materializada por código INE")
+    modelo = almacen_datos.cargar_modelo_delitos(path)
+    df_rentas = almacen_datos.cargar_rentas(path, almacen_datos.ficheros_rentas(path))
+    anio = almacen_datos.anios_modelo(modelo)[-1]
+
+    def por_nombres():
+        geografia = almacen_datos.construir_geografia(df_rentas, modelo)
+        tabla = almacen_datos.construir_delitos_renta(geografia, modelo, df_rentas)
+        return tabla[(tabla["Tipo Delito"] == "8. Hurtos") & (tabla["Año"] == anio)]
+
+    _, delitos_renta = almacen_datos.cargar_delitos_renta(path, compartido=True)
+    indice = almacen_datos.posiciones_por_grupo({"Tipo Delito": delitos_renta["Tipo Delito"], "Año": delitos_renta["Año"]})
+
+    def materializado():
+        return delitos_renta.iloc[indice[("8. Hurtos", anio)]]
+
+    t_nombres, res_nombres = medir(por_nombres, repeticiones=1)
+    t_materializado, res_materializado = medir(materializado, repeticiones=20)
+    assert len(res_nombres) == len(res_materializado)
+    print(f"  {len(res_materializado)} municipios | por nombres {t_nombres:6.3f}s | materializado {t_materializado * 1000:6.2f}ms")
+
+
+def benchmark_nomenclator():
+    print("Nomenclátor: nombres traducidos y cruzados como texto vs ids enteros asignados al ingerir")
+    modelo = almacen_datos.cargar_modelo_delitos(path)
+    df_delitos = almacen_datos.vista_ancha(modelo)
+    indice = almacen_datos.construir_indice_delitos(df_delitos)
+    capas = capas_geograficas.cargar_capas(path)
+    anio = almacen_datos.anios_modelo(modelo)[-1]
+    columnas = almacen_datos.columnas_vista("Total", anio)
+
+    # Ingesta: una búsqueda por fila frente a una por valor distinto
+    comunidades = modelo["Comunidad"].astype(object)
+    t_filas, ids_filas = medir(lambda: np.array([nomenclator.id_region("Comunidad", v) for v in comunidades], dtype="int8"), repeticiones=1)
+    t_distintos, ids_distintos = medir(nomenclator.ids_region, "Comunidad", modelo["Comunidad"])
+    assert (ids_filas == ids_distintos).all()
+    print(f"  ids de {len(modelo)} filas | por fila {t_filas:6.3f}s | por valor distinto {t_distintos * 1000:6.2f}ms")
+
+    for nivel in ["Comunidad", "Provincia"]:
+        gdf = capas_geograficas.capa_para_zoom(capas, nivel, 6)
+        # Lo que hacía la app: nombre de los datos -> nombre del geojson y merge por texto
+        nombre_geojson = dict(zip(gdf["id_region"], gdf[capas_geograficas.COLUMNA_NOMBRE]))
+        traduccion = {nombre: nombre_geojson[id_] for id_, nombre in nomenclator.NOMBRES[nivel].items() if id_ in nombre_geojson}
+        df_filas = almacen_datos.filas_indice(df_delitos, indice, "Nivel", (nivel, "8. Hurtos"))
+        df_filtrado = capas_geograficas.datos_mapa(df_filas, nivel, "8. Hurtos", *columnas)
+
+        def por_texto():
+            datos = df_filtrado.assign(Region_norm=df_filtrado[nivel].astype(object).replace(traduccion))
+            return gdf.merge(datos[["Region_norm", "valor_actual"]], left_on=capas_geograficas.COLUMNA_NOMBRE,
+                             right_on="Region_norm", how="left")
+
+        def por_id():
+            return capas_geograficas.cruzar_capa(gdf, df_filtrado, nivel)
+
+        t_texto, res_texto = medir(por_texto, repeticiones=20)
+        t_id, res_id = medir(por_id, repeticiones=20)
+        assert res_id["id_region"].ne(nomenclator.SIN_ID).all(), f"{nivel}: regiones del geojson sin id"
+        assert res_texto["valor_actual"].equals(res_id["valor_actual"]), f"{nivel}: los cruces no coinciden"
+        print(f"  {nivel:<10} {res_id['valor_actual'].notna().sum()}/{len(gdf)} regiones con dato | "
+              f"por texto {t_texto * 1000:6.2f}ms | por id {t_id * 1000:6.2f}ms")
+
+
+def bytes_arrow(df):
+    # Lo que st.dataframe envía al navegador: el dataframe serializado en Arrow IPC
+    tabla = pa.Table.from_pandas(df)
+    salida = pa.BufferOutputStream()
+    with pa.ipc.new_stream(salida, tabla.schema) as escritor:
+        escritor.write_table(tabla)
+    return salida.getvalue().size
+
+
+def benchmark_tabla():
+    print("Tabla interactiva: dataframe entero en cada recarga vs página filtrada y ordenada en el servidor")
+    modelo = almacen_datos.cargar_modelo_delitos(path)
+    anio = almacen_datos.anios_comparables(modelo)[-1]
+    vista = almacen_datos.vista_ancha(modelo, anio)
+    columnas = almacen_datos.CLAVES_DELITO + list(almacen_datos.columnas_vista("Total", anio))
+
+    for copias in [1, 4, 16]:
+        df = pd.concat([vista] * copias, ignore_index=True)
+        indice = almacen_datos.construir_indice_delitos(df)
+        t_orden, orden = medir(almacen_datos.orden_tabla, df, f"Total_{anio}", True, repeticiones=1)
+
+        def completa():
+            return bytes_arrow(df)
+
+        def pagina():
+            posiciones = almacen_datos.posiciones_filtro(indice, nivel="Municipio", tipos_delito=["8. Hurtos"])
+            df_pagina, total = almacen_datos.pagina_tabla(df, orden, posiciones, columnas, 0, 50)
+            return bytes_arrow(df_pagina), df_pagina, total
+
+        t_completa, kb_completa = medir(completa, repeticiones=1)
+        t_pagina, (kb_pagina, df_pagina, total) = medir(pagina)
+        # Misma página que filtrando y ordenando el dataframe entero
+        esperado = df[(almacen_datos.nivel_geografico(df) == "Municipio") & (df["Tipo Delito"] == "8. Hurtos")]
+        esperado = esperado.sort_values(f"Total_{anio}", ascending=False, kind="stable")[columnas].head(50)
+        assert total == len(df[(almacen_datos.nivel_geografico(df) == "Municipio") & (df["Tipo Delito"] == "8. Hurtos")])
+        assert df_pagina.equals(esperado)
+        print(f"  {len(df):7d} filas | entera {kb_completa / 1024:8.0f} KB {t_completa:6.3f}s | "
+              f"página {kb_pagina / 1024:5.1f} KB {t_pagina * 1000:6.2f}ms (orden una vez: {t_orden:5.3f}s)")
+
+
+def benchmark_sql():
+    print("Consultas de la app: pandas sobre los dataframes en memoria vs DuckDB sobre los parquet del almacén")
+    if consultas_sql.duckdb is None:
+        print("  DuckDB no está instalado (pip install duckdb)")
+        return
+    con = consultas_sql.conectar(path)
+    modelo = almacen_datos.cargar_modelo_delitos(path)
+    anio = almacen_datos.anios_comparables(modelo)[-1]
+    vista = almacen_datos.vista_ancha(modelo, anio)
+    indice = almacen_datos.construir_indice_delitos(vista)
+    df_rentas = almacen_datos.cargar_rentas(path, almacen_datos.ficheros_rentas(path))
+    agregados = almacen_datos.construir_agregados_renta(df_rentas)
+    metrica, comunidades = "Renta neta media por hogar 2023", ["Galicia", "Aragón", "Cataluña"]
+
+    # Mismo resultado que en pandas
+    columnas = list(almacen_datos.columnas_vista("Julio-Septiembre", anio))
+    for nivel in almacen_datos.NIVELES:
+        esperado = almacen_datos.filas_indice(vista, indice, "Nivel", (nivel, "8. Hurtos"))
+        obtenido = consultas_sql.vista_delitos(con, anio, "Julio-Septiembre", nivel=nivel, tipo_delito="8. Hurtos")
+        claves = esperado[nivel].astype(str).to_numpy()
+        assert sorted(claves) == sorted(obtenido[nivel]), f"{nivel}: filas distintas"
+        obtenido = obtenido.set_index(nivel).loc[claves, columnas]
+        assert np.allclose(esperado[columnas].to_numpy(dtype="float64"), obtenido.to_numpy(dtype="float64"), equal_nan=True)
+    esperado = almacen_datos.resumen_renta(df_rentas, agregados, metrica, comunidades)
+    assert np.allclose(esperado, consultas_sql.resumen_renta(con, metrica, comunidades))
+    esperado = almacen_datos.ranking_renta(df_rentas, agregados, metrica, comunidades, 30)
+    assert list(esperado["codigo_ine"].astype(str)) == list(consultas_sql.ranking_renta(con, metrica, comunidades, 30)["codigo_ine"])
+
+    # La app con MOTOR_CONSULTAS=duckdb: años, opciones de los filtros y páginas de la tabla sin cargar el modelo
+    assert consultas_sql.anios(con) == almacen_datos.anios_modelo(modelo)
+    assert list(vista.columns) == almacen_datos.columnas_ancha(anio)
+    opciones = consultas_sql.opciones_delitos(con, anio)
+    for col in almacen_datos.NIVELES + ["Tipo Delito"]:
+        assert opciones[col] == [valor for valor in indice[col] if not pd.isna(valor)], f"{col}: opciones distintas"
+    columnas = almacen_datos.columnas_ancha(anio)
+    filtros = [{}, {"nivel": "Provincia"}, {"nivel": "Comunidad", "region": "Galicia"},
+               {"nivel": "Municipio", "tipos_delito": ("8. Hurtos", "1. Homicidios dolosos y asesinatos consumados")}]
+    for filtro in filtros:
+        posiciones = almacen_datos.posiciones_filtro(indice, **filtro)
+        for orden, descendente in [("Comunidad", False), (f"Total_{anio}", True), (f"Variación_total_{anio}_{anio - 1}", True),
+                                   (f"Enero-Marzo_VAR_{anio}_{anio - 1}", False)]:
+            for pagina in (0, 3):
+                esperado, total = almacen_datos.pagina_tabla(vista, almacen_datos.orden_tabla(vista, orden, descendente),
+                                                             posiciones, columnas, pagina, 50)
+                obtenido = consultas_sql.pagina_delitos(con, anio, columnas, orden, descendente, pagina, 50, **filtro)
+                assert total == consultas_sql.filas_delitos(con, anio, **filtro), f"{filtro}: total distinto"
+                assert len(esperado) == len(obtenido), f"{filtro} {orden}: filas distintas"
+                for col in columnas:
+                    a, b = esperado[col].reset_index(drop=True), obtenido[col]
+                    if pd.api.types.is_numeric_dtype(b):
+                        assert np.allclose(a.to_numpy(dtype="float64"), b.to_numpy(dtype="float64"), equal_nan=True), f"{filtro} {orden}: {col}"
+                    else:
+                        assert list(a.astype(object).where(a.notna(), None)) == list(b.where(b.notna(), None)), f"{filtro} {orden}: {col}"
+    assert consultas_sql.comunidades_renta(con) == sorted(df_rentas["comunidad_autonoma"].dropna().unique())
+    dispersion = ["Municipios", "Renta neta media por persona 2022", "Renta neta media por persona 2023", "comunidad_autonoma"]
+    obtenido = consultas_sql.columnas_renta(con, dispersion)
+    assert list(obtenido["Municipios"]) == list(df_rentas["Municipios"].astype(str))
+    assert np.allclose(obtenido[dispersion[1:3]].to_numpy(dtype="float64"), df_rentas[dispersion[1:3]].to_numpy(dtype="float64"), equal_nan=True)
+
+    consultas = {
+        "mapa (provincias)": (
+            lambda: almacen_datos.filas_indice(vista, indice, "Nivel", ("Provincia", "8. Hurtos")),
+            lambda: consultas_sql.vista_delitos(con, anio, "Total", nivel="Provincia", tipo_delito="8. Hurtos")),
+        "región (comunidad)": (
+            lambda: almacen_datos.filas_indice(vista, indice, "Comunidad", "Galicia"),
+            lambda: consultas_sql.vista_delitos(con, anio, columna_region="Comunidad", region="Galicia")),
+        "ranking de renta": (
+            lambda: almacen_datos.ranking_renta(df_rentas, agregados, metrica, comunidades, 30),
+            lambda: consultas_sql.ranking_renta(con, metrica, comunidades, 30)),
+    }
+    for nombre, (con_pandas, con_sql) in consultas.items():
+        t_pandas, _ = medir(con_pandas, repeticiones=10)
+        t_sql, _ = medir(con_sql, repeticiones=10)
+        print(f"  {nombre:<20} pandas (precalculado) {t_pandas * 1000:7.2f}ms | DuckDB {t_sql * 1000:7.2f}ms")
+
+    # Con muchos años: pandas tiene que cargar el modelo entero y calcular la vista; DuckDB solo lee lo que pide
+    with tempfile.TemporaryDirectory() as carpeta:
+        for copias in [1, 8, 32]:
+            anios = [modelo.assign(**{"Año": (modelo["Año"] + 2 * (i - copias + 1)).astype("int16")}) for i in range(copias)]
+            almacen_datos.guardar_dataset(carpeta, "criminalidad", pd.concat(anios, ignore_index=True))
+            con_grande = consultas_sql.conectar(carpeta)
+
+            def con_pandas():
+                grande = almacen_datos.cargar_modelo_delitos(carpeta)
+                vista_grande = almacen_datos.vista_ancha(grande, anio)
+                return almacen_datos.filas_indice(vista_grande, almacen_datos.construir_indice_delitos(vista_grande),
+                                                  "Nivel", ("Provincia", "8. Hurtos")), grande
+
+            t_pandas, (_, grande) = medir(con_pandas, repeticiones=1)
+            t_sql, _ = medir(consultas_sql.vista_delitos, con_grande, anio, "Total", "Provincia", "8. Hurtos")
+            mb = almacen_datos.informe_memoria(grande).loc["Total", "MB"]
+            print(f"  {len(grande):8d} filas ({copias * 2} años) | pandas {t_pandas:6.3f}s y {mb:6.1f} MB en memoria | "
+                  f"DuckDB {t_sql * 1000:7.2f}ms")
+
+
+MODULOS_PESADOS = ["plotly.express", "folium", "streamlit_folium", "geopandas", "shapely", "duckdb"]
+
+# Se ejecuta en un intérprete nuevo (arranque en frío): primera pintura de la app y apertura de una vista
+SCRIPT_ARRANQUE = textwrap.dedent("""
+    import json, os, sys, time
+    inicio = time.perf_counter()
+    from streamlit.testing.v1 import AppTest
+    t_streamlit = time.perf_counter() - inicio
+    at = AppTest.from_file("aplicacion_streamlit.py", default_timeout=300)
+    inicio = time.perf_counter()
+    at.run()
+    t_primera = time.perf_counter() - inicio
+    pesados = [m for m in {pesados!r} if m in sys.modules]
+    inicio = time.perf_counter()
+    if {opcion!r} is not None:
+        at.sidebar.radio[0].set_value({opcion!r})
+        at.run()
+    t_vista = time.perf_counter() - inicio
+    print(json.dumps({{"streamlit": t_streamlit, "primera": t_primera, "vista": t_vista, "pesados": pesados,
+                      "error": [str(e.value) for e in at.exception]}}), flush=True)
+    # Sin esperar a los hilos en segundo plano de la app (calentar la caché del mapa)
+    os._exit(0)
+""")
+
+
+def arranque_en_frio(opcion):
+    script = SCRIPT_ARRANQUE.format(pesados=MODULOS_PESADOS, opcion=opcion)
+    salida = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True)
+    if salida.returncode != 0:
+        raise RuntimeError(f"La app ha fallado al arrancar ({opcion}):\n{salida.stderr[-2000:]}")
+    return json.loads(salida.stdout.strip().splitlines()[-1])
+
+
+def benchmark_arranque():
+    print("Arranque en frío (intérprete nuevo): primera pintura y primera apertura de cada vista")
+    # Lo que costaba importar al principio de la app lo que ahora importa cada vista
+    script = f"import time; import pandas, streamlit; t = time.perf_counter(); import {', '.join(MODULOS_PESADOS[:-1])}; print(time.perf_counter() - t)"
+    t_imports = float(subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True).stdout.split()[-1])
+    print(f"  imports de plotly, folium y la pila geográfica: {t_imports:.2f}s")
+
+    opciones = [None, "Histograma por tipo de delito", "Gráfico por región", "Mapa de España", "Delitos y renta", "Rentas"]
+    for opcion in opciones:
+        resultado = arranque_en_frio(opcion)
+        assert not resultado["error"], resultado["error"]
+        if opcion is None:
+            print(f"  primera pintura (Tabla interactiva) {resultado['primera']:6.2f}s | "
+                  f"módulos pesados cargados: {', '.join(resultado['pesados']) or 'ninguno'}")
+        else:
+            print(f"  primera pintura + {opcion:<30} {resultado['primera']:6.2f}s + {resultado['vista']:5.2f}s")
+
+
+def unidades_sinteticas(df_rentas, secciones=36000, semilla=0):
+    # Los municipios reales con distritos y secciones inventados hasta llegar a ~secciones secciones censales
+    rng = np.random.default_rng(semilla)
+    municipios = df_rentas[df_rentas["unidad_renta"] == "Municipio"]
+    etiquetas = list(municipios["Municipios"])
+    por_municipio = rng.poisson(secciones / len(municipios) - 1, len(municipios)) + 1
+    for etiqueta, n in zip(municipios["Municipios"], por_municipio):
+        codigo, nombre = etiqueta.split(" ", 1)
+        for s in range(n):
+            distrito = s // 10 + 1
+            if s % 10 == 0:
+                etiquetas.append(f"{codigo}{distrito:02d} {nombre} distrito {distrito:02d}")
+            etiquetas.append(f"{codigo}{distrito:02d}{s % 10 + 1:03d} {nombre} sección {distrito:02d}{s % 10 + 1:03d}")
+    df = pd.DataFrame({"Municipios": etiquetas})
+    for col in almacen_datos.METRICAS_RENTA:
+        df[col] = rng.normal(15000, 4000, len(df)).round()
+    return almacen_datos.preparar_unidades_renta(df)
+
+
+def benchmark_unidades():
+    print("Renta por secciones censales: dataset entero en memoria vs particiones por provincia con índice de padres")
+    unidades = unidades_sinteticas(almacen_datos.cargar_dataset(path, "renta"))
+    with tempfile.TemporaryDirectory() as carpeta:
+        t_guardar, _ = medir(almacen_datos.guardar_unidades_renta, carpeta, unidades, repeticiones=1)
+        ruta_entero = os.path.join(carpeta, "unidades.parquet")
+        unidades.to_parquet(ruta_entero, index=False)
+        t_indice, indice = medir(almacen_datos.indice_unidades_renta, carpeta)
+        assert indice == unidades["codigo_padre"].value_counts().to_dict()
+        print(f"  {len(unidades)} unidades ({(unidades['unidad_renta'] == 'Sección').sum()} secciones) | "
+              f"escritura de las particiones {t_guardar:.2f}s | índice de padres {t_indice * 1000:.1f}ms")
+
+        # El nodo con más hijos de cada nivel: provincia -> municipios, municipio -> distritos, distrito -> secciones
+        for nivel, digitos in (("Provincia", 2), ("Municipio", 5), ("Distrito", 7)):
+            padre = max((p for p in indice if len(p) == digitos), key=indice.get)
+
+            def entero():
+                df = almacen_datos.leer_parquet(ruta_entero)
+                return df, df[df["codigo_padre"] == padre]
+
+            t_entero, (df_entero, esperado) = medir(entero)
+            t_hijos, hijos = medir(almacen_datos.hijos_renta, carpeta, padre)
+            pd.testing.assert_frame_equal(
+                hijos, esperado[almacen_datos.COLUMNAS_UNIDADES].sort_values("codigo").reset_index(drop=True))
+            print(f"  {nivel:<9} {padre:<8} {len(hijos):5d} hijos | dataset entero {t_entero * 1000:6.1f}ms "
+                  f"{bytes_arrow(df_entero) / 1e6:5.1f}MB | hijos {t_hijos * 1000:5.1f}ms {bytes_arrow(hijos) / 1e3:6.1f}KB")
+
+
+def csv_renta_ine(unidades):
+    # Exportación CSV de la tabla de renta del INE de esas unidades: columnas Municipios, Distritos y Secciones
+    # con la etiqueta de la unidad y de sus padres, una fila por indicador y periodo, miles con "." y decimales con ","
+    etiquetas = dict(zip(unidades["codigo"], unidades["codigo"] + " " + unidades["nombre"]))
+    filas = []
+    for codigo, unidad in zip(unidades["codigo"], unidades["unidad_renta"]):
+        niveles = {"Municipio": [codigo], "Distrito": [codigo[:5], codigo], "Sección": [codigo[:5], codigo[:7], codigo]}[unidad]
+        columnas = [etiquetas.get(c, c) for c in niveles] + [""] * (3 - len(niveles))
+        for indicador in obtener_datos_ine.INDICADORES_RENTA:
+            for anio in ("2023", "2022", "2021"):
+                filas.append(";".join(columnas + [indicador, anio, "12.345,5"]))
+    return "\n".join(["Municipios;Distritos;Secciones;Indicadores de renta media y mediana;Periodo;Total"] + filas)
+
+
+def servidor_local(paginas, fallos=None, retardo=0):
+    """ Servidor HTTP local con un hilo por petición que sirve paginas ({ruta: texto o bytes}) por GET y POST.
+        fallos ({ruta: n}) hace que esa ruta conteste 500 las n primeras veces y retardo simula la latencia del servidor.
+        Devuelve el servidor (ya arrancado), su url base y la lista de peticiones recibidas (método, ruta y cuerpo)."""
+    fallos = dict(fallos or {})
+    peticiones = []
+    cerrojo = threading.Lock()
+
+    class Manejador(BaseHTTPRequestHandler):
+        def responder(self, cuerpo=b""):
+            ruta = urlsplit(self.path).path
+            with cerrojo:
+                peticiones.append((self.command, self.path, cuerpo))
+                fallar = fallos.get(ruta, 0) > 0
+                if fallar:
+                    fallos[ruta] -= 1
+            time.sleep(retardo)
+            if fallar or ruta not in paginas:
+                self.send_error(500 if fallar else 404)
+                return
+            contenido = paginas[ruta]
+            contenido = contenido.encode("utf-8") if isinstance(contenido, str) else contenido
+            self.send_response(200)
+            self.send_header("Content-Type", ("text/csv" if ruta.endswith(".csv") else "text/html") + "; charset=utf-8")
+            self.send_header("Content-Length", str(len(contenido)))
+            self.end_headers()
+            self.wfile.write(contenido)
+
+        def do_GET(self):
+            self.responder()
+
+        def do_POST(self):
+            self.responder(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+
+        def log_message(self, *args):
+            pass
+
+    servidor = ThreadingHTTPServer(("127.0.0.1", 0), Manejador)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor, f"http://127.0.0.1:{servidor.server_port}", peticiones
+
+
+def cerrar_servidor(servidor):
+    servidor.shutdown()
+    servidor.server_close()
+
+
+def benchmark_descarga_rentas():
+    print("Descarga de rentas contra un INE local: workers en paralelo, reintento tras un 500 y reanudación del progreso")
+    # Las 8 provincias con menos municipios, con distritos y secciones inventados; una tabla CSV por provincia
+    unidades = unidades_sinteticas(almacen_datos.cargar_dataset(path, "renta"))
+    provincias = unidades[unidades["unidad_renta"] == "Municipio"]["id_provincia"].value_counts().nsmallest(8).index
+    tablas = {nomenclator.NOMBRES["Provincia"][p]: (30000 + int(p), unidades[unidades["id_provincia"] == p]) for p in provincias}
+    paginas = {f"/{tabla}.csv": csv_renta_ine(df) for tabla, df in tablas.values()}
+    urls = {nombre: f"https://www.ine.es/jaxiT3/Tabla.htm?t={tabla}" for nombre, (tabla, _) in tablas.items()}
+    con_fallo = next(iter(tablas))
+    ruta_fallo = f"/{tablas[con_fallo][0]}.csv"
+
+    for num_workers, reanudar in ((1, False), (4, False), (4, True)):
+        with tempfile.TemporaryDirectory() as carpeta:
+            carpeta += os.sep
+            with open(os.path.join(carpeta, "urls_rentas.json"), "w", encoding="utf-8") as f:
+                json.dump(urls, f, ensure_ascii=False)
+            # Progreso de una ejecución anterior cortada a mitad: esas provincias no se vuelven a pedir
+            fichero_progreso = os.path.join(carpeta, "progreso_rentas.json")
+            hechas = set(list(tablas)[-3:]) if reanudar else set()
+            if reanudar:
+                obtener_datos_ine.guardar_progreso(fichero_progreso, hechas)
+
+            # La primera petición de la tabla con_fallo contesta 500: la sesión la reintenta sin repetir la provincia
+            servidor, url, peticiones = servidor_local(paginas, fallos={ruta_fallo: 1}, retardo=0.2)
+            traza_scraping.reiniciar()
+            inicio = time.perf_counter()
+            cambiadas = obtener_datos_ine.obtener_datos_ine_rentas(
+                carpeta, num_workers=num_workers, fichero_progreso=fichero_progreso, url_csv=url + "/{tabla}.csv")
+            t_descarga = time.perf_counter() - inicio
+            cerrar_servidor(servidor)
+
+            pendientes = set(tablas) - hechas
+            assert cambiadas == pendientes
+            assert sorted(ruta for _, ruta, _ in peticiones) == sorted(
+                [f"/{tablas[nombre][0]}.csv" for nombre in pendientes] + [ruta_fallo])
+            assert not os.path.exists(fichero_progreso)
+            eventos = [e for e in traza_scraping.EVENTOS if e["paso"] == "descargar"]
+            assert [e.get("reintentos") for e in eventos if e["provincia"] == con_fallo] == [1]
+            assert all(e.get("intento") == 1 for e in eventos)
+            hilos = {e["hilo"] for e in eventos}
+            assert len(hilos) == min(num_workers, len(pendientes))
+            indice = almacen_datos.indice_unidades_renta(carpeta)
+            for nombre in pendientes:
+                id_provincia = nomenclator.id_region("Provincia", nombre)
+                assert os.path.exists(almacen_datos.ruta_particion_unidades(carpeta, id_provincia))
+            assert sum(indice.values()) == sum(len(tablas[nombre][1]) for nombre in pendientes)
+            print(f"  {num_workers} worker(s){' (reanudando)' if reanudar else ''}: {len(pendientes)} provincias en {t_descarga:.2f}s | "
+                  f"{len(peticiones)} peticiones | {len(hilos)} hilos")
+
+
+# Formulario de selección del INE dentro del iframe: los select con todas las opciones, campos ocultos,
+# una casilla sin marcar y dos botones, de los que solo se envía "consultar selección"
+FORMULARIO_PORTAL = """<html><body><form method="post" action="tabla">
+<input type="hidden" name="sesion" value="abc 1">
+<select name="geografia" multiple><option value="ES">España</option><option value="AN">Andalucía</option><option>Ávila</option></select>
+<select name="tipologia" multiple><option value="T1">1. Homicidios</option><option value="T2">2. Tentativas</option></select>
+<select name="periodo" multiple><option value="2023T1">Enero-marzo 2023</option><option value="2022T1">Enero-marzo 2022</option></select>
+<input type="checkbox" name="totales" value="si">
+<div id="capaBotones"><input type="submit" id="botonConsulSele" name="consultar" value="Consultar selección">
+<input type="submit" id="botonLimpiar" name="limpiar" value="Limpiar"></div>
+</form></body></html>"""
+
+CAMPOS_PORTAL = [("sesion", "abc 1"), ("geografia", "ES"), ("geografia", "AN"), ("geografia", "Ávila"), ("tipologia", "T1"),
+                 ("tipologia", "T2"), ("periodo", "2023T1"), ("periodo", "2022T1"), ("consultar", "Consultar selección")]
+
+
+def paginas_portal(tablas):
+    """ Portal del ministerio con una tabla por trimestre: portada -> balance (acordeón por años) -> página del
+        trimestre -> iframe del INE con las secciones -> formulario de selección -> POST con la tabla tablaDatosPx."""
+    enlaces = "".join(f"<li><a href='../trimestres/{i}/'>Trimestre {i}</a></li>" for i in range(1, len(tablas) + 1))
+    paginas = {
+        "/portal/": "<main><section><div class='card'><div class='card-footer'><a href='balance/'>Balance de criminalidad</a></div></div></section></main>",
+        "/portal/balance/": ("<button class='accordion-button' aria-controls='anio2024'><span>Año 2024</span></button>"
+                             "<div id='anio2024'><ul class='list-group'><li><a href='../trimestres/9/'>2024</a></li></ul></div>"
+                             "<button class='accordion-button' aria-controls='anio2023'><span> Año 2023 </span></button>"
+                             f"<div id='anio2023'><ul class='list-group'>{enlaces}</ul></div>"),
+    }
+    for i, tabla in enumerate(tablas, start=1):
+        paginas[f"/portal/trimestres/{i}/"] = f"<iframe id='iframeINE' src='/ine/{i}/secciones'></iframe>"
+        paginas[f"/ine/{i}/secciones"] = "<ul class='secciones'><li><a href='otra'>Otra</a></li><li><a href='seleccion'>Consulta</a></li></ul>"
+        paginas[f"/ine/{i}/seleccion"] = FORMULARIO_PORTAL
+        paginas[f"/ine/{i}/tabla"] = html_pagina_ministerio(tabla)
+    return paginas
+
+
+def benchmark_portal():
+    print("Portal de criminalidad por HTTP contra un portal local: enlaces, formulario y tabla de cada trimestre")
+    guardados = [pd.read_excel(os.path.join(path, f"{nombre}_datos_criminalidad_espana.xlsx")) for nombre in FICHEROS_TRIMESTRES]
+    tablas = [tabla_ministerio_desde_trimestre(df) for df in guardados]
+    paginas = paginas_portal(tablas)
+    servidor, url, peticiones = servidor_local(paginas)
+    url_portal = url + "/portal/"
+
+    sesion = obtener_datos_ine.crear_sesion()
+    hrefs = obtener_datos_ine.obtener_hrefs_trimestres_http(sesion, url_portal=url_portal)
+    assert hrefs == [f"{url}/portal/trimestres/{i}/" for i in range(1, len(tablas) + 1)]
+
+    formulario = BeautifulSoup(FORMULARIO_PORTAL, "html.parser").find("form")
+    assert obtener_datos_ine.campos_formulario_seleccionar_todo(formulario) == CAMPOS_PORTAL
+
+    for i, (href, tabla, nombre) in enumerate(zip(hrefs, tablas, FICHEROS_TRIMESTRES), start=1):
+        peticiones.clear()
+        t_descarga, (df, _) = medir(obtener_datos_ine.descargar_tabla_criminalidad_http, sesion, href, repeticiones=1)
+        referencia = pd.read_html(StringIO(paginas[f"/ine/{i}/tabla"]), header=0, decimal=",", thousands=".")[0]
+        pd.testing.assert_frame_equal(df, referencia)
+        assert len(df) == len(tabla) and list(df.columns[1:]) == list(tabla.columns[1:])
+        metodo, ruta, cuerpo = peticiones[-1]
+        assert metodo == "POST" and ruta.endswith("/tabla") and parse_qsl(cuerpo.decode("utf-8")) == CAMPOS_PORTAL
+        print(f"  {nombre:<18} {len(df):>6} filas | {len(peticiones)} peticiones | {t_descarga:6.3f}s")
+    sesion.close()
+
+    # Recorrido completo: los trimestres descargados y reestructurados; la segunda vez, en incremental, no ha cambiado ninguno
+    with tempfile.TemporaryDirectory() as carpeta:
+        carpeta += os.sep
+        datos, cambiados = obtener_datos_ine.obtener_datos_ine_criminalidad(carpeta, url_portal=url_portal)
+        for (nombre, df), tabla, guardado in zip(datos.items(), tablas, guardados):
+            trimestre = guardado["Trimestre"].iloc[0]
+            esperado = reestructurar_excel_datos_criminalidad(tabla, trimestre)
+            pd.testing.assert_frame_equal(df[["Comunidad", "Provincia", "Municipio", "Tipo Delito"]],
+                                          esperado[["Comunidad", "Provincia", "Municipio", "Tipo Delito"]])
+            assert np.allclose(df["Dato 2023"].astype(float), esperado["Dato 2023"].astype(float), equal_nan=True)
+        assert cambiados == set(datos) and len(datos) == len(tablas)
+        _, cambiados = obtener_datos_ine.obtener_datos_ine_criminalidad(carpeta, incremental=True, url_portal=url_portal)
+        assert not cambiados
+    cerrar_servidor(servidor)
+
+
+def benchmark_traza():
+    print("Traza del scraping: coste de medir cada paso, descarga de renta por HTTP y esperas adaptativas")
+    def pasos_vacios(n=10000):
+        for _ in range(n):
+            with traza_scraping.paso("parsear"):
+                pass
+
+    traza_scraping.reiniciar()
+    t_paso, _ = medir(pasos_vacios, repeticiones=1)
+    print(f"  coste de paso(): {t_paso / 10000 * 1e6:.1f}µs por paso")
+
+    # Descarga de la provincia con más unidades desde un servidor HTTP local, con la sesión del scraping
+    unidades = unidades_sinteticas(almacen_datos.cargar_dataset(path, "renta"))
+    provincia = unidades["id_provincia"].value_counts().idxmax()
+    unidades = unidades[unidades["id_provincia"] == provincia]
+    with tempfile.TemporaryDirectory() as carpeta:
+        servidor, url, _ = servidor_local({"/30000.csv": csv_renta_ine(unidades)})
+        url_csv = url + "/{tabla}.csv"
+
+        traza_scraping.reiniciar()
+        sesion = obtener_datos_ine.crear_sesion()
+        with traza_scraping.contexto(provincia=nomenclator.NOMBRES["Provincia"][provincia], intento=1):
+            obtener_datos_ine.descargar_datos_renta_provincia_http(
+                sesion, nomenclator.NOMBRES["Provincia"][provincia], "https://www.ine.es/jaxiT3/Tabla.htm?t=30000",
+                carpeta + os.sep, url_csv=url_csv)
+        sesion.close()
+        cerrar_servidor(servidor)
+        assert sum(almacen_datos.indice_unidades_renta(carpeta + os.sep).values()) == len(unidades)
+        traza_scraping.exportar(os.path.join(carpeta, "traza_scraping.json"))
+        print(textwrap.indent(traza_scraping.informe(), "  "))
+
+    # Esperas: una página que tarda en estar lista lo que tardan las del portal tras un clic (simulado).
+    # Pausa fija de 0.7s vs WebDriverWait con su sondeo por defecto (0.5s) vs esperar_pagina (sondeo cada 0.1s)
+    rng = np.random.default_rng(0)
+    retardos = rng.uniform(0.05, 0.4, 10)
+
+    def navegador_listo_en(retardo):
+        lista = time.perf_counter() + retardo
+        return SimpleNamespace(execute_script=lambda script: time.perf_counter() >= lista)
+
+    traza_scraping.reiniciar()
+    inicio = time.perf_counter()
+    for retardo in retardos:
+        obtener_datos_ine.WebDriverWait(navegador_listo_en(retardo), 10).until(obtener_datos_ine.pagina_lista)
+    t_sondeo_defecto = time.perf_counter() - inicio
+    for retardo in retardos:
+        obtener_datos_ine.esperar_pagina(navegador_listo_en(retardo), "simulada")
+    tabla = traza_scraping.resumen()
+    print(f"  {len(retardos)} esperas (página lista en {retardos.sum():.2f}s en total) | pausas fijas {tabla.loc['esperar', 'pausa_fija']:.2f}s | "
+          f"WebDriverWait por defecto {t_sondeo_defecto:.2f}s | esperar_pagina {tabla.loc['esperar', 'espera_adaptativa']:.2f}s")
+
+
+BENCHMARKS = {
+    "reestructurar": benchmark_reestructurar,
+    "agrupar": benchmark_agrupar,
+    "tabla_html": benchmark_tabla_html,
+    "mapa": benchmark_mapa,
+    "municipios": benchmark_municipios,
+    "filtros": benchmark_filtros,
+    "cache_mapa": benchmark_cache_mapa,
+    "sesiones": benchmark_sesiones,
+    "memoria": benchmark_memoria,
+    "rentas": benchmark_rentas,
+    "dispersion": benchmark_dispersion,
+    "cruce": benchmark_cruce,
+    "nomenclator": benchmark_nomenclator,
+    "tabla": benchmark_tabla,
+    "sql": benchmark_sql,
+    "arranque": benchmark_arranque,
+    "unidades": benchmark_unidades,
+    "descarga_rentas": benchmark_descarga_rentas,
+    "portal": benchmark_portal,
+    "traza": benchmark_traza,
+}
+
+if __name__ == "__main__":
+    seleccion = sys.argv[1:] or list(BENCHMARKS)
+    for nombre in seleccion:
+        BENCHMARKS[nombre]()
@@ -0,0 +1,275 @@
+import os
+
+import geopandas as gpd
+import pandas as pd
+from shapely.errors import GEOSException
+from shapely.geometry import MultiPolygon, box
+
+import nomenclator
+from nomenclator import variantes_nombre
+
+# =====================================================
+# CAPAS GEOGRÁFICAS DEL MAPA
+# =====================================================
+# Los geojson de comunidades y provincias tienen mucho detalle. Enviarlos enteros a folium en cada cambio
+# de delito o trimestre supone cerca de 700 KB por recarga. Aquí se leen una sola vez y se precalculan versiones
+# simplificadas para cada rango de zoom. Por cada selección solo hay que hacer el merge con los datos.
+
+FICHEROS_GEOJSON = {
+    "Comunidad": "spain-communities.geojson",
+    "Provincia": "spain-provinces.geojson",
+}
+
+# Tolerancia de simplificación (en grados) para cada zoom mínimo de folium. None = geometría original
+TOLERANCIAS_POR_ZOOM = {
+    0: 0.02,
+    7: 0.005,
+    9: 0.001,
+    11: None,
+}
+
+COLUMNA_NOMBRE = "name"
+
+def quitar_islotes(geometria, area_minima):
+    # La mayoría de polígonos de los geojson son islotes diminutos que no se ven a poco zoom pero ocupan muchos puntos.
+    # De cada región se quitan las partes con área menor que area_minima (siempre se conserva la parte más grande)
+    if not isinstance(geometria, MultiPolygon):
+        return geometria
+    partes = sorted(geometria.geoms, key=lambda parte: parte.area, reverse=True)
+    return MultiPolygon([partes[0]] + [parte for parte in partes[1:] if parte.area >= area_minima])
+
+
+def simplificar(geometria, tolerancia):
+    # simplify_coverage conserva las fronteras compartidas entre regiones (no quedan huecos ni solapes).
+    # Necesita shapely >= 2.1 y una cobertura válida solo de polígonos; si no, se simplifica cada polígono por separado.
+    # Después se redondean las coordenadas a una décima de la tolerancia para que el geojson ocupe menos
+    if tolerancia is None:
+        return geometria
+    geometria = geometria.apply(quitar_islotes, area_minima=tolerancia ** 2)
+    try:
+        geometria = geometria.simplify_coverage(tolerancia)
+    except (AttributeError, NotImplementedError, GEOSException, TypeError):
+        geometria = geometria.simplify(tolerancia, preserve_topology=True)
+    return geometria.set_precision(tolerancia / 10)
+
+
+def cargar_capas(path):
+    """ Devuelve {nivel: {zoom_minimo: GeoDataFrame}} con solo el nombre, el id del nomenclátor (id_region)
+        y la geometría de cada región."""
+    capas = {}
+    for nivel, fichero in FICHEROS_GEOJSON.items():
+        gdf = gpd.read_file(os.path.join(path, fichero))[[COLUMNA_NOMBRE, "geometry"]]
+        gdf.insert(1, "id_region", nomenclator.ids_region(nivel, gdf[COLUMNA_NOMBRE]))
+        capas[nivel] = {
+            zoom: gdf.set_geometry(simplificar(gdf.geometry, tolerancia))
+            for zoom, tolerancia in TOLERANCIAS_POR_ZOOM.items()
+        }
+    return capas
+
+
+def zoom_detalle(zoom):
+    # Mayor zoom mínimo que no supera el zoom actual
+    return max(z for z in TOLERANCIAS_POR_ZOOM if z <= zoom)
+
+
+def capa_para_zoom(capas, nivel, zoom):
+    return capas[nivel][zoom_detalle(zoom)]
+
+
+# =====================================================
+# CAPAS CON DATOS
+# =====================================================
+def datos_mapa(df_filas, nivel, tipo_delito, col_actual, col_anterior, col_var, geografia=None):
+    """ Copia de las filas de un nivel y tipo de delito con las columnas que usa el mapa: Region_norm (nombre
+        de la región), id_region (id del nomenclátor en comunidades y provincias), codigo_ine (en municipios, de la
+        dimensión geografia), valor_actual, valor_anterior, variacion, variacion_pct y tipo_delito_tooltip."""
+    df_filtrado = df_filas.copy()
+    df_filtrado["Region_norm"] = df_filtrado[nivel].astype(object)
+    if nivel in nomenclator.COLUMNAS_ID:
+        df_filtrado["id_region"] = df_filtrado[nomenclator.COLUMNAS_ID[nivel]]
+    if nivel == "Municipio":
+        df_filtrado["codigo_ine"] = codigos_ine(df_filtrado, geografia)
+    df_filtrado["valor_actual"] = df_filtrado[col_actual]
+    df_filtrado["valor_anterior"] = df_filtrado[col_anterior]
+    df_filtrado["variacion"] = df_filtrado[col_var]
+    df_filtrado["variacion_pct"] = df_filtrado["variacion"].astype(str) + "%"
+    df_filtrado["tipo_delito_tooltip"] = tipo_delito
+    return df_filtrado
+
+
+def cruzar_capa(gdf, df_filtrado, nivel):
+    # Comunidades y provincias se cruzan por el id entero del nomenclátor y los municipios por su código INE
+    columnas = ["Region_norm", "valor_actual", "valor_anterior", "variacion", "variacion_pct", "tipo_delito_tooltip"]
+    if nivel == "Municipio":
+        return gdf.merge(df_filtrado[["codigo_ine"] + columnas], on="codigo_ine", how="left")
+    return gdf.merge(df_filtrado[["id_region"] + columnas], on="id_region", how="left")
+
+
+# =====================================================
+# MUNICIPIOS
+# =====================================================
+# Con ~8.000 municipios no se puede mandar la capa entera a folium. Solo se usan los municipios que tienen datos
+# de criminalidad y, según el zoom:
+# - A escala nacional cada municipio es un punto en su centroide.
+# - Con más zoom se mandan solo los polígonos que cortan la vista actual, buscados con el índice espacial (R-tree) de geopandas.
+#
+# El geojson de municipios no viene con el repositorio (ocupa decenas de MB): si no está en data, el nivel Municipio no
+# aparece en el mapa. Vale cualquier geojson de municipios en EPSG:4326, por ejemplo el de recintos municipales del
+# IGN (centrodedescargas.cnig.es, convertido a geojson) o la exportación geojson de georef-spain-municipio de
+# public.opendatasoft.com. Se guarda como data/spain-municipalities.geojson.
+# Cada polígono se cruza con la dimensión geografia del almacén (un municipio INE por fila):
+# - Por el código INE, si el geojson lo trae en alguna de las propiedades de COLUMNAS_CODIGO_INE.
+# - Si no, por provincia y nombre: la provincia es la del geojson de provincias que contiene el municipio y el nombre
+#   (propiedad "name") tiene que coincidir en alguna variante con el del INE o el de los datos de criminalidad.
+
+FICHERO_MUNICIPIOS = "spain-municipalities.geojson"
+
+# Propiedades con el código INE del municipio, por orden de preferencia. Se usan los 5 últimos dígitos:
+# el NATCODE del IGN lleva delante los códigos de país, comunidad y provincia
+COLUMNAS_CODIGO_INE = ["codigo_ine", "mun_code", "cod_ine", "ine", "natcode", "NATCODE"]
+
+# Zoom a partir del cual se pintan polígonos en vez de puntos
+ZOOM_POLIGONOS_MUNICIPIOS = 8
+
+# Al cargar los municipios de la vista se amplía la caja esta fracción por cada lado,
+# así los desplazamientos pequeños no obligan a recargar
+MARGEN_VISTA = 0.5
+
+
+def codigos_geojson(gdf):
+    # Código INE (5 dígitos) de cada municipio del geojson, o None si no trae ninguna propiedad con él
+    columna = next((col for col in COLUMNAS_CODIGO_INE if col in gdf.columns), None)
+    if columna is None:
+        return None
+    digitos = gdf[columna].astype(str).str.replace(r"\D", "", regex=True)
+    return digitos.str[-5:].str.zfill(5).where(digitos.str.len() > 0)
+
+
+def provincias_geojson(path, gdf):
+    # id del nomenclátor de la provincia (del geojson de provincias) que contiene el punto representativo de cada municipio
+    provincias = gpd.read_file(os.path.join(path, FICHEROS_GEOJSON["Provincia"]))[[COLUMNA_NOMBRE, "geometry"]]
+    provincias["id_provincia"] = nomenclator.ids_region("Provincia", provincias[COLUMNA_NOMBRE])
+    puntos = gpd.GeoDataFrame(geometry=gdf.geometry.representative_point(), crs=gdf.crs)
+    cruce = gpd.sjoin(puntos, provincias[["id_provincia", "geometry"]].to_crs(gdf.crs), how="left", predicate="within")
+    cruce = cruce[~cruce.index.duplicated()]
+    return cruce["id_provincia"].fillna(nomenclator.SIN_ID).astype(int).to_numpy()
+
+
+def cruzar_municipios(nombres_geojson, provincias, geografia):
+    """ Para cada municipio del geojson (nombre y id de provincia), el codigo_ine de la geografía de su misma provincia
+        con el que comparte alguna variante del nombre del INE o del de los datos de criminalidad (o None)."""
+    por_variante = {}
+    for columna in ("municipio", "municipio_delitos"):
+        filas = geografia.dropna(subset=[columna])
+        for codigo, provincia, nombre in zip(filas["codigo_ine"].astype(str), filas["id_provincia"], filas[columna].astype(str)):
+            for variante in variantes_nombre(nombre):
+                por_variante.setdefault((int(provincia), variante), codigo)
+    return [
+        next((por_variante[(provincia, v)] for v in sorted(variantes_nombre(nombre)) if (provincia, v) in por_variante), None)
+        for nombre, provincia in zip(nombres_geojson, provincias)
+    ]
+
+
+def claves_municipios(geografia):
+    """ Municipios de la geografía con datos de criminalidad: codigo_ine, id_provincia, Municipio (nombre en los datos
+        de criminalidad) y municipio (nombre del INE). Si dos códigos tienen el mismo municipio en criminalidad
+        se queda el primero, así cada fila de datos tiene un solo polígono."""
+    claves = geografia.dropna(subset=["municipio_delitos"])
+    claves = pd.DataFrame({
+        "codigo_ine": claves["codigo_ine"].astype(str).to_numpy(),
+        "id_provincia": claves["id_provincia"].astype(int).to_numpy(),
+        "Municipio": claves["municipio_delitos"].astype(str).to_numpy(),
+        "municipio": claves["municipio"].astype(str).to_numpy(),
+    })
+    return claves.drop_duplicates(subset=["id_provincia", "Municipio"]).reset_index(drop=True)
+
+
+def codigos_ine(df, geografia):
+    # codigo_ine de cada fila de municipio de los datos de criminalidad, por su id de provincia y su nombre
+    claves = claves_municipios(geografia).set_index(["id_provincia", "Municipio"])["codigo_ine"]
+    filas = pd.MultiIndex.from_arrays([df["id_provincia"].astype(int), df["Municipio"].astype(str)])
+    return claves.reindex(filas).to_numpy()
+
+
+def cargar_municipios(path, geografia):
+    """ Devuelve {"puntos": GeoDataFrame, "poligonos": {zoom_minimo: GeoDataFrame}} con los municipios del geojson que
+        tienen datos de criminalidad, o None si no hay geojson. Cada municipio lleva su codigo_ine (la clave con la que
+        se cruza con los datos), id_provincia y Municipio (nombre en los datos de criminalidad), de la dimensión geografia.
+        Los índices espaciales se construyen aquí, una sola vez."""
+    ruta = os.path.join(path, FICHERO_MUNICIPIOS)
+    if not os.path.exists(ruta):
+        return None
+
+    gdf = gpd.read_file(ruta)
+    if COLUMNA_NOMBRE not in gdf.columns:
+        gdf[COLUMNA_NOMBRE] = None
+    codigos = codigos_geojson(gdf)
+    if codigos is None:
+        codigos = cruzar_municipios(gdf[COLUMNA_NOMBRE], provincias_geojson(path, gdf), geografia)
+    gdf = gdf[[COLUMNA_NOMBRE, "geometry"]].assign(codigo_ine=codigos)
+
+    gdf = gdf.merge(claves_municipios(geografia), on="codigo_ine")
+    gdf[COLUMNA_NOMBRE] = gdf[COLUMNA_NOMBRE].fillna(gdf.pop("municipio"))
+    gdf = gdf[~gdf.geometry.is_empty].drop_duplicates(subset=["codigo_ine"]).reset_index(drop=True)
+
+    poligonos = {
+        zoom: gdf.set_geometry(simplificar(gdf.geometry, tolerancia))
+        for zoom, tolerancia in TOLERANCIAS_POR_ZOOM.items() if zoom >= zoom_detalle(ZOOM_POLIGONOS_MUNICIPIOS)
+    }
+    for capa in poligonos.values():
+        capa.sindex
+    # representative_point cae siempre dentro del municipio (el centroide de un municipio con forma rara puede caer fuera)
+    puntos = gdf.set_geometry(gdf.geometry.representative_point())
+
+    return {"puntos": puntos, "poligonos": poligonos}
+
+
+def limites_aproximados(centro, zoom, ancho=1200, alto=800):
+    # Caja [[sur, oeste], [norte, este]] que se ve con ese centro y zoom en un mapa de ancho x alto píxeles (teselas de 256 px)
+    grados_por_pixel = 360 / (256 * 2 ** zoom)
+    lat, lng = centro
+    return [[lat - alto / 2 * grados_por_pixel, lng - ancho / 2 * grados_por_pixel],
+            [lat + alto / 2 * grados_por_pixel, lng + ancho / 2 * grados_por_pixel]]
+
+
+def ampliar_limites(limites, margen=MARGEN_VISTA):
+    (sur, oeste), (norte, este) = limites
+    alto, ancho = norte - sur, este - oeste
+    return [[sur - alto * margen, oeste - ancho * margen], [norte + alto * margen, este + ancho * margen]]
+
+
+def limites_contienen(exteriores, interiores):
+    (sur, oeste), (norte, este) = exteriores
+    (sur_i, oeste_i), (norte_i, este_i) = interiores
+    return sur <= sur_i and oeste <= oeste_i and norte >= norte_i and este >= este_i
+
+
+def detalle_capa(nivel, zoom):
+    # Zoom mínimo de la geometría que se pinta a ese zoom: todos los zooms que usan la misma capa dan el mismo valor
+    if nivel == "Municipio" and zoom < ZOOM_POLIGONOS_MUNICIPIOS:
+        return 0
+    return zoom_detalle(zoom)
+
+
+def capa_municipios(municipios, zoom):
+    # Puntos a poco zoom; con más zoom, los polígonos simplificados para ese zoom
+    if zoom < ZOOM_POLIGONOS_MUNICIPIOS:
+        return municipios["puntos"]
+    return municipios["poligonos"][zoom_detalle(zoom)]
+
+
+def filtrar_vista(capa, limites):
+    # Filas de la capa que cortan la caja limites = [[sur, oeste], [norte, este]], con su índice espacial.
+    # Se llama sobre las capas de cargar_municipios, que ya lo tienen construido (una copia cruzada con los datos no)
+    (sur, oeste), (norte, este) = limites
+    posiciones = capa.sindex.query(box(oeste, sur, este, norte), predicate="intersects")
+    return capa.iloc[sorted(posiciones)]
+
+
+def municipios_en_vista(municipios, zoom, limites):
+    """ Puntos de todos los municipios a poco zoom. Con más zoom, los polígonos (simplificados para ese zoom)
+        que cortan la caja limites. Se filtra antes de cruzar con los datos (cruzar_capa)."""
+    capa = capa_municipios(municipios, zoom)
+    if zoom < ZOOM_POLIGONOS_MUNICIPIOS:
+        return capa
+    return filtrar_vista(capa, limites)
@@ -0,0 +1,247 @@
+import os
+
+import almacen_datos
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+# =====================================================
+# CONSULTAS SQL (DUCKDB) SOBRE EL ALMACÉN
+# =====================================================
+# Motor opcional (pip install duckdb). Cada dataset del almacén es una vista sobre su fichero parquet: las consultas
+# leen del disco solo las columnas y los grupos de filas que necesitan (los filtros y la proyección se aplican al leer)
+# y se ejecutan en varios hilos, sin cargar antes el dataset en pandas. Devuelven lo mismo que el cálculo en pandas
+# equivalente de almacen_datos, así que la app puede usar uno u otro.
+
+DATASETS_SQL = ["criminalidad", "renta", "geografia", "delitos_renta"]
+
+# Filas de cada nivel geográfico (ver almacen_datos.nivel_geografico)
+CONDICIONES_NIVEL = {
+    "Comunidad": '"Provincia" IS NULL AND "Municipio" IS NULL',
+    "Provincia": '"Provincia" IS NOT NULL AND "Municipio" IS NULL',
+    "Municipio": '"Municipio" IS NOT NULL',
+}
+
+# Las mismas filas de renta que usa la app (las que tienen código INE)
+FILTRO_RENTA = "codigo_ine IS NOT NULL AND list_contains($comunidades, comunidad_autonoma)"
+
+
+def conectar(path):
+    """ Conexión en memoria con una vista por cada dataset que exista en el almacén. Para usarla desde varios hilos,
+        cada consulta abre su cursor (ver consultar)."""
+    con = duckdb.connect()
+    for nombre in DATASETS_SQL:
+        ruta = os.path.join(almacen_datos.ruta_almacen(path), almacen_datos.DATASETS[nombre])
+        if os.path.exists(ruta):
+            # file_row_number: posición de la fila en el fichero, para desempatar igual que pandas
+            ruta_sql = ruta.replace("'", "''")
+            con.execute(f"CREATE VIEW {nombre} AS SELECT * FROM read_parquet('{ruta_sql}', file_row_number = true)")
+    return con
+
+
+def consultar(con, sql, parametros=None):
+    return con.cursor().execute(sql, parametros or {}).df()
+
+
+def columna_renta(metrica):
+    # Los nombres de columna no pueden ir como parámetro: solo se aceptan las métricas conocidas
+    if metrica not in almacen_datos.METRICAS_RENTA:
+        raise ValueError(f"Métrica de renta desconocida: {metrica}")
+    return f'"{metrica}"'
+
+
+# =====================================================
+# CRIMINALIDAD
+# =====================================================
+# Orden de las filas de almacen_datos.vista_ancha
+ORDEN_VISTA = '"Comunidad", "Provincia" NULLS FIRST, "Municipio" NULLS FIRST, "Tipo Delito"'
+
+
+def anios(con):
+    # Años del modelo de criminalidad, sin cargarlo (como almacen_datos.anios_modelo)
+    return [int(anio) for anio in consultar(con, 'SELECT DISTINCT "Año" FROM criminalidad ORDER BY "Año"')["Año"]]
+
+
+def opciones_delitos(con, anio):
+    """ {columna: valores} de las columnas de región y del tipo de delito en las filas de la vista ancha del año,
+        en el mismo orden que las claves de almacen_datos.construir_indice_delitos (orden de aparición)."""
+    df = consultar(con, f"""
+        SELECT DISTINCT "Comunidad", "Provincia", "Municipio", "Tipo Delito"
+        FROM criminalidad WHERE "Año" IN ($anio, $anterior)
+        ORDER BY {ORDEN_VISTA}
+    """, {"anio": anio, "anterior": anio - 1})
+    return {col: list(df[col].dropna().unique()) for col in almacen_datos.NIVELES + ["Tipo Delito"]}
+
+
+def filtros_delitos(nivel=None, region=None, tipos_delito=()):
+    # Condiciones y parámetros de los filtros de la tabla, los mismos que almacen_datos.posiciones_filtro
+    condiciones, parametros = [], {}
+    if region is not None:
+        if nivel not in almacen_datos.NIVELES:
+            raise ValueError(f"Columna de región desconocida: {nivel}")
+        condiciones.append(f'"{nivel}" = $region')
+        parametros["region"] = region
+    elif nivel is not None:
+        condiciones.append(CONDICIONES_NIVEL[nivel])
+    if tipos_delito:
+        condiciones.append('list_contains($tipos_delito, "Tipo Delito")')
+        parametros["tipos_delito"] = list(tipos_delito)
+    return condiciones, parametros
+
+
+def variacion_sql(actual, anterior):
+    # Como almacen_datos.variacion: redondeo al par (el de numpy) y 0 entre 0 nulo (NaN en pandas)
+    return f"CASE WHEN {actual} = 0 AND {anterior} = 0 THEN NULL ELSE round_even(({actual} - {anterior}) / {anterior} * 100, 1) END"
+
+
+def filas_delitos(con, anio, nivel=None, region=None, tipos_delito=()):
+    # Número de filas de la vista ancha del año que cumplen los filtros
+    condiciones, parametros = filtros_delitos(nivel, region, tipos_delito)
+    return int(consultar(con, f"""
+        SELECT COUNT(*) AS filas FROM (
+            SELECT DISTINCT "Comunidad", "Provincia", "Municipio", "Tipo Delito"
+            FROM criminalidad WHERE {" AND ".join(['"Año" IN ($anio, $anterior)'] + condiciones)}
+        )
+    """, {"anio": anio, "anterior": anio - 1, **parametros})["filas"].iloc[0])
+
+
+def pagina_delitos(con, anio, columnas, orden, descendente, pagina, filas_por_pagina, nivel=None, region=None, tipos_delito=()):
+    """ Página de la tabla de criminalidad: las filas de la vista ancha del año que cumplen los filtros, ordenadas
+        como almacen_datos.orden_tabla (nulos al final, empates en el orden de la vista) y solo con las columnas
+        pedidas, como almacen_datos.pagina_tabla. pagina empieza en 0."""
+    anterior = anio - 1
+    validas = almacen_datos.columnas_ancha(anio)
+    for col in list(columnas) + [orden]:
+        if col not in validas:
+            raise ValueError(f"Columna desconocida: {col}")
+    condiciones, parametros = filtros_delitos(nivel, region, tipos_delito)
+
+    sumas = [
+        f'COALESCE(SUM("Valor") FILTER (WHERE "Año" = ${nombre} AND "Trimestre" = \'{trimestre}\'), 0) AS "{trimestre}{a}"'
+        for nombre, a in (("anio", anio), ("anterior", anterior)) for trimestre in almacen_datos.TRIMESTRES
+    ]
+    totales = [" + ".join(f'"{trimestre}{a}"' for trimestre in almacen_datos.TRIMESTRES) + f' AS "Total_{a}"' for a in (anio, anterior)]
+    variaciones = [
+        variacion_sql(f'"{trimestre}{anio}"', f'"{trimestre}{anterior}"') + f' AS "{trimestre}_VAR_{anio}_{anterior}"'
+        for trimestre in almacen_datos.TRIMESTRES
+    ] + [variacion_sql(f'"Total_{anio}"', f'"Total_{anterior}"') + f' AS "Variación_total_{anio}_{anterior}"']
+
+    return consultar(con, f"""
+        WITH ancha AS (
+            SELECT "Comunidad", "Provincia", "Municipio", "Tipo Delito", id_comunidad, id_provincia, {", ".join(sumas)}
+            FROM criminalidad
+            WHERE {" AND ".join(['"Año" IN ($anio, $anterior)'] + condiciones)}
+            GROUP BY ALL
+        ), con_totales AS (
+            SELECT *, {", ".join(totales)} FROM ancha
+        ), vista AS (
+            SELECT *, {", ".join(variaciones)} FROM con_totales
+        )
+        SELECT {", ".join(f'"{col}"' for col in columnas)}
+        FROM vista
+        ORDER BY "{orden}" {"DESC" if descendente else "ASC"} NULLS LAST, {ORDEN_VISTA}
+        LIMIT $limite OFFSET $desplazamiento
+    """, {"anio": anio, "anterior": anterior, "limite": filas_por_pagina, "desplazamiento": pagina * filas_por_pagina, **parametros})
+
+
+def vista_delitos(con, anio, trimestre="Total", nivel=None, tipo_delito=None, columna_region=None, region=None):
+    """ Filas de almacen_datos.vista_ancha con solo las columnas de un trimestre (o del total) del año:
+        las de almacen_datos.columnas_vista, con las claves y los ids de región.
+        Filtra por nivel geográfico de la fila, tipo de delito y valor de una columna de región (columna_region)."""
+    col_actual, col_anterior, col_var = almacen_datos.columnas_vista(trimestre, anio)
+    condiciones = ['"Año" IN ($anio, $anterior)']
+    parametros = {"anio": anio, "anterior": anio - 1}
+    # El trimestre va en el agregado y no en el WHERE: como en la vista ancha, las filas sin dato en él valen 0
+    filtro_trimestre = ""
+    if trimestre != "Total":
+        filtro_trimestre = ' AND "Trimestre" = $trimestre'
+        parametros["trimestre"] = trimestre
+    if nivel is not None:
+        condiciones.append(CONDICIONES_NIVEL[nivel])
+    if tipo_delito is not None:
+        condiciones.append('"Tipo Delito" = $tipo_delito')
+        parametros["tipo_delito"] = tipo_delito
+    if columna_region is not None:
+        if columna_region not in almacen_datos.NIVELES:
+            raise ValueError(f"Columna de región desconocida: {columna_region}")
+        condiciones.append(f'"{columna_region}" = $region')
+        parametros["region"] = region
+
+    df = consultar(con, f"""
+        SELECT "Comunidad", "Provincia", "Municipio", "Tipo Delito", id_comunidad, id_provincia,
+               COALESCE(SUM("Valor") FILTER (WHERE "Año" = $anio{filtro_trimestre}), 0) AS "{col_actual}",
+               COALESCE(SUM("Valor") FILTER (WHERE "Año" = $anterior{filtro_trimestre}), 0) AS "{col_anterior}"
+        FROM criminalidad
+        WHERE {" AND ".join(condiciones)}
+        GROUP BY ALL
+        ORDER BY {ORDEN_VISTA}
+    """, parametros)
+    df[col_var] = almacen_datos.variacion(df[col_actual], df[col_anterior])
+    return df
+
+
+# =====================================================
+# RENTA
+# =====================================================
+def resumen_renta(con, metrica, comunidades):
+    # (media, mediana, número de municipios con dato), como almacen_datos.resumen_renta
+    columna = columna_renta(metrica)
+    fila = consultar(con, f"""
+        SELECT AVG({columna}) AS media, MEDIAN({columna}) AS mediana, COUNT({columna}) AS municipios
+        FROM renta WHERE {FILTRO_RENTA}
+    """, {"comunidades": list(comunidades)}).iloc[0]
+    return fila["media"], fila["mediana"], int(fila["municipios"])
+
+
+def ranking_renta(con, metrica, comunidades, top_n):
+    # Los top_n municipios con mayor valor de la métrica en esas comunidades, como almacen_datos.ranking_renta
+    columna = columna_renta(metrica)
+    return consultar(con, f"""
+        SELECT * EXCLUDE (file_row_number)
+        FROM renta WHERE {FILTRO_RENTA} AND {columna} IS NOT NULL
+        ORDER BY {columna} DESC, file_row_number
+        LIMIT $top_n
+    """, {"comunidades": list(comunidades), "top_n": top_n})
+
+
+def comunidades_renta(con):
+    # Comunidades autónomas con municipios en la renta, en orden alfabético
+    return list(consultar(con, f"""
+        SELECT DISTINCT comunidad_autonoma FROM renta
+        WHERE codigo_ine IS NOT NULL AND comunidad_autonoma IS NOT NULL
+        ORDER BY comunidad_autonoma
+    """)["comunidad_autonoma"])
+
+
+# Columnas de la renta que se pueden pedir con columnas_renta, además de las métricas
+COLUMNAS_DESCRIPTIVAS_RENTA = ["Municipios", "codigo_ine", "provincia", "comunidad_autonoma"]
+
+
+def columnas_renta(con, columnas):
+    # Solo esas columnas de todos los municipios, en el orden del dataset (p. ej. para el gráfico de dispersión)
+    for col in columnas:
+        if col not in COLUMNAS_DESCRIPTIVAS_RENTA:
+            columna_renta(col)
+    return consultar(con, f"""
+        SELECT {", ".join(f'"{col}"' for col in columnas)} FROM renta
+        WHERE codigo_ine IS NOT NULL
+        ORDER BY file_row_number
+    """)
+
+
+def perfil_comunidades(con):
+    # Medias de renta por comunidad autónoma (pestaña de agrupación por comunidad), de mayor a menor renta por persona
+    return consultar(con, """
+        SELECT comunidad_autonoma,
+               AVG("Renta neta media por persona 2023") AS renta_neta_persona_2023,
+               AVG("Renta neta media por hogar 2023") AS renta_neta_hogar_2023,
+               AVG("Media de la renta por unidad de consumo 2023") AS renta_uc_media_2023,
+               AVG("Mediana de la renta por unidad de consumo 2023") AS renta_uc_mediana_2023,
+               COUNT("Municipios") AS municipios
+        FROM renta
+        WHERE codigo_ine IS NOT NULL AND comunidad_autonoma IS NOT NULL
+        GROUP BY comunidad_autonoma
+        ORDER BY renta_neta_persona_2023 DESC
+    """)
@@ -0,0 +1,68 @@
+import numpy as np
+import plotly.express as px
+import plotly.graph_objects as go
+
+# =====================================================
+# GRÁFICOS DE DISPERSIÓN CON PRESUPUESTO DE PUNTOS
+# =====================================================
+# Un gráfico de dispersión en SVG con un punto (y su texto de hover) por municipio tarda en pintarse en el navegador
+# y ocupa mucha memoria a partir de unos miles de puntos. Aquí se pinta siempre con WebGL (scattergl) y, si hay más
+# puntos que el presupuesto, se envía un mapa de densidad calculado en el servidor más los puntos sueltos de las zonas
+# poco densas. Al seleccionar una zona (zoom), se vuelve a calcular solo con sus puntos: con pocos, se ven todos.
+
+PUNTOS_MAXIMOS = 10000
+# Celdas por eje del mapa de densidad
+CELDAS_DENSIDAD = 100
+# Los puntos de celdas con como mucho estos puntos se pintan sueltos (con su hover) sobre la densidad
+PUNTOS_CELDA_AISLADA = 2
+
+
+def puntos_en_rango(df, x, y, rango=None):
+    # Filas con valor en los dos ejes y, si se pasa rango = [[x0, x1], [y0, y1]], dentro de él
+    mascara = df[x].notna() & df[y].notna()
+    if rango is not None:
+        (x0, x1), (y0, y1) = rango
+        mascara &= df[x].between(x0, x1) & df[y].between(y0, y1)
+    return df[mascara]
+
+
+def figura_densidad(datos, x, y, hover_name, titulo, maximo=PUNTOS_MAXIMOS):
+    valores_x = datos[x].to_numpy(dtype="float64")
+    valores_y = datos[y].to_numpy(dtype="float64")
+    conteos, bordes_x, bordes_y = np.histogram2d(valores_x, valores_y, bins=CELDAS_DENSIDAD)
+
+    # Celda de cada punto (el último borde es cerrado, como en histogram2d)
+    celda_x = np.clip(np.searchsorted(bordes_x, valores_x, side="right") - 1, 0, CELDAS_DENSIDAD - 1)
+    celda_y = np.clip(np.searchsorted(bordes_y, valores_y, side="right") - 1, 0, CELDAS_DENSIDAD - 1)
+    sueltos = datos[conteos[celda_x, celda_y] <= PUNTOS_CELDA_AISLADA].head(maximo)
+
+    fig = go.Figure()
+    fig.add_trace(go.Heatmap(
+        z=np.where(conteos.T > 0, conteos.T, np.nan),
+        x=(bordes_x[:-1] + bordes_x[1:]) / 2,
+        y=(bordes_y[:-1] + bordes_y[1:]) / 2,
+        colorscale="Blues",
+        colorbar={"title": "Puntos"},
+        hovertemplate="%{z:.0f} puntos<extra></extra>",
+    ))
+    fig.add_trace(go.Scattergl(
+        x=sueltos[x], y=sueltos[y], mode="markers", text=sueltos[hover_name],
+        marker={"size": 4, "color": "#d62728"}, name="Zonas poco densas",
+        hovertemplate="%{text}<br>%{x:,.0f} → %{y:,.0f}<extra></extra>",
+    ))
+    fig.update_layout(
+        title=f"{titulo} — densidad de {len(datos)} puntos",
+        xaxis_title=x, yaxis_title=y, dragmode="select", showlegend=False,
+    )
+    return fig
+
+
+def figura_dispersion(df, x, y, color, hover_name, titulo, maximo=PUNTOS_MAXIMOS, rango=None):
+    """ Devuelve (figura, densidad). Con hasta maximo puntos en el rango, un scattergl con todos ellos;
+        si hay más, el mapa de densidad (densidad=True)."""
+    datos = puntos_en_rango(df, x, y, rango)
+    if len(datos) > maximo:
+        return figura_densidad(datos, x, y, hover_name, titulo, maximo), True
+    fig = px.scatter(datos, x=x, y=y, color=color, hover_name=hover_name, title=titulo, render_mode="webgl")
+    fig.update_layout(dragmode="select")
+    return fig, False
@@ -0,0 +1,134 @@
+import re
+import unicodedata
+
+import numpy as np
+import pandas as pd
+
+# =====================================================
+# NOMENCLÁTOR DE COMUNIDADES Y PROVINCIAS
+# =====================================================
+# Cada fuente escribe las regiones a su manera: el ministerio del interior en mayúsculas y con el artículo detrás
+# ("MADRID (COMUNIDAD DE)", "Provincia de CORUÑA (A)"), el INE con coma ("Coruña, A") y los geojson con su propio
+# nombre ("Castilla-Leon", "Bizkaia/Vizcaya"). Aquí está, una sola vez, cada comunidad y provincia con un id entero
+# (su código INE), el nombre que usa la app y los alias que no salen de normalizar el nombre (ver claves_nombre).
+# Los nombres se pasan a id al ingerir los datos (una búsqueda por valor distinto, no por fila) y los cruces entre
+# fuentes se hacen por id.
+
+SIN_ID = -1
+
+# Id -> (nombre en la app, alias). Nacional y En el extranjero no son comunidades, pero el ministerio las publica como tales
+COMUNIDADES = {
+    0: ("Nacional", ()),
+    1: ("Andalucía", ()),
+    2: ("Aragón", ()),
+    3: ("Principado de Asturias", ("Asturias",)),
+    4: ("Illes Balears", ("Baleares",)),
+    5: ("Canarias", ()),
+    6: ("Cantabria", ()),
+    7: ("Castilla y León", ("Castilla-León",)),
+    8: ("Castilla-La Mancha", ()),
+    9: ("Cataluña", ("Catalunya",)),
+    10: ("Comunidad Valenciana", ("Comunitat Valenciana", "Valencia")),
+    11: ("Extremadura", ()),
+    12: ("Galicia", ()),
+    13: ("Comunidad de Madrid", ("Madrid",)),
+    14: ("Región de Murcia", ("Murcia",)),
+    15: ("Comunidad Foral de Navarra", ("Navarra",)),
+    16: ("País Vasco", ("Euskadi",)),
+    17: ("La Rioja", ()),
+    18: ("Ciudad Autónoma de Ceuta", ("Ceuta",)),
+    19: ("Ciudad Autónoma de Melilla", ("Melilla",)),
+    99: ("En el extranjero", ()),
+}
+
+# Id -> (nombre en la app, id de la comunidad, alias)
+PROVINCIAS = {
+    1: ("Álava", 16, ("Araba",)), 2: ("Albacete", 8, ()), 3: ("Alicante", 10, ("Alacant",)), 4: ("Almería", 1, ()),
+    5: ("Ávila", 7, ()), 6: ("Badajoz", 11, ()), 7: ("Baleares", 4, ("Illes Balears", "Balears (Las)")),
+    8: ("Barcelona", 9, ()), 9: ("Burgos", 7, ()), 10: ("Cáceres", 11, ()), 11: ("Cádiz", 1, ()),
+    12: ("Castellón", 10, ("Castelló",)), 13: ("Ciudad Real", 8, ()), 14: ("Córdoba", 1, ()),
+    15: ("A Coruña", 12, ("La Coruña",)), 16: ("Cuenca", 8, ()), 17: ("Girona", 9, ("Gerona",)), 18: ("Granada", 1, ()),
+    19: ("Guadalajara", 8, ()), 20: ("Gipuzkoa", 16, ("Guipúzcoa",)), 21: ("Huelva", 1, ()), 22: ("Huesca", 2, ()),
+    23: ("Jaén", 1, ()), 24: ("León", 7, ()), 25: ("Lleida", 9, ("Lérida",)), 26: ("La Rioja", 17, ()),
+    27: ("Lugo", 12, ()), 28: ("Madrid", 13, ()), 29: ("Málaga", 1, ()), 30: ("Murcia", 14, ()), 31: ("Navarra", 15, ()),
+    32: ("Ourense", 12, ("Orense",)), 33: ("Asturias", 3, ()), 34: ("Palencia", 7, ()), 35: ("Las Palmas", 5, ()),
+    36: ("Pontevedra", 12, ()), 37: ("Salamanca", 7, ()), 38: ("Santa Cruz de Tenerife", 5, ()), 39: ("Cantabria", 6, ()),
+    40: ("Segovia", 7, ()), 41: ("Sevilla", 1, ()), 42: ("Soria", 7, ()), 43: ("Tarragona", 9, ()), 44: ("Teruel", 2, ()),
+    45: ("Toledo", 8, ()), 46: ("Valencia", 10, ("València",)), 47: ("Valladolid", 7, ()), 48: ("Bizkaia", 16, ("Vizcaya",)),
+    49: ("Zamora", 7, ()), 50: ("Zaragoza", 2, ()), 51: ("Ceuta", 18, ()), 52: ("Melilla", 19, ()),
+}
+
+# Columna con el id de cada nivel en los datasets que tienen la columna del nivel
+COLUMNAS_ID = {"Comunidad": "id_comunidad", "Provincia": "id_provincia"}
+
+NOMBRES = {
+    "Comunidad": {id_: nombre for id_, (nombre, _) in COMUNIDADES.items()},
+    "Provincia": {id_: nombre for id_, (nombre, _, _) in PROVINCIAS.items()},
+}
+COMUNIDAD_DE_PROVINCIA = {id_: comunidad for id_, (_, comunidad, _) in PROVINCIAS.items()}
+
+# Comunidades autónomas (no las ciudades autónomas) con una sola provincia: nombre de la comunidad -> de la provincia.
+# En los datos del ministerio no aparece la combinación comunidad-provincia de estas comunidades
+PROVINCIA_UNICA = {
+    NOMBRES["Comunidad"][comunidad]: nombre
+    for comunidad in range(1, 18)
+    if len(provincias := [nombre for nombre, c, _ in PROVINCIAS.values() if c == comunidad]) == 1
+    for nombre in provincias
+}
+
+
+def variantes_nombre(nombre):
+    """ Formas normalizadas de un nombre de municipio, para cruzar fuentes que lo escriben distinto.
+        "Rozas de Madrid (Las)", "Rozas de Madrid, Las" y "Las Rozas de Madrid" dan "las rozas de madrid".
+        Los nombres bilingües ("Elche/Elx") dan una variante por idioma."""
+    variantes = set()
+    for parte in str(nombre).split("/"):
+        parte = parte.strip()
+        articulo = re.match(r"^(.*?)\s*(?:\((.+)\)|,\s*(.+))$", parte)
+        if articulo:
+            parte = f"{articulo.group(2) or articulo.group(3)} {articulo.group(1)}"
+        parte = unicodedata.normalize("NFKD", parte).encode("ascii", "ignore").decode().lower()
+        parte = " ".join(re.sub(r"[^a-z0-9']", " ", parte).split()).replace("' ", "'")
+        if parte:
+            variantes.add(parte)
+    return variantes
+
+
+def claves_nombre(nombre):
+    # Claves de búsqueda de una región: las variantes de su nombre sin el "Provincia de" del ministerio.
+    # Sin mayúsculas ni acentos, con el artículo delante y los guiones como espacios ("castilla la mancha")
+    return variantes_nombre(re.sub(r"^\s*provincia de\s+", "", str(nombre), flags=re.IGNORECASE))
+
+
+def construir_indice(regiones):
+    # {clave: id} con el nombre y los alias de cada región. Dos regiones con la misma clave son un error del nomenclátor
+    indice = {}
+    for id_, (nombre, *_, alias) in regiones.items():
+        for clave in set().union(*(claves_nombre(n) for n in (nombre, *alias))):
+            if indice.setdefault(clave, id_) != id_:
+                raise ValueError(f"La clave '{clave}' es de dos regiones: {indice[clave]} y {id_}")
+    return indice
+
+
+INDICE = {"Comunidad": construir_indice(COMUNIDADES), "Provincia": construir_indice(PROVINCIAS)}
+
+
+def id_region(nivel, nombre):
+    # Id de una comunidad o provincia por cualquiera de sus nombres (SIN_ID si no está)
+    return next((INDICE[nivel][clave] for clave in sorted(claves_nombre(nombre)) if clave in INDICE[nivel]), SIN_ID)
+
+
+def ids_region(nivel, valores):
+    """ Array int8 con el id de cada valor (SIN_ID para nulos y nombres desconocidos).
+        Se busca una vez cada valor distinto y se reparte con sus códigos."""
+    codigos, distintos = pd.factorize(pd.Series(valores))
+    ids = np.array([id_region(nivel, valor) for valor in distintos] + [SIN_ID], dtype="int8")
+    # Los nulos tienen código -1: el último elemento
+    return ids[codigos]
+
+
+def nombres_region(nivel, valores):
+    # Nombre de la app de cada valor. Los que no están en el nomenclátor se dejan como vienen
+    valores = pd.Series(valores)
+    ids = pd.Series(ids_region(nivel, valores), index=valores.index)
+    return ids.map(NOMBRES[nivel]).where(ids != SIN_ID, valores.astype(object))
@@ -2,11 +2,19 @@ import pandas as pd
 import requests
 import selenium
 import os
-from io import StringIO
-
-import time
-
+import re
+import sys
+import json
+import hashlib
+import queue
+import threading
+import functools
+from io import StringIO, BytesIO
+from urllib.parse import urljoin, urlparse, parse_qs
+
+import numpy as np
 from bs4 import BeautifulSoup
+from lxml import etree
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions as EC
@@ -14,119 +22,152 @@ from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support.ui import Select
 from selenium.webdriver.chrome.service import Service
 from webdriver_manager.chrome import ChromeDriverManager
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import almacen_datos
+import nomenclator
+import traza_scraping
 
 #Se ha decidido que se van a obtener los datos para 2022 y 2023. Esto es principalmente porque los datos de renta limitan la fecha más reciente.
 
-def reestructurar_excel_datos_criminalidad(df, trimestre):
-    def esta_en_mayusculas(s):
-        return isinstance(s, str) and any(c.isalpha() for c in s) and s.isupper()
+CATEGORIAS_DELITO = {"I. CRIMINALIDAD CONVENCIONAL",
+                     "II. CIBERCRIMINALIDAD (infracciones penales cometidas en/por medio ciber)",
+                     "III. TOTAL INFRACCIONES PENALES"}
+
+PREFIJOS_MUNICIPIO = ("-Municipio de", "Municipio de", "Municipo de", "Isla de", "-Municipo de", "CIUDAD AUTÓNOMA")
 
+
+def anios_tabla_criminalidad(df, trimestre):
+    # Años de la tabla en el orden de sus columnas "<trimestre> <año>" (p. ej. "Enero-Marzo 2023"), del mas reciente al mas antiguo
+    return [m.group(1) for col in df.columns if (m := re.fullmatch(rf"{re.escape(trimestre)} (\d{{4}})", str(col)))]
+
+
+def reestructurar_excel_datos_criminalidad(df, trimestre):
+    """ La tabla del ministerio mezcla en la primera columna las cabeceras de la jerarquia (comunidad, provincia, municipio)
+        con los tipos de delito. En vez de recorrerla fila a fila, se clasifica cada fila con mascaras de texto,
+        se rellena hacia abajo la jerarquia (ffill) y se convierten las columnas numericas de una vez.
+        Los años salen de las columnas de la tabla: una columna "Dato <año>" por año y "Variación <año>/<año anterior>".
+        Da el mismo resultado que la versión original fila a fila (ver benchmark.py)."""
     trimestre = trimestre.replace("_", "-")
-    # Renombrar columna
     df = df.rename(columns={"Unnamed: 0": "Texto"})
-
-    tratamiento_especial = {
-        "CIUDAD AUTÓNOMA DE CEUTA",
-        "CIUDAD AUTÓNOMA DE MELILLA",
-        "EN EL EXTRANJERO",
-        "NACIONAL"
+    anios = anios_tabla_criminalidad(df, trimestre)
+
+    texto = df["Texto"]
+    es_texto = texto.map(lambda x: isinstance(x, str))
+    texto_str = texto.where(es_texto, "").astype(str)
+
+    # Clasificacion de las filas. El orden de prioridad es el mismo que en la version iterativa
+    es_mayusculas = texto_str.str.isupper() & texto_str.str.contains(r"[^\W\d_]", regex=True)
+    es_comunidad = es_texto & es_mayusculas & ~texto_str.isin(CATEGORIAS_DELITO)
+    es_provincia = es_texto & ~es_comunidad & texto_str.str.startswith("Provincia de")
+    es_municipio = es_texto & ~es_comunidad & ~es_provincia & texto_str.str.startswith(PREFIJOS_MUNICIPIO)
+    es_dato = ~es_comunidad & ~es_provincia & ~es_municipio & df[f"{trimestre} {anios[-1]}"].notna()
+
+    # Cada comunidad reinicia provincia y municipio, y cada provincia reinicia el municipio
+    comunidad = texto.where(es_comunidad).ffill()
+    provincia = texto.where(es_provincia).groupby(es_comunidad.cumsum()).ffill()
+    municipio = texto_str.str.lstrip("-").where(es_municipio).groupby((es_comunidad | es_provincia).cumsum()).ffill()
+
+    def a_none(col):
+        col = col[es_dato].astype(object)
+        return col.where(col.notna(), None).reset_index(drop=True)
+
+    def numerica(col):
+        return pd.to_numeric(df.loc[es_dato, col], errors='coerce').reset_index(drop=True)
+
+    columnas = {
+        "Comunidad": a_none(comunidad),
+        "Provincia": a_none(provincia),
+        "Municipio": a_none(municipio),
+        "Tipo Delito": texto[es_dato].reset_index(drop=True),
+        "Trimestre": trimestre,
     }
+    for anio in anios:
+        columnas[f"Dato {anio}"] = numerica(f"{trimestre} {anio}")
+    for col in df.columns:
+        if str(col).startswith("Variación % "):
+            columnas[col.replace("Variación % ", "Variación ")] = numerica(col)
+    df_final = pd.DataFrame(columnas)
 
-    datos = {
-        "Comunidad": [],
-        "Provincia": [],
-        "Municipio": [],
-        "Tipo Delito": [],
-        "Trimestre": [],
-        "Dato 2023": [],
-        "Dato 2022": [],
-        "Variación 2023/2022": []
-    }
+    # Ordenar
+    df_final = df_final.sort_values(
+        by=["Comunidad", "Provincia", "Municipio", "Tipo Delito"],
+        key=lambda col: col.fillna('')
+    ).reset_index(drop=True)
 
-    comunidad = None
-    provincia = None
-    municipio = None
+    return df_final
 
-    for _, row in df.iterrows():
-        texto = row["Texto"]
 
-        # Comunidades y especiales
-        if esta_en_mayusculas(texto) and texto not in {"I. CRIMINALIDAD CONVENCIONAL",
-                                                      "II. CIBERCRIMINALIDAD (infracciones penales cometidas en/por medio ciber)",
-                                                      "III. TOTAL INFRACCIONES PENALES"}:
-            comunidad = texto
-            provincia = None
-            municipio = None
-            continue
+# =====================================================
+# ESPERAS ADAPTATIVAS DE SELENIUM
+# =====================================================
+# Entre accion y accion habia pausas fijas de 0.7s, y WebDriverWait(browser, 10) comprueba la condicion cada 0.5s.
+# Ahora se espera a una condicion concreta (elemento clicable, pagina cargada, acordeon abierto) comprobada cada
+# POLL_ESPERA segundos. Cada espera, clic y navegacion queda en la traza (ver traza_scraping.py); las esperas que
+# sustituyen a una pausa fija apuntan la pausa para comparar lo que tardan con lo que costaba la pausa.
+TIEMPO_MAXIMO_ESPERA = 10
+POLL_ESPERA = 0.1
+PAUSA_FIJA = 0.7
 
-        # Provincias
-        if isinstance(texto, str) and texto.startswith("Provincia de"):
-            provincia = texto
-            municipio = None
-            continue
 
-        # Municipios
-        if isinstance(texto, str) and (
-            texto.startswith("-Municipio de") or texto.startswith("Municipio de") or
-            texto.startswith("Municipo de") or texto.startswith("Isla de") or
-            texto.startswith("-Municipo de") or texto.startswith("CIUDAD AUTÓNOMA")
-        ):
-            municipio = texto.lstrip("-")
-            continue
+def esperar(browser, condicion, objetivo="", sustituye=None, timeout=TIEMPO_MAXIMO_ESPERA):
+    datos = {} if sustituye is None else {"sustituye": sustituye}
+    with traza_scraping.paso("esperar", objetivo, **datos):
+        return WebDriverWait(browser, timeout, poll_frequency=POLL_ESPERA).until(condicion)
 
-        # Filas con datos (incluyendo categorías I, II, III)
-        if pd.notna(row[f"{trimestre} 2022"]):
-            datos["Comunidad"].append(comunidad)
-            datos["Provincia"].append(provincia)
-            datos["Municipio"].append(municipio)
-            datos["Tipo Delito"].append(texto)
-            datos["Trimestre"].append(trimestre)
-            datos["Dato 2023"].append(pd.to_numeric(row[f"{trimestre} 2023"], errors='coerce'))
-            datos["Dato 2022"].append(pd.to_numeric(row[f"{trimestre} 2022"], errors='coerce'))
-            datos["Variación 2023/2022"].append(pd.to_numeric(row["Variación % 2023/2022"], errors='coerce'))
 
-    df_final = pd.DataFrame(datos)
+def pagina_lista(browser):
+    # Documento cargado, sin peticiones ajax pendientes (jQuery) y sin desplegables de bootstrap a medio abrir o cerrar
+    return browser.execute_script(
+        "return document.readyState === 'complete' && (!window.jQuery || jQuery.active === 0)"
+        " && !document.querySelector('.collapsing')"
+    )
 
-    # None en lugar de "Columna Vacía"
-    df_final["Provincia"] = df_final["Provincia"].where(df_final["Provincia"].notna(), None)
-    df_final["Municipio"] = df_final["Municipio"].where(df_final["Municipio"].notna(), None)
 
-    # Ordenar
-    df_final = df_final.sort_values(
-        by=["Comunidad", "Provincia", "Municipio", "Tipo Delito"],
-        key=lambda col: col.fillna('')
-    ).reset_index(drop=True)
+def esperar_pagina(browser, objetivo=""):
+    # Sustituye a las pausas fijas que habia despues de cada accion
+    return esperar(browser, pagina_lista, objetivo, sustituye=PAUSA_FIJA)
 
-    return df_final
+
+def navegar(browser, url):
+    with traza_scraping.paso("navegar", url):
+        browser.get(url = url)
+
+
+def clicar(elemento, objetivo=""):
+    with traza_scraping.paso("clicar", objetivo):
+        elemento.click()
 
 
-def obtener_datos_ine_rentas(path):
+def leer_tabla_navegador(browser, id_tabla):
+    # outerHTML de la tabla ya cargada en el navegador
+    with traza_scraping.paso("descargar", id_tabla) as evento:
+        html = browser.find_element(By.ID, id_tabla).get_attribute("outerHTML")
+        evento["bytes"] = len(html.encode("utf-8"))
+    return html
+
+
+def obtener_urls_provincias_rentas(browser):
+    # Navega por el arbol del INE y devuelve {nombre_provincia: url} con la pagina de renta media y mediana de cada provincia
 
     url_ine_datos_demograficos = 'https://www.ine.es/dynt3/inebase/index.htm?padre=12385'
 
     
-    browser = webdriver.Chrome(service=Service(ChromeDriverManager().install()))
-    browser.maximize_window()
-    browser.get(url = url_ine_datos_demograficos)
+    navegar(browser, url_ine_datos_demograficos)
 
     
-    desplegar_resultados_por_municipios = (WebDriverWait(browser, 10)
-                      .until(EC.element_to_be_clickable((By.CSS_SELECTOR, 'a#c_12384'))))
-    desplegar_resultados_por_municipios.click()
+    desplegar_resultados_por_municipios = esperar(browser, EC.element_to_be_clickable((By.CSS_SELECTOR, 'a#c_12384')), "c_12384")
+    clicar(desplegar_resultados_por_municipios, "c_12384")
 
-    desplegar_resultados_por_municipios_continuacion = (WebDriverWait(browser, 10)
-                      .until(EC.element_to_be_clickable((By.CSS_SELECTOR, 'a#c_7132'))))
-    desplegar_resultados_por_municipios_continuacion.click()
+    desplegar_resultados_por_municipios_continuacion = esperar(browser, EC.element_to_be_clickable((By.CSS_SELECTOR, 'a#c_7132')), "c_7132")
+    clicar(desplegar_resultados_por_municipios_continuacion, "c_7132")
 
     # Todas las provincias
     # 1. Hay que hacer click en cada desplegable para que carguen las opciones.
     # 2. Dentro de cada provincia, se clica en los indicadores de renta media y mediana. Esto te lleva a otra página
 
-    WebDriverWait(browser, 10).until(
-    EC.presence_of_element_located(
-        (By.CSS_SELECTOR, "a#c_7132 + ul.subSecc")
-    )
-    )
+    esperar(browser, EC.presence_of_element_located((By.CSS_SELECTOR, "a#c_7132 + ul.subSecc")), "provincias")
 
     ###############
     # EXPLICACIÓN #
@@ -163,15 +204,15 @@ def obtener_datos_ine_rentas(path):
             print(f"{nombre}")
 
             if expanded == "false":
-                provincia.click()
+                clicar(provincia, nombre)
 
-                WebDriverWait(browser, 10).until(EC.presence_of_element_located((By.CSS_SELECTOR, f"a#{provincia.get_attribute('id')} + ul.subSecc")))
+                esperar(browser, EC.presence_of_element_located((By.CSS_SELECTOR, f"a#{provincia.get_attribute('id')} + ul.subSecc")), nombre)
 
                 #Ahora es cuando clicamos en "Indicadores de renta media y mediana"
                 # <ul> -> <li>,<li>...
                 # Unicamente quiero el primer elemento <li>
-                desplegar_resultados_por_municipios_continuacion = (WebDriverWait(browser, 10)
-                      .until(EC.element_to_be_clickable((By.CSS_SELECTOR, f"a#{provincia.get_attribute('id')} + ul.subSecc > li:first-child > a"))))
+                desplegar_resultados_por_municipios_continuacion = esperar(
+                    browser, EC.element_to_be_clickable((By.CSS_SELECTOR, f"a#{provincia.get_attribute('id')} + ul.subSecc > li:first-child > a")), nombre)
                 
                 #Guardar las urls como he explicado antes
                 diccionario_de_urls.update({nombre : desplegar_resultados_por_municipios_continuacion.get_attribute("href")})
@@ -184,26 +225,43 @@ def obtener_datos_ine_rentas(path):
     if len(diccionario_de_urls) != len(provincias): 
         raise Exception("Falta alguna provincia")
 
-    #Recorremos el diccionario para obtener los datos de las provincias. 2022 y 2023
+    return diccionario_de_urls
 
-    for nombre_provincia, url_datos_provincia in diccionario_de_urls.items():
-        print(nombre_provincia, url_datos_provincia)
-        nombre_provincia = nombre_provincia.replace("/", "_").replace(",", "")
-        
-        browser.get(url = url_datos_provincia)
 
-        tabla_valores = browser.find_element(
-                By.CSS_SELECTOR, "ul.secciones > li > ul#variables"
-            )
-        browser.execute_script(
-                "arguments[0].scrollIntoView({block:'center'});", tabla_valores
-            )
-        
-        # Ahora seleccionamos las opciones en cada una de las tablas.
-        # De indicadores seleccionamos todos y de fechas unicamente 2023 y 2022
-        # De unidades territoriales seleccionamos unicamente los municipios.
-        # Para una futura implementacion (ya lo hice en mi tfg), se podría seleccionar hasta secciones censales.
+INDICADORES_RENTA = ["Renta neta media por persona", "Renta neta media por hogar",
+                     "Media de la renta por unidad de consumo", "Mediana de la renta por unidad de consumo",
+                     "Renta bruta media por persona", "Renta bruta media por hogar"]
+
+COLUMNAS_RENTA = ["Municipios"] + [f"{indicador} {anio}" for indicador in INDICADORES_RENTA for anio in ("2023", "2022")]
+
 
+def ruta_excel_renta(nombre_provincia, path):
+    nombre_provincia = nombre_provincia.replace("/", "_").replace(",", "")
+    return path + fr"\{nombre_provincia.lower()}_datos_rentas.xlsx"
+
+
+def guardar_renta_provincia(df_tabla_final, nombre_provincia, path):
+    df_tabla_final.to_excel(ruta_excel_renta(nombre_provincia, path))
+
+
+def descargar_datos_renta_provincia(browser, nombre_provincia, url_datos_provincia, path):
+    print(nombre_provincia, url_datos_provincia)
+
+    navegar(browser, url_datos_provincia)
+
+    tabla_valores = browser.find_element(
+            By.CSS_SELECTOR, "ul.secciones > li > ul#variables"
+        )
+    browser.execute_script(
+            "arguments[0].scrollIntoView({block:'center'});", tabla_valores
+        )
+
+    # Ahora seleccionamos las opciones en cada una de las tablas.
+    # De indicadores seleccionamos todos y de fechas unicamente 2023 y 2022
+    # De unidades territoriales seleccionamos unicamente los municipios: la tabla html con las secciones censales
+    # es demasiado grande. Los distritos y las secciones se obtienen con la descarga HTTP (descargar_datos_renta_provincia_http).
+
+    with traza_scraping.paso("clicar", "formulario de renta"):
         tabla_periodo = browser.find_element(By.CSS_SELECTOR, "ul#variables select#periodo")
         select_tabla_periodo = Select(tabla_periodo)
         select_tabla_periodo.select_by_value("28~2023")
@@ -211,92 +269,436 @@ def obtener_datos_ine_rentas(path):
 
         tabla_indicadores_renta_media_y_mediana = browser.find_element(By.CSS_SELECTOR, "ul#variables select.cajaVariables")
         select_tabla_indicadores_renta_media_y_mediana = Select(tabla_indicadores_renta_media_y_mediana)
-        select_tabla_indicadores_renta_media_y_mediana.select_by_visible_text("Renta neta media por persona")
-        select_tabla_indicadores_renta_media_y_mediana.select_by_visible_text("Renta neta media por hogar")
-        select_tabla_indicadores_renta_media_y_mediana.select_by_visible_text("Media de la renta por unidad de consumo")
-        select_tabla_indicadores_renta_media_y_mediana.select_by_visible_text("Mediana de la renta por unidad de consumo")
-        select_tabla_indicadores_renta_media_y_mediana.select_by_visible_text("Renta bruta media por persona")
-        select_tabla_indicadores_renta_media_y_mediana.select_by_visible_text("Renta bruta media por hogar")
+        for indicador in INDICADORES_RENTA:
+            select_tabla_indicadores_renta_media_y_mediana.select_by_visible_text(indicador)
 
         input_distritos = browser.find_element(By.CSS_SELECTOR, "ul#variables input#selCri_1")
         input_distritos.click()
         input_secciones = browser.find_element(By.CSS_SELECTOR, "ul#variables input#selCri_2")
         input_secciones.click()
-        
-        # Para aceptar el boton de cookies.
-        try:
-            boton_cookies = WebDriverWait(browser, 10).until(
-                EC.element_to_be_clickable((By.CSS_SELECTOR, "a#aceptarCookie"))
-            )
-            boton_cookies.click()
 
-            # esperar a que desaparezca el banner
-            WebDriverWait(browser, 10).until(
-                EC.invisibility_of_element_located((By.CSS_SELECTOR, "a#aceptarCookie"))
-            )
-        except:
-            pass
+    # Para aceptar el boton de cookies.
+    try:
+        boton_cookies = esperar(browser, EC.element_to_be_clickable((By.CSS_SELECTOR, "a#aceptarCookie")), "cookies")
+        clicar(boton_cookies, "cookies")
+
+        # esperar a que desaparezca el banner
+        esperar(browser, EC.invisibility_of_element_located((By.CSS_SELECTOR, "a#aceptarCookie")), "cookies")
+    except:
+        pass
 
-        #Una vez seleccionadas las opciones, le damos al boton de "consultar selección"
-        boton_consultar_seleccion = browser.find_element(By.CSS_SELECTOR, "input#botonConsulSele")
-        boton_consultar_seleccion.click()
+    #Una vez seleccionadas las opciones, le damos al boton de "consultar selección"
+    boton_consultar_seleccion = browser.find_element(By.CSS_SELECTOR, "input#botonConsulSele")
+    clicar(boton_consultar_seleccion, "consultar selección")
 
-        url_con_datos_provincia = browser.current_url
-        print(f"La url donde esta la tabla con los resultados es: {url_con_datos_provincia}")
+    url_con_datos_provincia = browser.current_url
+    print(f"La url donde esta la tabla con los resultados es: {url_con_datos_provincia}")
 
-        #Esperamos a que la tabla con los datos esté cargada
-        WebDriverWait(browser, 10).until(EC.presence_of_element_located((By.ID, "tablaDatos")))
+    #Esperamos a que la tabla con los datos esté cargada
+    esperar(browser, EC.presence_of_element_located((By.ID, "tablaDatos")), "tablaDatos")
 
-        # Para leer la tabla utilizare beautifulsoup. La tabla esta localizada en el elemento <table id=tablaDatos>.
-        # Dentro de esta tabla hay un thead con los nombres de las columnas y un tbody con los datos. Cada fila es un municipio
-        html_tabla = browser.find_element(By.ID, "tablaDatos").get_attribute("outerHTML")
+    # Para leer la tabla utilizare beautifulsoup. La tabla esta localizada en el elemento <table id=tablaDatos>.
+    # Dentro de esta tabla hay un thead con los nombres de las columnas y un tbody con los datos. Cada fila es un municipio
+    html_tabla = leer_tabla_navegador(browser, "tablaDatos")
+    with traza_scraping.paso("parsear", "tablaDatos"):
         web_tabla_con_datos_provincia = BeautifulSoup(html_tabla, "html.parser")
         table = web_tabla_con_datos_provincia.select("table#tablaDatos")[0]
-        df_tabla_final = pd.read_html(str(table), header=0, decimal=",", thousands=".")[0]
-
-        df_tabla_final.columns = ["Municipios", 
-                                  "Renta neta media por persona 2023", "Renta neta media por persona 2022",
-                                  "Renta neta media por hogar 2023", "Renta neta media por hogar 2022",
-                                  "Media de la renta por unidad de consumo 2023", "Media de la renta por unidad de consumo 2022",
-                                  "Mediana de la renta por unidad de consumo 2023", "Mediana de la renta por unidad de consumo 2022",
-                                  "Renta bruta media por persona 2023", "Renta bruta media por persona 2022",
-                                  "Renta bruta media por hogar 2023", "Renta bruta media por hogar 2022"]
-        df_tabla_final = df_tabla_final[1:]
-        df_tabla_final.to_excel(path + fr"\{nombre_provincia.lower()}_datos_rentas.xlsx")
-
-    browser.close()
+        df_tabla_final = pd.read_html(StringIO(str(table)), header=0, decimal=",", thousands=".")[0]
+
+    df_tabla_final.columns = COLUMNAS_RENTA
+    df_tabla_final = df_tabla_final[1:]
+    with traza_scraping.paso("escribir", nombre_provincia):
+        guardar_renta_provincia(df_tabla_final, nombre_provincia, path)
+
+
+URL_CSV_TABLA_INE = "https://www.ine.es/jaxiT3/files/t/es/csv_bdsc/{tabla}.csv?nocab=1"
+
+
+@functools.lru_cache(maxsize=None)
+def ruta_chromedriver():
+    # Solo se descarga el driver la primera vez que hace falta un navegador
+    return ChromeDriverManager().install()
+
+
+def crear_navegador(headless=False):
+    # Los workers del pool usan Chrome en modo headless. La version serie mantiene la ventana visible como antes
+    opciones = webdriver.ChromeOptions()
+    if headless:
+        opciones.add_argument("--headless=new")
+        opciones.add_argument("--window-size=1920,1080")
+    browser = webdriver.Chrome(service=Service(ruta_chromedriver()), options=opciones)
+    if not headless:
+        browser.maximize_window()
+    return browser
+
+
+# Para la actualizacion incremental se guarda, por cada tabla descargada, su ETag, Last-Modified y hash del contenido
+FICHERO_FUENTES = "fuentes_descarga.json"
+
+
+def leer_fuentes(path):
+    ruta = os.path.join(path, FICHERO_FUENTES)
+    if not os.path.exists(ruta):
+        return {}
+    with open(ruta, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def guardar_fuentes(path, fuentes):
+    with open(os.path.join(path, FICHERO_FUENTES), "w", encoding="utf-8") as f:
+        json.dump(fuentes, f, ensure_ascii=False, indent=2)
+
+
+def cabeceras_condicionales(info_fuente):
+    # Si el servidor las soporta, contesta 304 sin cuerpo cuando la tabla no ha cambiado
+    cabeceras = {}
+    if info_fuente:
+        if info_fuente.get("etag"):
+            cabeceras["If-None-Match"] = info_fuente["etag"]
+        if info_fuente.get("last_modified"):
+            cabeceras["If-Modified-Since"] = info_fuente["last_modified"]
+    return cabeceras
+
+
+def comprobar_cambio(respuesta, info_fuente):
+    """ Devuelve (cambiado, info) comparando la respuesta con la descarga anterior.
+        Si el servidor no soporta peticiones condicionales, se compara el hash del contenido."""
+    if respuesta.status_code == 304 and info_fuente:
+        return False, info_fuente
+    respuesta.raise_for_status()
+    info = {
+        "etag": respuesta.headers.get("ETag"),
+        "last_modified": respuesta.headers.get("Last-Modified"),
+        "sha256": hashlib.sha256(respuesta.content).hexdigest(),
+    }
+    return info_fuente is None or info["sha256"] != info_fuente.get("sha256"), info
+
+
+def crear_sesion(tamanio_pool=10):
+    # Sesion HTTP con conexiones reutilizables y reintentos automaticos ante errores del servidor
+    sesion = requests.Session()
+    reintentos = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+    adaptador = HTTPAdapter(pool_connections=tamanio_pool, pool_maxsize=tamanio_pool, max_retries=reintentos)
+    sesion.mount("http://", adaptador)
+    sesion.mount("https://", adaptador)
+    sesion.headers.update({"User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36"})
+    return sesion
+
+
+def codificacion_respuesta(respuesta):
+    # Si el servidor no indica el charset, requests asume latin-1 y se rompen las tildes
+    if "charset" not in respuesta.headers.get("Content-Type", "").lower():
+        respuesta.encoding = respuesta.apparent_encoding
+    return respuesta.encoding
+
+
+def texto_respuesta(respuesta):
+    respuesta.raise_for_status()
+    codificacion_respuesta(respuesta)
+    return respuesta.text
+
+
+def obtener_html(sesion, url):
+    with traza_scraping.paso("navegar", url) as evento:
+        return texto_respuesta(traza_scraping.anotar_respuesta(evento, sesion.get(url, timeout=60)))
+
+
+def parsear_csv_renta(contenido):
+    """ Tabla con COLUMNAS_RENTA (una fila por municipio, distrito y seccion censal) a partir de la exportacion CSV
+        de una tabla de renta del INE: años 2023 y 2022 y los 6 indicadores de renta."""
+    df = pd.read_csv(StringIO(contenido.decode("utf-8-sig")), sep=";", dtype=str)
+    df.columns = [col.strip() for col in df.columns]
+
+    col_indicador = next(col for col in df.columns if col.startswith("Indicadores"))
+    df[col_indicador] = df[col_indicador].str.strip()
+    # Cada fila es de la unidad mas pequeña que tiene rellena: seccion, distrito o municipio
+    for col in ("Distritos", "Secciones"):
+        if col in df.columns:
+            df["Municipios"] = df[col].fillna(df["Municipios"])
+    df = df[df["Municipios"].str.match(r"^\d{5}(\d{2}(\d{3})?)? ", na=False)
+            & df["Periodo"].isin(["2023", "2022"])
+            & df[col_indicador].isin(INDICADORES_RENTA)].copy()
+    df["Total"] = pd.to_numeric(df["Total"].str.replace(".", "", regex=False).str.replace(",", ".", regex=False), errors="coerce")
+
+    df_unidades = df.pivot_table(index="Municipios", columns=[col_indicador, "Periodo"], values="Total", aggfunc="first", sort=False, dropna=False)
+    df_unidades = df_unidades.reindex(columns=[(indicador, anio) for indicador in INDICADORES_RENTA for anio in ("2023", "2022")]).reset_index()
+    df_unidades.columns = COLUMNAS_RENTA
+    return df_unidades
+
+
+def descargar_datos_renta_provincia_http(sesion, nombre_provincia, url_datos_provincia, path, url_csv=URL_CSV_TABLA_INE, info_fuente=None):
+    """ En vez de rellenar el formulario con selenium, se descarga la exportacion CSV de la tabla del INE
+        (el identificador de la tabla es el parametro t de la url de la provincia) y se filtra con pandas:
+        años 2023 y 2022 y los 6 indicadores de renta. Los municipios se guardan en el excel de la provincia y
+        los municipios, distritos y secciones censales en la particion de la provincia del almacen.
+        Si se pasa info_fuente (datos de la descarga anterior) y la tabla no ha cambiado, no se vuelve a procesar.
+        Devuelve (cambiado, info_fuente_nueva)."""
+    print(nombre_provincia, url_datos_provincia)
+    tabla = parse_qs(urlparse(url_datos_provincia).query)["t"][0]
+
+    with traza_scraping.paso("descargar", tabla) as evento:
+        respuesta = sesion.get(url_csv.format(tabla=tabla), headers=cabeceras_condicionales(info_fuente), timeout=120)
+        cambiado, info = comprobar_cambio(traza_scraping.anotar_respuesta(evento, respuesta), info_fuente)
+    if not cambiado:
+        print(f"{nombre_provincia} sin cambios")
+        return False, info
+
+    with traza_scraping.paso("parsear", tabla):
+        df_unidades = parsear_csv_renta(respuesta.content)
+
+    # El excel (y el dataset renta) sigue teniendo solo los municipios.
+    # Municipios, distritos y secciones van al dataset particionado del almacen (ver almacen_datos.guardar_unidades_renta)
+    df_tabla_final = df_unidades[df_unidades["Municipios"].str.match(r"^\d{5} ")]
+    # Mismo indice que la version selenium, donde se descarta la primera fila de la tabla
+    df_tabla_final.index = range(1, len(df_tabla_final) + 1)
+
+    if df_tabla_final.empty:
+        raise Exception(f"La tabla {tabla} no tiene datos de municipios")
+
+    with traza_scraping.paso("escribir", nombre_provincia):
+        guardar_renta_provincia(df_tabla_final, nombre_provincia, path)
+        almacen_datos.guardar_unidades_renta(path, almacen_datos.preparar_unidades_renta(df_unidades))
+    return True, info
+
+
+def descargar_renta_con_respaldo(sesion, obtener_browser, nombre_provincia, url_datos_provincia, path, backend, info_fuente=None, url_csv=URL_CSV_TABLA_INE):
+    # Primero se intenta por HTTP. Si falla (o backend="selenium") se usa el navegador, y entonces siempre se considera que ha cambiado
+    if backend == "http":
+        try:
+            return descargar_datos_renta_provincia_http(sesion, nombre_provincia, url_datos_provincia, path, url_csv, info_fuente)
+        except Exception as e:
+            print(f"Descarga HTTP fallida para {nombre_provincia} ({e}). Se usa selenium")
+    descargar_datos_renta_provincia(obtener_browser(), nombre_provincia, url_datos_provincia, path)
+    return True, None
+
+
+def leer_progreso(fichero_progreso):
+    if fichero_progreso is None or not os.path.exists(fichero_progreso):
+        return set()
+    with open(fichero_progreso, encoding="utf-8") as f:
+        return set(json.load(f)["completadas"])
+
+
+def guardar_progreso(fichero_progreso, completadas):
+    # Se escribe en un fichero temporal y se renombra para no dejar el progreso a medias si se corta el proceso
+    temporal = fichero_progreso + ".tmp"
+    with open(temporal, "w", encoding="utf-8") as f:
+        json.dump({"completadas": sorted(completadas)}, f, ensure_ascii=False, indent=2)
+    os.replace(temporal, fichero_progreso)
+
+
+def worker_rentas(cola, path, backend, reintentos, fichero_progreso, completadas, fallidas, lock, fuentes=None, cambiadas=None, url_csv=URL_CSV_TABLA_INE):
+    # Cada worker tiene su propia sesion HTTP y, solo si hace falta, su propio navegador headless.
+    # Va cogiendo provincias de la cola hasta vaciarla
+    sesion = crear_sesion()
+    browser = None
+
+    def obtener_browser():
+        nonlocal browser
+        if browser is None:
+            browser = crear_navegador(headless=True)
+        return browser
+
+    try:
+        while True:
+            try:
+                nombre_provincia, url_datos_provincia = cola.get_nowait()
+            except queue.Empty:
+                break
+
+            for intento in range(1, reintentos + 1):
+                try:
+                    # En modo incremental solo se usa la descarga anterior si el excel y la particion de la provincia siguen existiendo
+                    info_fuente = None
+                    id_provincia = nomenclator.id_region("Provincia", nombre_provincia)
+                    if (fuentes is not None and os.path.exists(ruta_excel_renta(nombre_provincia, path))
+                            and os.path.exists(almacen_datos.ruta_particion_unidades(path, id_provincia))):
+                        info_fuente = fuentes.get(f"renta/{nombre_provincia}")
+
+                    # Los pasos de la traza llevan la provincia y el intento
+                    with traza_scraping.contexto(provincia=nombre_provincia, intento=intento):
+                        cambiado, info = descargar_renta_con_respaldo(sesion, obtener_browser, nombre_provincia, url_datos_provincia, path, backend, info_fuente, url_csv)
+                    with lock:
+                        completadas.add(nombre_provincia)
+                        if fuentes is not None:
+                            if info is not None:
+                                fuentes[f"renta/{nombre_provincia}"] = info
+                            if cambiado:
+                                cambiadas.add(nombre_provincia)
+                        if fichero_progreso is not None:
+                            guardar_progreso(fichero_progreso, completadas)
+                    break
+                except Exception as e:
+                    print(f"Error en {nombre_provincia} (intento {intento}/{reintentos}): {e}")
+                    # Si el navegador se ha quedado en mal estado, se reinicia antes de reintentar
+                    if browser is not None:
+                        try:
+                            browser.quit()
+                        except Exception:
+                            pass
+                        browser = None
+            else:
+                with lock:
+                    fallidas.append(nombre_provincia)
+    finally:
+        if browser is not None:
+            browser.quit()
+        sesion.close()
+
+
+def obtener_datos_ine_rentas(path, num_workers=1, reintentos=3, fichero_progreso=None, backend="http", incremental=False, url_csv=URL_CSV_TABLA_INE):
+    """ Obtiene los datos de renta de todas las provincias del INE.
+        Con backend="http" cada provincia se descarga con peticiones HTTP y selenium solo se usa si la descarga falla.
+        Las urls de las provincias se guardan en urls_rentas.json para no tener que abrir el navegador en las siguientes ejecuciones
+        (si el INE cambia las urls, basta con borrar ese fichero).
+        Con num_workers=1 se recorren las provincias una detras de otra.
+        Con num_workers>1 se lanza un pool de workers que van cogiendo provincias de una cola.
+        Si se indica fichero_progreso, las provincias ya descargadas se apuntan ahi y se saltan al relanzar el proceso.
+        Con incremental=True solo se reescriben las provincias cuya tabla ha cambiado desde la ultima descarga.
+        url_csv es la plantilla de la exportacion CSV de las tablas (se cambia para probar contra un servidor local).
+        Devuelve el conjunto de provincias que han cambiado (todas si no es incremental)."""
+
+    fichero_urls = os.path.join(path, "urls_rentas.json")
+    if backend == "http" and os.path.exists(fichero_urls):
+        with open(fichero_urls, encoding="utf-8") as f:
+            diccionario_de_urls = json.load(f)
+    else:
+        browser = crear_navegador()
+        diccionario_de_urls = obtener_urls_provincias_rentas(browser)
+        browser.close()
+        with open(fichero_urls, "w", encoding="utf-8") as f:
+            json.dump(diccionario_de_urls, f, ensure_ascii=False, indent=2)
+
+    completadas = leer_progreso(fichero_progreso)
+    pendientes = {nombre: url for nombre, url in diccionario_de_urls.items() if nombre not in completadas}
+    print(f"Provincias pendientes: {len(pendientes)} de {len(diccionario_de_urls)}")
+
+    #Recorremos el diccionario para obtener los datos de las provincias. 2022 y 2023
+    cola = queue.Queue()
+    for item in pendientes.items():
+        cola.put(item)
+
+    lock = threading.Lock()
+    fallidas = []
+    fuentes = leer_fuentes(path)
+    cambiadas = set()
+    argumentos = (cola, path, backend, reintentos, fichero_progreso, completadas, fallidas, lock, fuentes if incremental else None, cambiadas, url_csv)
+    if num_workers <= 1:
+        worker_rentas(*argumentos)
+    else:
+        workers = [
+            threading.Thread(target=worker_rentas, args=argumentos)
+            for _ in range(min(num_workers, len(pendientes)))
+        ]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+
+    if incremental:
+        guardar_fuentes(path, fuentes)
+        print(f"Provincias con cambios: {len(cambiadas)}")
+    else:
+        cambiadas = set(pendientes)
+
+    if fallidas:
+        raise Exception(f"No se han podido descargar las provincias: {fallidas}")
+
+    # Si todo ha ido bien se borra el progreso para que la siguiente ejecucion vuelva a descargarlo todo
+    if fichero_progreso is not None and os.path.exists(fichero_progreso):
+        os.remove(fichero_progreso)
+
     print("Se ha completado la obtención de los datos de rentas del INE")
+    return cambiadas
+
+
+def nombres_cabecera(celdas):
+    # Igual que pd.read_html(header=0): las cabeceras vacias pasan a "Unnamed: i" y las repetidas llevan ".1", ".2"...
+    nombres = []
+    for i, texto in enumerate(celdas):
+        nombre = texto or f"Unnamed: {i}"
+        base, n = nombre, 0
+        while nombre in nombres:
+            n += 1
+            nombre = f"{base}.{n}"
+        nombres.append(nombre)
+    return nombres
+
+
+def tipar_columna_html(valores, decimal, thousands):
+    # La columna pasa a numerica solo si todos los valores no vacios son numeros (como hace pd.read_html)
+    serie = pd.Series(valores, dtype=object).replace("", np.nan)
+    numerica = pd.to_numeric(serie.str.replace(thousands, "", regex=False).str.replace(decimal, ".", regex=False), errors="coerce")
+    if numerica.notna().sum() == serie.notna().sum():
+        return numerica
+    return serie
+
+
+def leer_tabla_html(fuente, id_tabla, encoding=None, decimal=",", thousands="."):
+    """ Lee la tabla html con ese id en una sola pasada (lxml iterparse), sin construir el DOM de toda la pagina.
+        Cada fila se pasa a las listas de sus columnas y se libera en cuanto se lee. Al acabar la tabla se deja de leer.
+        fuente es un fichero binario (o BytesIO). Devuelve lo mismo que pd.read_html(..., header=0, decimal=decimal, thousands=thousands)[0]."""
+    columnas = None
+    valores = None
+    dentro = False
+
+    for evento, elemento in etree.iterparse(fuente, events=("start", "end"), tag=("table", "tr"), html=True, encoding=encoding):
+        if elemento.tag == "table":
+            if elemento.get("id") == id_tabla:
+                if evento == "end":
+                    break
+                dentro = True
+            continue
+        if evento != "end" or not dentro:
+            continue
 
+        celdas = []
+        for celda in elemento:
+            if celda.tag in ("td", "th"):
+                texto = " ".join("".join(celda.itertext()).split())
+                celdas += [texto] * int(celda.get("colspan") or 1)
 
-def obtener_datos_ine_criminalidad(path):
+        # Se libera la fila ya leida y las anteriores para que el arbol no crezca
+        elemento.clear()
+        while elemento.getprevious() is not None:
+            del elemento.getparent()[0]
 
-    url_minterior_datos_criminalidad = 'https://estadisticasdecriminalidad.ses.mir.es/publico/portalestadistico/'
+        if columnas is None:
+            columnas = nombres_cabecera(celdas)
+            valores = [[] for _ in columnas]
+        elif any(celdas):
+            celdas += [""] * (len(columnas) - len(celdas))
+            for lista, texto in zip(valores, celdas):
+                lista.append(texto)
 
-    
-    browser = webdriver.Chrome(service=Service(ChromeDriverManager().install()))
-    browser.maximize_window()
-    browser.get(url = url_minterior_datos_criminalidad)
+    if columnas is None:
+        raise ValueError(f"No se ha encontrado la tabla {id_tabla}")
+    return pd.DataFrame({col: tipar_columna_html(lista, decimal, thousands) for col, lista in zip(columnas, valores)})
+
+
+URL_PORTAL_CRIMINALIDAD = 'https://estadisticasdecriminalidad.ses.mir.es/publico/portalestadistico/'
+
+
+def abrir_portal_criminalidad(browser):
+    navegar(browser, URL_PORTAL_CRIMINALIDAD)
 
     # Para aceptar el boton de cookies.
     try:
-        boton_cookies = WebDriverWait(browser, 10).until(
-            EC.element_to_be_clickable((By.CSS_SELECTOR, "button#AceptoCookies"))
-        )
-        time.sleep(0.7)
-        boton_cookies.click()
-        time.sleep(0.7)
+        boton_cookies = esperar(browser, EC.element_to_be_clickable((By.CSS_SELECTOR, "button#AceptoCookies")), "cookies")
+        esperar_pagina(browser, "cookies")
+        clicar(boton_cookies, "cookies")
 
-        # esperar a que desaparezca el banner
-        WebDriverWait(browser, 10).until(
-            EC.invisibility_of_element_located((By.CSS_SELECTOR, "button#AceptoCookies"))
-        )
+        # esperar a que desaparezca el banner (antes, una pausa fija)
+        esperar(browser, EC.invisibility_of_element_located((By.CSS_SELECTOR, "button#AceptoCookies")), "cookies", sustituye=PAUSA_FIJA)
     except:
         pass
 
-    #Para que parezca un poco natural, añado un sleep entre acciones
-    boton_acceder_balance_criminalidad = (WebDriverWait(browser, 10).until(EC.element_to_be_clickable((By.CSS_SELECTOR, 'main section div.card-footer'))))
-    boton_acceder_balance_criminalidad.click()
-    time.sleep(0.7)
+
+def obtener_hrefs_trimestres_selenium(browser):
+    #Entre accion y accion se espera a que la pagina este lista (ver esperar_pagina)
+    boton_acceder_balance_criminalidad = esperar(browser, EC.element_to_be_clickable((By.CSS_SELECTOR, 'main section div.card-footer')), "balance de criminalidad")
+    clicar(boton_acceder_balance_criminalidad, "balance de criminalidad")
+    esperar_pagina(browser, "balance de criminalidad")
 
     # Hacemos scroll hasta el año 2025. Lo cerramos para que aparezcan los demás sin necesidad de hacer scroll "x" pixeles
     # Abrimos el año 2023.
@@ -304,180 +706,271 @@ def obtener_datos_ine_criminalidad(path):
     # no es necesario consultar 2022 utilizando web scraping. Basta con obtener los datos de los 4 trimestres de 2023 y realizar un tratamiento de los datos
     boton_ultimo_anio = browser.find_element(By.CSS_SELECTOR, "button.accordion-button")
     browser.execute_script("arguments[0].scrollIntoView({block:'center'});", boton_ultimo_anio)
-    time.sleep(0.7)
-    boton_ultimo_anio.click()
-    time.sleep(0.7)
+    esperar(browser, EC.element_to_be_clickable(boton_ultimo_anio), "último año", sustituye=PAUSA_FIJA)
+    clicar(boton_ultimo_anio, "último año")
+    esperar_pagina(browser, "último año")
 
-    boton_2023 = (WebDriverWait(browser, 10).until(EC.element_to_be_clickable((By.XPATH,"//button[.//span[normalize-space()='Año 2023']]"))))
+    boton_2023 = esperar(browser, EC.element_to_be_clickable((By.XPATH,"//button[.//span[normalize-space()='Año 2023']]")), "año 2023")
     browser.execute_script("arguments[0].scrollIntoView({block:'center'});", boton_2023)
-    boton_2023.click()
-    time.sleep(0.7)
+    clicar(boton_2023, "año 2023")
+    esperar_pagina(browser, "año 2023")
 
     # Ahora obtengo todos los botones trimestrales
     # Para no obtener el acordeon (card body que contiene los botones para 2023)
     # puedo filtrar para que encuentre el div cuyo padre tenga el id = id_anio_2023
     accordion_id = boton_2023.get_attribute("aria-controls")
 
-    accordion_2023 = WebDriverWait(browser, 10).until(
-        EC.presence_of_element_located((By.ID, accordion_id))
-    )
+    accordion_2023 = esperar(browser, EC.presence_of_element_located((By.ID, accordion_id)), "año 2023")
     botones_trimestres = accordion_2023.find_elements(By.CSS_SELECTOR, "ul.list-group li a")
 
+    hrefs_trimestres = [boton.get_attribute("href") for boton in botones_trimestres]
+
+    return hrefs_trimestres
+
+
+def descargar_tabla_criminalidad_selenium(browser, href):
+    navegar(browser, href)
+
+    # Este es el desplegable con las estadisticas. Por defecto se abre nada mas visitar la página.
+    # En caso de que en un futuro modifiquen la página, hago un check para comprobar si esta desplegado o no. Si no esta desplegado, hago click
+    boton_estadisticas_x_trimestre = esperar(browser, EC.element_to_be_clickable((By.CSS_SELECTOR,"button.accordion-button")), "estadísticas por trimestre")
+    if boton_estadisticas_x_trimestre.get_attribute("aria-expanded") != "true":
+        esperar_pagina(browser, "estadísticas por trimestre")
+        clicar(boton_estadisticas_x_trimestre, "estadísticas por trimestre")
+        esperar_pagina(browser, "estadísticas por trimestre")
+
+
+    # El boton con el enlace a las estadisticas esta dentro de un iframe. un iframe es un html dentro de otro html
+    # Es necesario cambiar el browser al html del iframe
+    # Despues ya podemos seleccionar el ultimo elemento dentro de la lista <li> que esta dentro de <ul.secciones>
+    iframe = esperar(browser, EC.presence_of_element_located((By.ID, "iframeINE")), "iframeINE")
+
+    # Cambiamos el contexto de Selenium al iframe
+    browser.switch_to.frame(iframe)
+
+    # Ahora sí podemos buscar el último li dentro de ul.secciones
+    ul_secciones = esperar(browser, EC.presence_of_element_located((By.CSS_SELECTOR, "ul.secciones")), "secciones")
+    li_secciones = ul_secciones.find_elements(By.TAG_NAME, "li")
+    ultimo_li = li_secciones[-1]
+    clicar(ultimo_li, "última sección")
+
+    # Seleccionamos toda la geografía, todas las tipologías penales y todos los periodosç
+    # Después, clicamos en "consultar selección"
+    botones_seleccionar_todas_las_opciones = esperar(
+        browser, EC.presence_of_all_elements_located((By.CSS_SELECTOR, "button.icoSeleccionTodos")), "seleccionar todo", sustituye=PAUSA_FIJA)
+    browser.execute_script("arguments[0].scrollIntoView({block:'center'});", botones_seleccionar_todas_las_opciones[0])
+    esperar(browser, EC.element_to_be_clickable(botones_seleccionar_todas_las_opciones[0]), "seleccionar todo", sustituye=PAUSA_FIJA)
+
+    #En este caso, en vez de seleccionar las opciones manualmente como hago en la otra funcion, esta vez puedo darle a 3 botones de "seleccionar todo"
+
+    for boton in botones_seleccionar_todas_las_opciones:
+        clicar(boton, "seleccionar todo")
+        esperar_pagina(browser, "seleccionar todo")
+
+    boton_consultar_seleccion_datos_criminalidad = browser.find_element(By.CSS_SELECTOR, "div#capaBotones input#botonConsulSele")
+    browser.execute_script("arguments[0].scrollIntoView({block:'center'});", boton_consultar_seleccion_datos_criminalidad)
+    esperar(browser, EC.element_to_be_clickable(boton_consultar_seleccion_datos_criminalidad), "consultar selección", sustituye=PAUSA_FIJA)
+    clicar(boton_consultar_seleccion_datos_criminalidad, "consultar selección")
+
+    esperar(browser, EC.presence_of_element_located((By.ID, "tablaDatosPx")), "tablaDatosPx")
+
+    html_tabla_criminalidad_x_trimestre = leer_tabla_navegador(browser, "tablaDatosPx")
+    with traza_scraping.paso("parsear", "tablaDatosPx"):
+        df_tabla_final = leer_tabla_html(BytesIO(html_tabla_criminalidad_x_trimestre.encode("utf-8")), "tablaDatosPx", encoding="utf-8")
+
+    return df_tabla_final
+
+
+def obtener_hrefs_trimestres_http(sesion, anio="2023", url_portal=URL_PORTAL_CRIMINALIDAD):
+    # Las paginas del portal no necesitan javascript para mostrar los enlaces: el acordeon de cada año ya viene en el html
+    soup = BeautifulSoup(obtener_html(sesion, url_portal), "html.parser")
+    url_balance = urljoin(url_portal, soup.select_one("main section div.card-footer a[href]")["href"])
+
+    soup = BeautifulSoup(obtener_html(sesion, url_balance), "html.parser")
+    boton_anio = next(b for b in soup.find_all("button") if b.find("span", string=lambda t: t and t.strip() == f"Año {anio}"))
+    acordeon = soup.find(id=boton_anio["aria-controls"])
+    return [urljoin(url_balance, a["href"]) for a in acordeon.select("ul.list-group li a[href]")]
+
+
+def campos_formulario_seleccionar_todo(formulario):
+    # Equivale a pulsar los botones de "seleccionar todo" y despues "consultar selección":
+    # se envian todas las opciones de cada select junto con los campos ocultos del formulario
+    campos = []
+    for campo in formulario.find_all(["input", "select"]):
+        nombre = campo.get("name")
+        if not nombre:
+            continue
+        if campo.name == "select":
+            campos += [(nombre, opcion.get("value", opcion.text)) for opcion in campo.find_all("option")]
+        elif campo.get("type", "text") in ("checkbox", "radio"):
+            if campo.has_attr("checked"):
+                campos.append((nombre, campo.get("value", "on")))
+        elif campo.get("type") in ("submit", "button", "image"):
+            if campo.get("id") == "botonConsulSele":
+                campos.append((nombre, campo.get("value", "")))
+        else:
+            campos.append((nombre, campo.get("value", "")))
+    return campos
+
+
+def descargar_tabla_criminalidad_http(sesion, href, info_fuente=None):
+    # Mismo recorrido que con selenium (pagina del trimestre -> iframe -> ultima seccion -> formulario), pero con peticiones HTTP.
+    # Devuelve (tabla, info_fuente_nueva). Si la tabla no ha cambiado respecto a info_fuente, la tabla es None
+    soup = BeautifulSoup(obtener_html(sesion, href), "html.parser")
+    url_iframe = urljoin(href, soup.find("iframe", id="iframeINE")["src"])
+
+    soup = BeautifulSoup(obtener_html(sesion, url_iframe), "html.parser")
+    url_seleccion = urljoin(url_iframe, soup.select("ul.secciones li a[href]")[-1]["href"])
+
+    soup = BeautifulSoup(obtener_html(sesion, url_seleccion), "html.parser")
+    formulario = soup.find("input", id="botonConsulSele").find_parent("form")
+    accion = urljoin(url_seleccion, formulario.get("action") or url_seleccion)
+    campos = campos_formulario_seleccionar_todo(formulario)
+
+    cabeceras = cabeceras_condicionales(info_fuente)
+    with traza_scraping.paso("descargar", "tablaDatosPx") as evento:
+        if formulario.get("method", "get").lower() == "post":
+            respuesta = sesion.post(accion, data=campos, headers=cabeceras, timeout=120)
+        else:
+            respuesta = sesion.get(accion, params=campos, headers=cabeceras, timeout=120)
+        cambiado, info = comprobar_cambio(traza_scraping.anotar_respuesta(evento, respuesta), info_fuente)
+    if not cambiado:
+        return None, info
+
+    with traza_scraping.paso("parsear", "tablaDatosPx"):
+        return leer_tabla_html(BytesIO(respuesta.content), "tablaDatosPx", encoding=codificacion_respuesta(respuesta)), info
+
+
+def cargar_trimestre_anterior(path, nombre_trimestre):
+    # Trimestre guardado en la ejecucion anterior, con las columnas de texto como en la salida de reestructurar_excel_datos_criminalidad
+    df = almacen_datos.cargar_dataset(path, f"criminalidad_{nombre_trimestre}")
+    if df is None:
+        return None
+    for col in ["Comunidad", "Provincia", "Municipio", "Tipo Delito", "Trimestre"]:
+        df[col] = df[col].astype(object).where(df[col].notna(), None)
+    return df
+
+
+def obtener_datos_ine_criminalidad(path, backend="http", incremental=False, url_portal=URL_PORTAL_CRIMINALIDAD):
+    """ Obtiene los datos de criminalidad de los 4 trimestres de 2023 del portal del ministerio de interior.
+        Con backend="http" se descargan las tablas con peticiones HTTP y selenium solo se usa si algo falla.
+        Con incremental=True, los trimestres cuya tabla no ha cambiado se reutilizan de la ejecucion anterior.
+        url_portal es la portada desde la que se recorre el portal por HTTP (se cambia para probar contra un servidor local).
+        Devuelve ({trimestre: datos}, conjunto de trimestres que han cambiado)."""
+
+    sesion = crear_sesion()
+    browser = None
+
+    def obtener_browser():
+        nonlocal browser
+        if browser is None:
+            browser = crear_navegador()
+            abrir_portal_criminalidad(browser)
+        return browser
+
+    hrefs_trimestres = None
+    if backend == "http":
+        try:
+            hrefs_trimestres = obtener_hrefs_trimestres_http(sesion, url_portal=url_portal)
+        except Exception as e:
+            print(f"No se han podido obtener los trimestres por HTTP ({e}). Se usa selenium")
+    if not hrefs_trimestres:
+        hrefs_trimestres = obtener_hrefs_trimestres_selenium(obtener_browser())
+
     #Para obtener el dato, recorremos los 4 botones de los trimestres.
     dict_trimestres = {1: "Enero_marzo", 2: "Enero_junio", 3: "enero_septiembre", 4: "enero_diciembre"}
 
-    hrefs_trimestres = [boton.get_attribute("href") for boton in botones_trimestres]
+    # Devolvemos los datos de cada trimestre para no tener que volver a leer los excels despues
+    datos_trimestres = {}
+    trimestres_cambiados = set()
+    fuentes = leer_fuentes(path)
 
     for i, href in enumerate(hrefs_trimestres, start=1):
         print(f"Trimestre {i}: {href}")
-        browser.get(url = href)
-
-        # Este es el desplegable con las estadisticas. Por defecto se abre nada mas visitar la página.
-        # En caso de que en un futuro modifiquen la página, hago un check para comprobar si esta desplegado o no. Si no esta desplegado, hago click
-        boton_estadisticas_x_trimestre = (WebDriverWait(browser, 10).until(EC.element_to_be_clickable((By.CSS_SELECTOR,"button.accordion-button"))))
-        if boton_estadisticas_x_trimestre.get_attribute("aria-expanded") != "true":
-            time.sleep(0.7)
-            boton_estadisticas_x_trimestre.click()
-            time.sleep(0.7)
-
-
-        # El boton con el enlace a las estadisticas esta dentro de un iframe. un iframe es un html dentro de otro html
-        # Es necesario cambiar el browser al html del iframe
-        # Despues ya podemos seleccionar el ultimo elemento dentro de la lista <li> que esta dentro de <ul.secciones>
-        iframe = WebDriverWait(browser, 10).until(
-            EC.presence_of_element_located((By.ID, "iframeINE"))
-        )
-
-        # Cambiamos el contexto de Selenium al iframe
-        browser.switch_to.frame(iframe)
 
-        # Ahora sí podemos buscar el último li dentro de ul.secciones
-        ul_secciones = WebDriverWait(browser, 10).until(
-            EC.presence_of_element_located((By.CSS_SELECTOR, "ul.secciones"))
-        )
-        li_secciones = ul_secciones.find_elements(By.TAG_NAME, "li")
-        ultimo_li = li_secciones[-1]
-        ultimo_li.click()
-        time.sleep(0.7)
-
-        # Seleccionamos toda la geografía, todas las tipologías penales y todos los periodosç
-        # Después, clicamos en "consultar selección"
-        botones_seleccionar_todas_las_opciones = browser.find_elements(By.CSS_SELECTOR, "button.icoSeleccionTodos")
-        browser.execute_script("arguments[0].scrollIntoView({block:'center'});", botones_seleccionar_todas_las_opciones[0])
-        time.sleep(0.7)
-
-        #En este caso, en vez de seleccionar las opciones manualmente como hago en la otra funcion, esta vez puedo darle a 3 botones de "seleccionar todo"
-
-        for boton in botones_seleccionar_todas_las_opciones:
-            boton.click()
-            time.sleep(0.7)
-
-        boton_consultar_seleccion_datos_criminalidad = browser.find_element(By.CSS_SELECTOR, "div#capaBotones input#botonConsulSele")
-        browser.execute_script("arguments[0].scrollIntoView({block:'center'});", boton_consultar_seleccion_datos_criminalidad)
-        time.sleep(0.7)
-        boton_consultar_seleccion_datos_criminalidad.click()
-        
-        WebDriverWait(browser, 10).until(EC.presence_of_element_located((By.ID, "tablaDatosPx")))
-
-        html_tabla_criminalidad_x_trimestre = browser.find_element(By.ID, "tablaDatosPx").get_attribute("outerHTML")
-        tabla_con_datos_criminalidad_x_trimestre = BeautifulSoup(html_tabla_criminalidad_x_trimestre, "html.parser")
-        table = tabla_con_datos_criminalidad_x_trimestre.find("table", id="tablaDatosPx")
-        df_tabla_final = pd.read_html(str(table), header=0, decimal=",", thousands=".")[0]
-
-        
-        df_tabla_final_parseada = reestructurar_excel_datos_criminalidad(df_tabla_final, trimestre = dict_trimestres[i])
-        df_tabla_final_parseada.to_excel(path + fr"\{dict_trimestres[i].lower()}_datos_criminalidad_espana.xlsx")
-
-    browser.close()
+        nombre_trimestre = dict_trimestres[i].lower()
+        df_anterior = cargar_trimestre_anterior(path, nombre_trimestre) if incremental else None
+        info_fuente = fuentes.get(f"criminalidad/{nombre_trimestre}") if df_anterior is not None else None
+
+        # Los pasos de la traza llevan el trimestre
+        with traza_scraping.contexto(trimestre=nombre_trimestre):
+            df_tabla_final = None
+            sin_cambios = False
+            if backend == "http":
+                try:
+                    df_tabla_final, fuentes[f"criminalidad/{nombre_trimestre}"] = descargar_tabla_criminalidad_http(sesion, href, info_fuente)
+                    sin_cambios = df_tabla_final is None
+                except Exception as e:
+                    print(f"Descarga HTTP fallida ({e}). Se usa selenium")
+            if sin_cambios:
+                print(f"{nombre_trimestre} sin cambios")
+                datos_trimestres[nombre_trimestre] = df_anterior
+                continue
+            if df_tabla_final is None:
+                df_tabla_final = descargar_tabla_criminalidad_selenium(obtener_browser(), href)
+
+            with traza_scraping.paso("reestructurar", nombre_trimestre):
+                df_tabla_final_parseada = reestructurar_excel_datos_criminalidad(df_tabla_final, trimestre = dict_trimestres[i])
+            with traza_scraping.paso("escribir", nombre_trimestre):
+                df_tabla_final_parseada.to_excel(path + fr"\{nombre_trimestre}_datos_criminalidad_espana.xlsx")
+                almacen_datos.guardar_dataset(path, f"criminalidad_{nombre_trimestre}", df_tabla_final_parseada)
+            datos_trimestres[nombre_trimestre] = df_tabla_final_parseada
+            trimestres_cambiados.add(nombre_trimestre)
+
+    guardar_fuentes(path, fuentes)
+    if browser is not None:
+        browser.close()
+    sesion.close()
     print("Se ha completado la obtencion de los datos de criminalidad del ministerio de interior")
+    return datos_trimestres, trimestres_cambiados
 
 def agrupar_datos_por_trimestres(df_enero_marzo, df_enero_junio, df_enero_septiembre, df_enero_diciembre):
     """ Con esta funcion pretendo agrupar todos los datos obtenidos de enero_marzo, enero_junio, enero_septiembre y enero_diciembre
         Los datos obtenidos del ministerio de interior de criminalidad, en vez de venir agrupados por trimestres, agrupan el trimestre actual
         y el trimestre anterior. De tal forma que cuando antes obtenia el dato de los botones primer trimestre, segundo trimestre... en realidad
-        estaba obtiendo el agregado hasta la fecha."""
-    
-    cols_clave = ["Comunidad", "Provincia", "Municipio", "Tipo Delito"]
-
-    for df in [df_enero_marzo, df_enero_junio, df_enero_septiembre, df_enero_diciembre]:
-        df["Dato 2023"] = pd.to_numeric(df["Dato 2023"], errors="coerce")
-        df["Dato 2022"] = pd.to_numeric(df["Dato 2022"], errors="coerce")
-        for col in cols_clave:
-            df[col] = df[col].fillna("").str.strip() #.str.upper()
-    
-    combinaciones = set()
-    for df in [df_enero_marzo, df_enero_junio, df_enero_septiembre, df_enero_diciembre]:
-        combinaciones.update([tuple(x) for x in df[cols_clave].values])
-
-    def alinear(df):
-        df_full = pd.DataFrame(list(combinaciones), columns=cols_clave)
-        df_merge = df_full.merge(df, on=cols_clave, how="left")
-        df_merge[["Dato 2023", "Dato 2022"]] = df_merge[["Dato 2023", "Dato 2022"]].fillna(0)
-        return df_merge
-    
-    df_enero_marzo = alinear(df_enero_marzo)
-    df_enero_junio = alinear(df_enero_junio)
-    df_enero_septiembre = alinear(df_enero_septiembre)
-    df_enero_diciembre = alinear(df_enero_diciembre)
-
-    # Calcular trimestres reales
-    df1 = df_enero_marzo.copy(); df1["Trimestre"] = "Enero-Marzo"
-    df2 = df_enero_junio.copy(); df2["Dato 2023"] -= df_enero_marzo["Dato 2023"]; df2["Dato 2022"] -= df_enero_marzo["Dato 2022"]; df2["Trimestre"] = "Abril-Junio"
-    df3 = df_enero_septiembre.copy(); df3["Dato 2023"] -= df_enero_junio["Dato 2023"]; df3["Dato 2022"] -= df_enero_junio["Dato 2022"]; df3["Trimestre"] = "Julio-Septiembre"
-    df4 = df_enero_diciembre.copy(); df4["Dato 2023"] -= df_enero_septiembre["Dato 2023"]; df4["Dato 2022"] -= df_enero_septiembre["Dato 2022"]; df4["Trimestre"] = "Octubre-Diciembre"
-
-    # Concatenar todos los trimestres
-    df_long = pd.concat([df1, df2, df3, df4], ignore_index=True)
-
-    ccaa_dict = {"ANDALUCÍA": "Andalucía", "ARAGÓN": "Aragón", "ASTURIAS (PRINCIPADO DE)": "Principado de Asturias", "BALEARS (ILLES)": "Illes Balears", "CANARIAS": "Canarias", 
-                 "CANTABRIA": "Cantabria", "CASTILLA - LA MANCHA": "Castilla-La Mancha", "CASTILLA Y LEON": "Castilla y León", "CATALUÑA": "Cataluña", "CIUDAD AUTÓNOMA DE CEUTA": "Ciudad Autónoma de Ceuta", 
-                 "CIUDAD AUTÓNOMA DE MELILLA": "Ciudad Autónoma de Melilla", "COMUNITAT VALENCIANA": "Comunidad Valenciana", "EXTREMADURA": "Extremadura", "GALICIA": "Galicia", 
-                 "MADRID (COMUNIDAD DE)": "Comunidad de Madrid", "MURCIA (REGION DE)": "Región de Murcia", "NAVARRA (COMUNIDAD FORAL DE)": "Comunidad Foral de Navarra", "PAÍS VASCO": "País Vasco", 
-                 "RIOJA (LA)": "La Rioja", "NACIONAL": "Nacional", "EN EL EXTRANJERO": "En el extranjero"}
-    
-    provincias_dict = {"Provincia de ÁVILA": "Ávila", "Provincia de ALBACETE": "Albacete", "Provincia de ALICANTE/ALACANT": "Alicante", "Provincia de ALMERÍA": "Almería", 
-                       "Provincia de ARABA/ÁLAVA": "Álava", "Provincia de BADAJOZ": "Badajoz", "Provincia de BALEARS (LAS)": "Las Palmas", "Provincia de BARCELONA": "Barcelona", 
-                       "Provincia de BIZKAIA": "Bizkaia", "Provincia de BURGOS": "Burgos", "Provincia de CÁCERES": "Cáceres", "Provincia de CÁDIZ": "Cádiz", "Provincia de CASTELLÓN/CASTELLÓ": "Castellón", 
-                       "Provincia de CIUDAD REAL": "Ciudad Real", "Provincia de CÓRDOBA": "Córdoba", "Provincia de CORUÑA (A)": "A Coruña", "Provincia de CUENCA": "Cuenca", 
-                       "Provincia de GIRONA": "Girona", "Provincia de GRANADA": "Granada", "Provincia de GUADALAJARA": "Guadalajara", "Provincia de GIPUZKOA": "Gipuzkoa", 
-                       "Provincia de HUELVA": "Huelva", "Provincia de HUESCA": "Huesca", "Provincia de JAÉN": "Jaén", "Provincia de LEÓN": "León", "Provincia de LLEIDA": "Lleida", 
-                       "Provincia de LUGO": "Lugo", "Provincia de MADRID": "Madrid", "Provincia de MÁLAGA": "Málaga", "Provincia de MURCIA": "Murcia", "Provincia de OURENSE": "Ourense", 
-                       "Provincia de PALENCIA": "Palencia", "Provincia de PALMAS (LAS)": "Las Palmas", "Provincia de PONTEVEDRA": "Pontevedra", "Provincia de SALAMANCA": "Salamanca", 
-                       "Provincia de SANTA CRUZ DE TENERIFE": "Santa Cruz de Tenerife", "Provincia de SEGOVIA": "Segovia", "Provincia de SEVILLA": "Sevilla", "Provincia de SORIA": "Soria", 
-                       "Provincia de TARRAGONA": "Tarragona", "Provincia de TERUEL": "Teruel", "Provincia de TOLEDO": "Toledo", "Provincia de VALENCIA/VALÈNCIA": "Valencia", 
-                       "Provincia de VALLADOLID": "Valladolid", "Provincia de ZAMORA": "Zamora", "Provincia de ZARAGOZA": "Zaragoza", "": ""}
-    
-    df_long["Comunidad"] = df_long["Comunidad"].replace(ccaa_dict)
-    df_long["Provincia"] = df_long["Provincia"].replace(provincias_dict)
-    df_long["Municipio"] = df_long["Municipio"].str.replace("Municipio de ", "", regex=False).str.replace("Municipo de ", "", regex=False)
-    df_long["Variación 2023/2022"] = ((df_long["Dato 2023"] - df_long["Dato 2022"]) / df_long["Dato 2022"] * 100).round(1)
-
-    # Pivot para 2023
-    df_wide_2023 = df_long.pivot_table(index=cols_clave,columns="Trimestre",values="Dato 2023",aggfunc="first")
-
-    # Pivot para 2022
-    df_wide_2022 = df_long.pivot_table(index=cols_clave,columns="Trimestre",values="Dato 2022",aggfunc="first")
-
-    df_variacion_2023_2022 = df_long.pivot_table(index=cols_clave, columns="Trimestre", values="Variación 2023/2022", aggfunc="first")
-
-    df_wide_2023.columns = [f"{c}2023" for c in df_wide_2023.columns]
-    df_wide_2022.columns = [f"{c}2022" for c in df_wide_2022.columns]
-    df_variacion_2023_2022.columns = [f"{c}_VAR_2023_2022" for c in df_variacion_2023_2022.columns]
+        estaba obtiendo el agregado hasta la fecha.
+        Los cuatro acumulados se juntan en una tabla con claves categoricas, se completan con un unico pivot (0 si una region no aparece
+        en un acumulado) y cada trimestre es la diferencia (groupby diff) entre su acumulado y el anterior de la misma region.
+        Devuelve el LONG con una columna "Dato <año>" por cada año de las tablas y la variacion de cada año frente al anterior.
+        El modelo largo y las vistas anchas se obtienen de aqui con almacen_datos.modelo_largo y almacen_datos.vista_ancha."""
 
-    df_wide = (df_wide_2023.join(df_wide_2022, how="outer").join(df_variacion_2023_2022, how="outer").reset_index())
-
-    # Columnas de trimestres
-    trimestres = ["Enero-Marzo", "Abril-Junio", "Julio-Septiembre", "Octubre-Diciembre"]
+    cols_clave = ["Comunidad", "Provincia", "Municipio", "Tipo Delito"]
+    cols_dato = [f"Dato {anio}" for anio in sorted(almacen_datos.columnas_por_anio(df_enero_marzo, "Dato "), reverse=True)]
 
-    # Sumar los trimestres para 2023 y 2022
-    df_wide["Total_2023"] = df_wide[[f"{t}2023" for t in trimestres]].sum(axis=1)
-    df_wide["Total_2022"] = df_wide[[f"{t}2022" for t in trimestres]].sum(axis=1)
+    # El acumulado de enero a junio es el dato hasta Abril-Junio, etc.
+    acumulados = pd.concat(
+        [df[cols_clave + cols_dato].assign(Trimestre=trimestre)
+         for df, trimestre in zip([df_enero_marzo, df_enero_junio, df_enero_septiembre, df_enero_diciembre], almacen_datos.TRIMESTRES)],
+        ignore_index=True
+    )
+    for col in cols_clave:
+        acumulados[col] = acumulados[col].fillna("").str.strip().astype("category")
+    acumulados["Trimestre"] = acumulados["Trimestre"].astype(pd.CategoricalDtype(almacen_datos.TRIMESTRES, ordered=True))
+    acumulados[cols_dato] = acumulados[cols_dato].apply(pd.to_numeric, errors="coerce")
+
+    # Todas las regiones con los 4 trimestres, en orden dentro de cada region
+    completo = (
+        acumulados.drop_duplicates(subset=cols_clave + ["Trimestre"])
+        .set_index(cols_clave + ["Trimestre"])[cols_dato]
+        .unstack("Trimestre")
+        .stack("Trimestre", future_stack=True)
+        .fillna(0)
+    )
+    trimestral = completo.groupby(level=cols_clave, observed=True, sort=False).diff().fillna(completo)
 
-    # Variación porcentual anual
-    df_wide["Variación_total_2023_2022"] = ((df_wide["Total_2023"] - df_wide["Total_2022"]) / df_wide["Total_2022"] * 100).round(1)
+    # Mismo orden que antes: primero todas las filas de Enero-Marzo, luego Abril-Junio...
+    df_long = trimestral.reset_index().sort_values("Trimestre", kind="stable", ignore_index=True)
 
+    # Los nombres del ministerio se pasan a los del nomenclátor (una búsqueda por valor distinto) y se devuelven como texto
+    df_long["Comunidad"] = nomenclator.nombres_region("Comunidad", df_long["Comunidad"])
+    df_long["Provincia"] = nomenclator.nombres_region("Provincia", df_long["Provincia"])
+    df_long["Municipio"] = df_long["Municipio"].map(lambda v: v.replace("Municipio de ", "").replace("Municipo de ", "")).astype(object)
+    df_long["Tipo Delito"] = df_long["Tipo Delito"].astype(object)
+    df_long["Trimestre"] = df_long["Trimestre"].astype(object)
+    for actual, anterior in zip(cols_dato, cols_dato[1:]):
+        df_long[f"Variación {actual[5:]}/{anterior[5:]}"] = almacen_datos.variacion(df_long[actual], df_long[anterior])
 
-    return df_long, df_wide
+    return df_long
 
 
 if __name__ == "__main__":
@@ -492,38 +985,61 @@ if __name__ == "__main__":
     path = path_ejecucion + "\\data\\"
 
 
-    #Llamamos a la funcion que realiza el scraping a la pagina del ministerio de interior para los datos de criminalidad
-    obtener_datos_ine_criminalidad(path)
-    
-    #Una vez obtenidos los datos, necesitamos agruparlos para mayor comodidad de cara a la parte de streamlit
-    df_enero_marzo = pd.read_excel(fr"{path}\enero_marzo_datos_criminalidad_espana.xlsx")
-    df_enero_junio = pd.read_excel(fr"{path}\enero_junio_datos_criminalidad_espana.xlsx")
-    df_enero_septiembre = pd.read_excel(fr"{path}\enero_septiembre_datos_criminalidad_espana.xlsx")
-    df_enero_diciembre = pd.read_excel(fr"{path}\enero_diciembre_datos_criminalidad_espana.xlsx")
+    #Con --incremental solo se vuelven a procesar las tablas que han cambiado desde la ultima ejecucion
+    incremental = "--incremental" in sys.argv
 
-    long, datos_finales_criminalidad = agrupar_datos_por_trimestres(df_enero_marzo, df_enero_junio, df_enero_septiembre, df_enero_diciembre)
-
-    # Esto es necesario porque en los datos, las comunidades autonomas que no tienen mas de 1 provincia, no aparece la combinacion Comunidad, Provincia por razones obvias.
-    # Pero esto es un problema de cara a pintar los datos en nuestro futuro mapa interactivo. Es necesario que aparezca el nombre exacto de la provincia.
-    # Por ejemplo, la Comunidad de Madrid está formada por una única provincia, que es Madrid. Dentro de Madrid provincia, tenemos Madrid como municipio(pero eso si que está bien reflejado).
-    # Por tanto lo unico que se necesita hacer es 1. identificar las comunidades con una unica provincia e introducir el dato utilizando una mascara booleana
-    mapa_comunidad_provincia = {'Cantabria': 'Cantabria', 'Comunidad Foral de Navarra': 'Navarra', 'Comunidad de Madrid': 'Madrid', 
-                                'Illes Balears': 'Baleares', 'La Rioja': 'La Rioja', 'Principado de Asturias': 'Asturias', 'Región de Murcia': 'Murcia'}
-
-    mask_long = (long["Provincia"] == "") & (long["Comunidad"].isin(mapa_comunidad_provincia.keys()))
-    long.loc[mask_long, "Provincia"] = long.loc[mask_long, "Comunidad"].map(mapa_comunidad_provincia)
-
-    mask = (datos_finales_criminalidad["Provincia"] == "") & (datos_finales_criminalidad["Comunidad"].isin(mapa_comunidad_provincia.keys()))
-    datos_finales_criminalidad.loc[mask, "Provincia"] = datos_finales_criminalidad.loc[mask, "Comunidad"].map(mapa_comunidad_provincia)
-
-
-    #Ahora almacenamos el dato final de criminalidad. Tanto en versión long como wide (en caso de necesitar ambas en Streamlit)
-    long.to_excel(path + "datos_criminalidad_espana_LONG.xlsx")
-    datos_finales_criminalidad.to_excel(path + "datos_criminalidad_espana_WIDE.xlsx")
-    print(datos_finales_criminalidad.columns)
-
-
-    #Llamamos a la funcion que realiza el scraping a la pagina del INE para los datos de renta media y mediana
-    obtener_datos_ine_rentas(path)
-
-        
\ No newline at end of file
+    #Cada paso (navegar, clicar, esperar, descargar, parsear, reestructurar, escribir) queda en una traza con su duracion.
+    #Al terminar (tambien si falla) se guarda en traza_scraping.json y se muestra el resumen por paso
+    try:
+        #Llamamos a la funcion que realiza el scraping a la pagina del ministerio de interior para los datos de criminalidad
+        datos_trimestres, trimestres_cambiados = obtener_datos_ine_criminalidad(path, incremental=incremental)
+
+        if not incremental or trimestres_cambiados or almacen_datos.cargar_dataset(path, "criminalidad") is None:
+            #Una vez obtenidos los datos, necesitamos agruparlos para mayor comodidad de cara a la parte de streamlit
+            #Usamos directamente los dataframes devueltos por el scraping en vez de volver a leer los excels
+            df_enero_marzo = datos_trimestres["enero_marzo"]
+            df_enero_junio = datos_trimestres["enero_junio"]
+            df_enero_septiembre = datos_trimestres["enero_septiembre"]
+            df_enero_diciembre = datos_trimestres["enero_diciembre"]
+
+            with traza_scraping.paso("reestructurar", "agrupar trimestres"):
+                long = agrupar_datos_por_trimestres(df_enero_marzo, df_enero_junio, df_enero_septiembre, df_enero_diciembre)
+
+            # Esto es necesario porque en los datos, las comunidades autonomas que no tienen mas de 1 provincia, no aparece la combinacion Comunidad, Provincia por razones obvias.
+            # Pero esto es un problema de cara a pintar los datos en nuestro futuro mapa interactivo. Es necesario que aparezca el nombre exacto de la provincia.
+            # Por ejemplo, la Comunidad de Madrid está formada por una única provincia, que es Madrid. Dentro de Madrid provincia, tenemos Madrid como municipio(pero eso si que está bien reflejado).
+            # Por tanto lo unico que se necesita hacer es 1. identificar las comunidades con una unica provincia (las da el nomenclátor) e introducir el dato utilizando una mascara booleana
+            mask_long = (long["Provincia"] == "") & (long["Comunidad"].isin(nomenclator.PROVINCIA_UNICA.keys()))
+            long.loc[mask_long, "Provincia"] = long.loc[mask_long, "Comunidad"].map(nomenclator.PROVINCIA_UNICA)
+
+
+            #Ahora almacenamos el dato final de criminalidad en el almacén parquet (es lo que lee streamlit), en formato largo.
+            #Los años que ya estaban en el almacén se conservan, así se pueden ir acumulando las publicaciones de varios años.
+            #Tambien se exporta a excel, tanto en versión long como wide (el último año frente al anterior)
+            with traza_scraping.paso("escribir", "criminalidad"):
+                modelo = almacen_datos.combinar_modelos(almacen_datos.cargar_dataset(path, "criminalidad"), almacen_datos.modelo_largo(long))
+                almacen_datos.guardar_dataset(path, "criminalidad", modelo)
+                datos_finales_criminalidad = almacen_datos.vista_ancha(modelo)
+                long.to_excel(path + "datos_criminalidad_espana_LONG.xlsx")
+                datos_finales_criminalidad.to_excel(path + "datos_criminalidad_espana_WIDE.xlsx")
+            print(datos_finales_criminalidad.columns)
+        else:
+            print("No hay cambios en los datos de criminalidad")
+
+
+        #Llamamos a la funcion que realiza el scraping a la pagina del INE para los datos de renta media y mediana
+        #Se usa un pool de navegadores headless (uno por nucleo, maximo 8). Si el proceso se corta, al relanzarlo continua donde se quedo
+        provincias_cambiadas = obtener_datos_ine_rentas(path, num_workers=min(8, os.cpu_count() or 1), fichero_progreso=path + "progreso_rentas.json", incremental=incremental)
+
+        #Compilamos los excels de rentas de cada provincia en un unico dataset del almacén
+        if not incremental or provincias_cambiadas or almacen_datos.cargar_dataset(path, "renta") is None:
+            with traza_scraping.paso("escribir", "renta"):
+                excels_rentas = almacen_datos.ficheros_rentas(path)
+                df_rentas = almacen_datos.guardar_dataset(path, "renta", almacen_datos.preparar_rentas(excels_rentas), fuentes=almacen_datos.firma_ficheros(excels_rentas))
+                # Las provincias descargadas con selenium solo tienen municipios
+                almacen_datos.completar_unidades_renta(path, df_rentas)
+        else:
+            print("No hay cambios en los datos de renta")
+    finally:
+        traza_scraping.exportar(path + "traza_scraping.json")
+        print(traza_scraping.informe())
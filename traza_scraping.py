@@ -0,0 +1,132 @@
+import json
+import time
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+# =====================================================
+# TRAZA DEL SCRAPING
+# =====================================================
+# Cada paso del scraping (navegar, clicar, esperar, descargar la tabla, parsear, reestructurar y escribir) se mide
+# con paso(): cuánto tarda, los bytes que baja o escribe, los reintentos y el error si falla. Los pasos se apuntan en
+# una lista de eventos común a todos los hilos (los workers de rentas van en paralelo) y al final se exportan a un json
+# con la traza completa y un resumen por paso.
+#
+# Cada evento lleva además el contexto del hilo (la provincia o el trimestre que se está descargando, ver contexto()),
+# así se puede ver qué provincia o qué trimestre se lleva el tiempo.
+
+PASOS = ["navegar", "clicar", "esperar", "descargar", "parsear", "reestructurar", "escribir"]
+
+EVENTOS = []
+CERROJO = threading.Lock()
+CONTEXTO = threading.local()
+INICIO = time.perf_counter()
+
+
+def reiniciar():
+    global INICIO
+    with CERROJO:
+        EVENTOS.clear()
+        INICIO = time.perf_counter()
+
+
+@contextmanager
+def contexto(**datos):
+    # Datos que se añaden a todos los pasos del hilo dentro del bloque, p. ej. contexto(provincia="Madrid")
+    anterior = getattr(CONTEXTO, "datos", {})
+    CONTEXTO.datos = {**anterior, **datos}
+    try:
+        yield
+    finally:
+        CONTEXTO.datos = anterior
+
+
+@contextmanager
+def paso(tipo, objetivo="", **datos):
+    """ Mide un paso del scraping. Dentro del bloque se pueden añadir datos al evento que devuelve
+        (p. ej. evento["bytes"] = len(contenido)). Si el bloque lanza una excepción se apunta el error y se relanza."""
+    if tipo not in PASOS:
+        raise ValueError(f"Paso desconocido: {tipo}")
+    inicio = time.perf_counter()
+    evento = {"paso": tipo, "objetivo": objetivo, "hilo": threading.current_thread().name,
+              **getattr(CONTEXTO, "datos", {}), **datos}
+    try:
+        yield evento
+    except Exception as e:
+        evento["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        evento["inicio"] = round(inicio - INICIO, 4)
+        evento["duracion"] = round(time.perf_counter() - inicio, 4)
+        with CERROJO:
+            EVENTOS.append(evento)
+
+
+def anotar_respuesta(evento, respuesta):
+    # Bytes de una respuesta HTTP y los reintentos que ha hecho la sesión (urllib3 Retry) antes de conseguirla
+    evento["bytes"] = len(respuesta.content)
+    evento["estado"] = respuesta.status_code
+    reintentos = getattr(getattr(respuesta.raw, "retries", None), "history", ())
+    if reintentos:
+        evento["reintentos"] = len(reintentos)
+    return respuesta
+
+
+def resumen(eventos=None):
+    """ Por paso: número de veces, segundos totales, media, p95 y máximo, bytes y errores. Los reintentos son los de
+        la sesión HTTP más las veces que se ha repetido el paso al reintentar una provincia o un trimestre (intento > 1).
+        En las esperas que sustituyen a una pausa fija, espera_adaptativa es lo que han tardado y pausa_fija lo que
+        habría costado la pausa."""
+    df = pd.DataFrame(EVENTOS if eventos is None else eventos)
+    if df.empty:
+        return pd.DataFrame()
+    for col in ("bytes", "reintentos", "intento", "sustituye"):
+        df[col] = pd.to_numeric(df[col]) if col in df.columns else np.nan
+    if "error" not in df.columns:
+        df["error"] = None
+    df["reintentos"] = df["reintentos"].fillna(0) + (df["intento"].fillna(1) > 1)
+    df["espera_adaptativa"] = df["duracion"].where(df["sustituye"].notna())
+    agrupado = df.groupby("paso", sort=False)
+    tabla = pd.DataFrame({
+        "veces": agrupado.size(),
+        "segundos": agrupado["duracion"].sum(),
+        "media": agrupado["duracion"].mean(),
+        "p95": agrupado["duracion"].quantile(0.95),
+        "maximo": agrupado["duracion"].max(),
+        "bytes": agrupado["bytes"].sum(min_count=1),
+        "reintentos": agrupado["reintentos"].sum(),
+        "errores": agrupado["error"].count(),
+        "espera_adaptativa": agrupado["espera_adaptativa"].sum(min_count=1),
+        "pausa_fija": agrupado["sustituye"].sum(min_count=1),
+    })
+    return tabla.reindex([p for p in PASOS if p in tabla.index])
+
+
+def informe(eventos=None):
+    # Resumen en texto para la consola, con lo que se ahorran las esperas adaptativas frente a las pausas fijas
+    tabla = resumen(eventos)
+    if tabla.empty:
+        return "Traza vacía"
+    lineas = [tabla.round(3).to_string()]
+    if tabla["pausa_fija"].notna().any():
+        lineas.append(f"Esperas adaptativas: {tabla['espera_adaptativa'].sum():.1f}s "
+                      f"frente a {tabla['pausa_fija'].sum():.1f}s de pausas fijas")
+    return "\n".join(lineas)
+
+
+def exportar(ruta):
+    # Json con la traza completa y el resumen por paso
+    with CERROJO:
+        eventos = list(EVENTOS)
+    tabla = resumen(eventos)
+    with open(ruta, "w", encoding="utf-8") as f:
+        json.dump({
+            "fecha": datetime.now().isoformat(timespec="seconds"),
+            "segundos": round(time.perf_counter() - INICIO, 3),
+            "resumen": json.loads(tabla.to_json(orient="index")) if not tabla.empty else {},
+            "eventos": eventos,
+        }, f, ensure_ascii=False, indent=2)
+    return tabla